@@ -0,0 +1,154 @@
+"""
+GSD from raster headers
+-----------------------
+Builds <base_dir>/metashape_report/gsd_4_all.xlsx (filename, GSD(mm/pix),
+flight_altitude(m)) from the pixel size in the transform of each date's
+ortho.tif (else dem.tif), without Metashape or PDF reports. Only the GeoTIFF
+header is read.
+
+  projected CRS   pixel size x linear unit factor (metres per CRS unit)
+  geographic CRS  pixel size in degrees x metres per degree at the raster centre
+
+Dates without a raster fall back to their Metashape PDF report (if any);
+with reports present the raster GSD is also cross-checked against them, and
+flight altitude (not in the raster) is taken from the report.
+
+Usage:
+    python 0_gsd_from_rasters.py D:\\test
+    python 0_gsd_from_rasters.py D:\\test --no-report
+"""
+
+import os
+import math
+import argparse
+import importlib
+import numpy as np
+import pandas as pd
+import rasterio
+import catalog
+
+RASTER_SUFFIXES = ("ortho.tif", "dem.tif")   # preference order
+SEARCH_SUBDIRS = ("", "orthos")              # date folder itself, then orthos/ (after mv_render_dem_orthos)
+SKIP_DIRS = ("metashape_report", "trait_store", "mulch_height", "dem_trait", "nodem_trait", "merged_trait")
+
+
+def find_raster(folder, cat):
+    """First *ortho.tif (else *dem.tif) in the date folder or its orthos/ subfolder."""
+    for suffix in RASTER_SUFFIXES:
+        for sub in SEARCH_SUBDIRS:
+            d = os.path.join(folder, sub)
+            hits = sorted(f for f in catalog.listdir(cat, d) if f.lower().endswith(suffix))
+            if hits:
+                return os.path.join(d, hits[0])
+    return None
+
+
+def _metres_per_degree(lat_deg):
+    """(m per degree longitude, m per degree latitude) on the WGS84 ellipsoid."""
+    phi = math.radians(lat_deg)
+    m_lat = 111132.954 - 559.822 * math.cos(2 * phi) + 1.175 * math.cos(4 * phi)
+    m_lon = 111412.84 * math.cos(phi) - 93.5 * math.cos(3 * phi) + 0.118 * math.cos(5 * phi)
+    return m_lon, m_lat
+
+
+def raster_gsd_mm(path, header=None):
+    """
+    Ground sampling distance (mm/pix, geometric mean of x and y) from the raster
+    header; `header` is the catalog's cached copy (catalog.raster_info), if any.
+    """
+    if header is None:
+        with rasterio.open(path) as src:
+            header = {"width": src.width, "height": src.height, "transform": list(src.transform)[:6],
+                      "crs": src.crs.to_string() if src.crs else None}
+    if header["crs"] is None:
+        raise ValueError("no CRS")
+    crs = rasterio.crs.CRS.from_user_input(header["crs"])
+    transform = rasterio.Affine(*header["transform"])
+    xres, yres = abs(transform.a), abs(transform.e)
+    if crs.is_geographic:
+        _, cy = transform * (header["width"] / 2, header["height"] / 2)
+        m_lon, m_lat = _metres_per_degree(cy)
+        xres, yres = xres * m_lon, yres * m_lat
+    else:
+        factor = crs.linear_units_factor[1]
+        xres, yres = xres * factor, yres * factor
+    return math.sqrt(xres * yres) * 1000.0
+
+
+def _report_values(report_folder):
+    """date -> (GSD mm/pix, flight altitude m) parsed from the Metashape PDF reports."""
+    if not os.path.isdir(report_folder):
+        return {}
+    pdfs = [f for f in os.listdir(report_folder) if f.lower().endswith(".pdf")]
+    if not pdfs:
+        return {}
+    try:
+        extract_pdf_data = importlib.import_module("0_extract_from_report").extract_pdf_data
+    except ImportError as e:
+        print(f"[WARN] Reports not parsed ({e}); using raster GSD only.")
+        return {}
+    values = {}
+    for f in sorted(pdfs):
+        gsd, alt = extract_pdf_data(os.path.join(report_folder, f))
+        if gsd is not None:
+            values[f.split('_')[0]] = (gsd, alt)
+    return values
+
+
+def gsd_table(base_dir, use_report=True, tolerance=0.05, cat=None):
+    """One row per date folder: raster GSD, else report GSD; warns on > `tolerance` disagreement."""
+    report = _report_values(os.path.join(base_dir, "metashape_report")) if use_report else {}
+    cat = cat or catalog.load(base_dir)
+    rows = []
+    for name in catalog.subdirs(cat):
+        folder = os.path.join(base_dir, name)
+        if name in SKIP_DIRS:
+            continue
+        date = name.split('_')[0]
+        rep_gsd, rep_alt = report.get(date, (None, None))
+        gsd, source = None, None
+
+        raster = find_raster(folder, cat)
+        if raster is not None:
+            try:
+                gsd, source = raster_gsd_mm(raster, catalog.raster_info(cat, raster)), os.path.basename(raster)
+            except Exception as e:
+                print(f"[WARN] Could not read GSD from {raster}: {e}")
+        if gsd is None and rep_gsd is not None:
+            gsd, source = rep_gsd, "report"
+        if gsd is None:
+            print(f"[WARN] No ortho/dem raster or report for {name}, skipping.")
+            continue
+        if source != "report" and rep_gsd:
+            rel = abs(gsd - rep_gsd) / rep_gsd
+            tag = "WARN" if rel > tolerance else "INFO"
+            print(f"[{tag}] {date}: raster {gsd:.3f} mm/pix vs report {rep_gsd:.3f} mm/pix ({rel:.1%})")
+
+        rows.append({"filename": date, "GSD(mm/pix)": gsd,
+                     "flight_altitude(m)": rep_alt if rep_alt is not None else np.nan,
+                     "source": source})
+    return pd.DataFrame(rows, columns=["filename", "GSD(mm/pix)", "flight_altitude(m)", "source"])
+
+
+def main(base_dir, use_report=True, tolerance=0.05, cat=None):
+    df = gsd_table(base_dir, use_report=use_report, tolerance=tolerance, cat=cat)
+    if df.empty:
+        print(f"[WARN] No GSD found under {base_dir}")
+        return df
+    report_folder = os.path.join(base_dir, "metashape_report")
+    os.makedirs(report_folder, exist_ok=True)
+    out_path = os.path.join(report_folder, "gsd_4_all.xlsx")
+    df.to_excel(out_path, index=False)
+    print(f"[OK] {len(df)} date(s) → {out_path}")
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GSD table (gsd_4_all.xlsx) from ortho/DEM GeoTIFF headers.")
+    parser.add_argument("base_dir", type=str, help="Base directory with one folder per date")
+    parser.add_argument("--no-report", action="store_true",
+                        help="Ignore Metashape PDF reports (no fallback, no cross-check).")
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="Relative raster/report GSD difference that triggers a warning (default 0.05).")
+    args = parser.parse_args()
+    main(args.base_dir, use_report=not args.no_report, tolerance=args.tolerance)
@@ -1,18 +1,26 @@
 # 10_merge_dem_nodem.py
-# 1) Copy (flatten) per-date DEM/NoDEM Excel files to top-level dem_trait/ & nodem_trait/
-# 2) Merge paired files by auto-detected ID column (tif-like values) into merged_trait/
+# Load dem_trait and nodem_trait for ALL dates at once (trait store written by steps 7-9,
+# or the legacy <date>/dem_trait/*.xlsx & <date>/nodem_trait/*.xlsx), join them once on
+# (Date, <id column>) and write:
+#   trait_store/merged_trait/date=<d>/  + merged_trait/<date>.xlsx   one row per plot and date
+#   trait_store/trait_long.parquet      + merged_trait/traits_long.xlsx   Date, Image ID, Trait, Value
+#   trait_store/trait_wide.parquet      + merged_trait/traits_wide.xlsx   one row per plot, (date, trait) columns
+# Dates with only DEM or only NoDEM traits are skipped, as before.
+# Excel exports are skipped with --no-excel.
 # Usage:
 #   python 10_merge_dem_nodem.py --batchpath E:\AS
+#   python 10_merge_dem_nodem.py --batchpath E:\AS --id-column "Image ID"
 
 import argparse
-import re
-import shutil
 from pathlib import Path
 import pandas as pd
+import trait_store
+import catalog
+import tracing
 
-TIFF_LIKE_RE = re.compile(r".*\.tif(f)?$", re.IGNORECASE)
+ID_COLUMN = trait_store.KEY_COLS[1]
+SKIP_DIRS = ("dem_trait", "nodem_trait", "merged_trait", trait_store.STORE_DIR)
 
-# replace detect_id_column with this
 def detect_id_column(df: pd.DataFrame) -> str | None:
     """Auto-detect an ID column (prefer tif-like values, else fallback to known names)."""
 
@@ -37,99 +45,166 @@ def detect_id_column(df: pd.DataFrame) -> str | None:
 
     return None
 
-def flatten_to_top_level(base: Path) -> tuple[list[Path], list[Path]]:
+def _load_legacy_family(base: Path, family: str, id_column: str) -> pd.DataFrame:
     """
-    Copy *.xlsx from each <date>/dem_trait and <date>/nodem_trait into
-    <base>/dem_trait and <base>/nodem_trait, keeping the same filename.
-    Overwrites if a file with the same name already exists.
-    Returns lists of paths that now exist in the top-level dem/nodem folders.
+    Concatenate every <base>/<date folder>/<family>/*.xlsx into one frame with a
+    'Date' column (file stem if the sheet has none). Sheets without `id_column`
+    fall back to detect_id_column, renamed to `id_column`.
     """
-    top_dem = base / "dem_trait"
-    top_nodem = base / "nodem_trait"
-    top_dem.mkdir(parents=True, exist_ok=True)
-    top_nodem.mkdir(parents=True, exist_ok=True)
-
-    copied_dem, copied_nodem = [], []
-
-    # iterate immediate subfolders of base (date folders)
-    for child in sorted(base.iterdir()):
-        if not child.is_dir():
-            continue
-        if child.name in ("dem_trait", "nodem_trait", "merged_trait"):
+    cat = catalog.load(base)
+    frames = []
+    for name in catalog.subdirs(cat):
+        if name in SKIP_DIRS or family not in catalog.subdirs(cat, base / name):
             continue
-
-        dem_src = child / "dem_trait"
-        nodem_src = child / "nodem_trait"
-
-        if dem_src.is_dir():
-            for f in dem_src.glob("*.xlsx"):
-                dst = top_dem / f.name
-                shutil.copy2(f, dst)  # overwrite if exists
-                copied_dem.append(dst)
-                print(f"[COPY] {f} -> {dst}")
-
-        if nodem_src.is_dir():
-            for f in nodem_src.glob("*.xlsx"):
-                dst = top_nodem / f.name
-                shutil.copy2(f, dst)  # overwrite if exists
-                copied_nodem.append(dst)
-                print(f"[COPY] {f} -> {dst}")
-
-    print(f"[OK] Top-level dem_trait has {len(list(top_dem.glob('*.xlsx')))} files.")
-    print(f"[OK] Top-level nodem_trait has {len(list(top_nodem.glob('*.xlsx')))} files.")
-    return list(top_dem.glob("*.xlsx")), list(top_nodem.glob("*.xlsx"))
-
-def merge_pairs(base: Path):
+        for f in catalog.files(cat, base / name / family, kind="trait", suffix=".xlsx"):
+            f = Path(f)
+            with tracing.span("pd.read_excel", path=str(f)):
+                df = pd.read_excel(f)
+            if id_column not in df.columns:
+                found = detect_id_column(df)
+                if found is None:
+                    print(f"[WARN] No '{id_column}' column in {f}, skipping.")
+                    continue
+                print(f"[WARN] No '{id_column}' column in {f}, using detected '{found}'.")
+                df = df.rename(columns={found: id_column})
+            if "Date" not in df.columns:
+                df.insert(0, "Date", f.stem)
+            frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=["Date", id_column])
+    return pd.concat(frames, ignore_index=True)
+
+def load_family(base: Path, family: str, id_column: str = ID_COLUMN) -> pd.DataFrame:
+    """All dates of one trait family, from the trait store if present, else legacy xlsx."""
+    if trait_store.has_family(base, family):
+        df = trait_store.read_traits(base, family)
+        if id_column != ID_COLUMN:
+            df = df.rename(columns={ID_COLUMN: id_column})
+        return df
+    return _load_legacy_family(base, family, id_column)
+
+def _drop_duplicates(df: pd.DataFrame, keys: list, name: str) -> pd.DataFrame:
     """
-    Pair files by identical filename between <base>/dem_trait and <base>/nodem_trait,
-    auto-detect ID columns (tif-like), and write merged files into <base>/merged_trait.
+    Keep the last row per (Date, plot). Two date folders with the same date
+    prefix write the same keys; the old per-file copy into dem_trait/ kept the last.
     """
-    dem_dir = base / "dem_trait"
-    nodem_dir = base / "nodem_trait"
-    out_dir = base / "merged_trait"
-    out_dir.mkdir(parents=True, exist_ok=True)
-
-    demfiles = sorted(dem_dir.glob("*.xlsx"))
-    nodem_map = {p.name: p for p in nodem_dir.glob("*.xlsx")}
-
-    merged_count = 0
-    for demfile in demfiles:
-        nodemfile = nodem_map.get(demfile.name)
-        if nodemfile is None:
-            print(f"[WARN] Missing NoDEM for {demfile.name}, skipping.")
-            continue
-
-        df_dem = pd.read_excel(demfile)
-        df_nodem = pd.read_excel(nodemfile)
-
-        dem_id = detect_id_column(df_dem)
-        nodem_id = detect_id_column(df_nodem)
-        if not dem_id or not nodem_id:
-            print(f"[WARN] Could not detect ID in {demfile.name}, skipping.")
-            continue
-
-        print(f"[INFO] Pair {demfile.name}: DEM id='{dem_id}', NoDEM id='{nodem_id}'")
-        merged = pd.merge(df_dem, df_nodem, left_on=dem_id, right_on=nodem_id, how="outer")
-
-        out_file = out_dir / demfile.name
-        merged.to_excel(out_file, index=False)
-        print(f"[OK] Wrote {out_file}")
-        merged_count += 1
-
-    if merged_count == 0:
-        print("[WARN] No merged files created.")
-    else:
-        print(f"[DONE] Created {merged_count} merged file(s) in {out_dir}")
+    dup = df.duplicated(keys, keep="last")
+    if not dup.any():
+        return df
+    print(f"[WARN] {int(dup.sum())} duplicate {tuple(keys)} row(s) in the {name} traits "
+          f"(e.g. {tuple(df.loc[dup, keys].iloc[0])}), keeping the last.")
+    return df[~dup]
+
+@tracing.traced()
+def build_trait_tables(df_dem: pd.DataFrame, df_nodem: pd.DataFrame, id_column: str = ID_COLUMN):
+    """
+    One outer join of the DEM and NoDEM traits over all dates on (Date, id_column).
+    As before, only dates with both tables are merged; a date with only one is skipped,
+    and duplicate (Date, id_column) rows keep the last one.
+    Returns (merged, long, wide), or None when no date has both:
+      merged  one row per (Date, plot), trait columns as written by steps 8/9
+      long    Date, id_column, Trait, Value (categorical keys, NaN values dropped)
+      wide    index id_column, columns (Date, Trait)
+    Non-numeric trait columns are kept in `merged` only.
+    """
+    keys = ["Date", id_column]
+    for name, df in (("DEM", df_dem), ("NoDEM", df_nodem)):
+        missing = [k for k in keys if k not in df.columns]
+        if missing:
+            raise KeyError(f"{name} traits have no {missing} column(s); pass --id-column")
+    df_dem = df_dem.astype({"Date": str, id_column: str})
+    df_nodem = df_nodem.astype({"Date": str, id_column: str})
+
+    dem_dates, nodem_dates = set(df_dem["Date"]), set(df_nodem["Date"])
+    for date in sorted(dem_dates - nodem_dates):
+        print(f"[WARN] Missing NoDEM for {date}, skipping.")
+    for date in sorted(nodem_dates - dem_dates):
+        print(f"[WARN] Missing DEM for {date}, skipping.")
+    dates = dem_dates & nodem_dates
+    if not dates:
+        return None
+    df_dem = df_dem[df_dem["Date"].isin(dates)]
+    df_nodem = df_nodem[df_nodem["Date"].isin(dates)]
+    df_dem = _drop_duplicates(df_dem, keys, "DEM")
+    df_nodem = _drop_duplicates(df_nodem, keys, "NoDEM")
+
+    merged = pd.merge(df_dem, df_nodem, on=keys, how="outer", suffixes=(" (DEM)", " (NoDEM)"))
+    merged["Date"] = pd.Categorical(merged["Date"], categories=sorted(dates), ordered=True)
+    merged[id_column] = merged[id_column].astype("category")
+    merged = merged.sort_values(keys, ignore_index=True)
+
+    trait_cols = [c for c in merged.columns if c not in keys and pd.api.types.is_numeric_dtype(merged[c])]
+    dropped = [c for c in merged.columns if c not in keys and c not in trait_cols]
+    if dropped:
+        print(f"[INFO] Non-numeric columns left out of the long/wide tables: {dropped}")
+
+    long = merged.melt(id_vars=keys, value_vars=trait_cols, var_name="Trait", value_name="Value")
+    long["Trait"] = pd.Categorical(long["Trait"], categories=trait_cols)
+    long = long.dropna(subset=["Value"]).reset_index(drop=True)
+
+    wide = long.pivot(index=id_column, columns=["Date", "Trait"], values="Value")
+    wide = wide.reindex(columns=pd.MultiIndex.from_product(
+        [merged["Date"].cat.categories, trait_cols], names=["Date", "Trait"])).dropna(axis=1, how="all")
+    return merged, long, wide
+
+def _flat_wide(wide: pd.DataFrame) -> pd.DataFrame:
+    """Wide table with '<date>_<trait>' column names (Parquet needs flat string names)."""
+    flat = wide.copy()
+    flat.columns = [f"{date}_{trait}" for date, trait in flat.columns]
+    return flat.reset_index()
+
+@tracing.traced()
+def merge_all(base: Path, id_column: str = ID_COLUMN, excel: bool = True):
+    """Build merged/long/wide trait tables for every date under `base` and write them."""
+    df_dem = load_family(base, "dem_trait", id_column)
+    df_nodem = load_family(base, "nodem_trait", id_column)
+    if df_dem.empty and df_nodem.empty:
+        print("[WARN] No DEM or NoDEM traits found.")
+        return None
+    tables = build_trait_tables(df_dem, df_nodem, id_column)
+    if tables is None:
+        print("[WARN] No date has both DEM and NoDEM traits; nothing merged.")
+        return None
+    merged, long, wide = tables
 
-def main(batchpath: str):
-    base = Path(batchpath)
-    # 1) flatten/copy to top-level dem_trait & nodem_trait
-    flatten_to_top_level(base)
-    # 2) merge paired files into merged_trait
-    merge_pairs(base)
+    out_dir = base / "merged_trait"
+    if excel:
+        out_dir.mkdir(parents=True, exist_ok=True)
+    for date, g in merged.groupby("Date", observed=True, sort=True):
+        g = g.astype({"Date": str, id_column: str})
+        if id_column != ID_COLUMN:
+            g = g.rename(columns={id_column: ID_COLUMN})
+        trait_store.write_traits(base, "merged_trait", date, g)
+        if excel:
+            with tracing.span("to_excel", path=str(out_dir / f"{date}.xlsx"), rows=len(g)):
+                g.to_excel(out_dir / f"{date}.xlsx", index=False)
+
+    print(f"[OK] Wrote {trait_store.write_table(base, 'trait_long', long)}")
+    print(f"[OK] Wrote {trait_store.write_table(base, 'trait_wide', _flat_wide(wide))}")
+    if excel:
+        with tracing.span("to_excel", path=str(out_dir / "traits_long.xlsx"), rows=len(long)):
+            long.to_excel(out_dir / "traits_long.xlsx", index=False)
+        with tracing.span("to_excel", path=str(out_dir / "traits_wide.xlsx"), rows=len(wide)):
+            wide.to_excel(out_dir / "traits_wide.xlsx")
+        print(f"[OK] Wrote Excel exports to {out_dir}")
+
+    print(f"[DONE] {merged['Date'].nunique()} date(s) x {merged[id_column].nunique()} plot(s): "
+          f"{len(long)} long rows, wide {wide.shape[0]} x {wide.shape[1]}")
+    return merged, long, wide
+
+def main(batchpath: str, id_column: str = ID_COLUMN, excel: bool = True):
+    merge_all(Path(batchpath), id_column=id_column, excel=excel)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Flatten DEM/NoDEM xlsx to top-level and merge by tif-like ID.")
+    parser = argparse.ArgumentParser(description="Merge DEM/NoDEM traits of all dates into merged, long and wide "
+                                                 "tables. Dates with only one of the two are skipped.")
     parser.add_argument("--batchpath", type=str, required=True, help="Path to the base folder")
+    parser.add_argument("--id-column", type=str, default=ID_COLUMN,
+                        help="Plot ID column shared by the DEM and NoDEM tables (default: 'Image ID').")
+    parser.add_argument("--no-excel", action="store_true",
+                        help="Keep the merged/long/wide tables in the trait store only.")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
     args = parser.parse_args()
-    main(args.batchpath)
+    tracing.start(args.trace)
+    main(args.batchpath, id_column=args.id_column, excel=not args.no_excel)
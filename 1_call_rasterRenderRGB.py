@@ -1,15 +1,17 @@
 import os
 import subprocess
 import argparse
+import catalog
 
 def main(base_dir: str, folder_pattern: str, suffix: str):
     # Iterate over folders
-    for folder_name in os.listdir(base_dir):
+    cat = catalog.load(base_dir)
+    for folder_name in catalog.subdirs(cat):
         folder_path = os.path.join(base_dir, folder_name)
-        if os.path.isdir(folder_path) and folder_name.endswith(folder_pattern):
+        if folder_name.endswith(folder_pattern):
             orthos_folder = os.path.join(folder_path, 'orthos')
-            if os.path.isdir(orthos_folder):
-                ortho_files = [f for f in os.listdir(orthos_folder) if f.endswith(suffix)]
+            if 'orthos' in catalog.subdirs(cat, folder_path):
+                ortho_files = [f for f in catalog.listdir(cat, orthos_folder) if f.endswith(suffix)]
                 if ortho_files:
                     ortho_file_path = os.path.join(orthos_folder, ortho_files[0])
                     command = f"python 1_rasterRenderRGB.py -s \"{ortho_file_path}\""
@@ -6,6 +6,7 @@ from qgis.gui import *
 import numpy as np
 
 import argparse
+import raster_profile
 ap = argparse.ArgumentParser()
 ap.add_argument("-s", "--srcRaster", required=True,
     help="source raster file")
@@ -81,6 +82,14 @@ pipe.set(provider.clone())
 pipe.set(renderer.clone())
 
 file_writer = QgsRasterFileWriter(str(sourceRaster).replace(".tif","_rgb_render.tif"))
+# shared output layout (tiled, DEFLATE + predictor, BIGTIFF as needed, internal overviews)
+file_writer.setCreateOptions(raster_profile.creation_options("uint8", width, height, layer="render"))
+factors = raster_profile.overview_factors(width, height)
+if factors:
+    file_writer.setBuildPyramidsFlag(QgsRaster.PyramidsFlagYes)
+    file_writer.setPyramidsList(factors)
+    file_writer.setPyramidsResampling("AVERAGE")
+    file_writer.setPyramidsFormat(QgsRaster.PyramidsInternal)
 file_writer.writeRaster(pipe, width, height, provider.extent(), crs, QgsCoordinateTransformContext())
 
 
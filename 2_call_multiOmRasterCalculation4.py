@@ -2,17 +2,17 @@ import os
 import sys
 import subprocess
 import argparse
+import catalog
 
 def main(base_dir: str, folder_pattern: str, subdir: str):
-    for folder_name in os.listdir(base_dir):
+    cat = catalog.load(base_dir)
+    for folder_name in catalog.subdirs(cat):
         folder_path = os.path.join(base_dir, folder_name)
-        if not os.path.isdir(folder_path):
-            continue
         if not folder_name.endswith(folder_pattern):
             continue
 
         orthos_path = os.path.join(folder_path, subdir)
-        if not os.path.isdir(orthos_path):
+        if subdir not in catalog.subdirs(cat, folder_path):
             print(f"[skip] missing subdir: {orthos_path}")
             continue
 
@@ -2,6 +2,7 @@ import os
 import sys
 import subprocess
 import argparse
+import catalog
 
 def main(base_dir: str, folder_pattern: str, subdir: str, shp_path: str):
     if not os.path.isdir(base_dir):
@@ -9,13 +10,14 @@ def main(base_dir: str, folder_pattern: str, subdir: str, shp_path: str):
     if not os.path.isfile(shp_path):
         raise FileNotFoundError(f"Shapefile not found: {shp_path}")
 
-    for folder_name in os.listdir(base_dir):
+    cat = catalog.load(base_dir)
+    for folder_name in catalog.subdirs(cat):
         folder_path = os.path.join(base_dir, folder_name)
-        if not (os.path.isdir(folder_path) and folder_name.endswith(folder_pattern)):
+        if not folder_name.endswith(folder_pattern):
             continue
 
         raster_folder = os.path.join(folder_path, subdir)
-        if not os.path.isdir(raster_folder):
+        if subdir not in catalog.subdirs(cat, folder_path):
             print(f"[skip] Missing subdir: {raster_folder}")
             continue
 
@@ -14,26 +14,39 @@ import rasterio
 import os 
 
 from rasterio.mask import mask
+import raster_profile
+import scratch
+import tracing
 
-def crop_from_orthomosaic(src_geoTiff, shape_file, target_path):
+def read_plots(shape_file):
+    """[(plot ID, geometry)] of the plot shapefile; the ID is the chip file name."""
     with fiona.open(shape_file) as shapes:
         geoms = [feature["geometry"] for feature in shapes]
         plotIDs = [feature["properties"] for feature in shapes]
 
-    if not os.path.exists(target_path):
-        os.makedirs(target_path)
-
+    plots = []
     for i in range(len(plotIDs)):
         plotID = str(plotIDs[i]).split(", ")[1].split(")")[0]
-        plotIDUpdated = plotID.replace("'", "")
+        plots.append((plotID.replace("'", ""), geoms[i]))
+    return plots
+
+@tracing.traced()
+def crop_from_orthomosaic(src_geoTiff, shape_file, target_path):
+    plots = read_plots(shape_file)
 
-        with rasterio.open(src_geoTiff) as src:
-            out_image, out_transform = mask(src, [geoms[i]], crop=True)
+    if not os.path.exists(target_path):
+        os.makedirs(target_path)
+
+    for plotIDUpdated, geom in plots:
+        with rasterio.open(src_geoTiff) as src, \
+                tracing.span("rasterio.mask.mask", plot=plotIDUpdated, path=src_geoTiff) as sp:
+            out_image, out_transform = mask(src, [geom], crop=True)
+            sp.set(pixels=int(out_image.shape[1] * out_image.shape[2]))
 
-        out_meta = src.meta.copy()
-        out_meta.update({"driver": "GTiff", "height": out_image.shape[1], "width": out_image.shape[2], "transform": out_transform})
-        
         tif_basename = os.path.splitext(os.path.basename(src_geoTiff))[0].split('_')[-1]
+        out_meta = raster_profile.output_profile(src.meta, raster_profile.chip_layer(tif_basename),
+                                                 height=out_image.shape[1], width=out_image.shape[2],
+                                                 transform=out_transform)
         target_folder = os.path.join(target_path, tif_basename + "_by_plot")
 
         if not os.path.exists(target_folder):
@@ -41,6 +54,19 @@ def crop_from_orthomosaic(src_geoTiff, shape_file, target_path):
 
         with rasterio.open(os.path.join(target_folder, plotIDUpdated + ".tif"), "w", **out_meta) as dest:
             dest.write(out_image)
+            raster_profile.add_overviews(dest, "average")
+
+def crop_folder(src_folder, shape_file, target_path, skip=(), reclaim=True):
+    """
+    Crop every .tif in src_folder, then delete the VI rasters (scratch.py intermediates) unless
+    reclaim=False (pipeline.py reclaims them itself once every consumer is done).
+    Rasters ending in `skip` are left alone (e.g. the ortho when ortho_fanout.py already wrote its chips).
+    """
+    for file in os.listdir(src_folder):
+        if file.endswith(".tif") and not (skip and file.endswith(skip)):
+            crop_from_orthomosaic(os.path.join(src_folder, file), shape_file, target_path)
+    if reclaim:
+        scratch.reclaim(src_folder, "vi_rasters")
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
@@ -50,19 +76,20 @@ if __name__ == "__main__":
                     help="Source shapefile")
     ap.add_argument("-tpath", "--targetPath", required=True,
                     help="Target path")
+    ap.add_argument("--trace", type=str, default=None,
+                    help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
 
     args = ap.parse_args()
     src_geoTiff = args.geoTiff
     plot_shape = args.shapeFile
     target_path = args.targetPath
+    tracing.start(args.trace)
 
     if os.path.isdir(src_geoTiff):
-        for file in os.listdir(src_geoTiff):
-            if file.endswith(".tif"):
-                crop_from_orthomosaic(os.path.join(src_geoTiff, file), plot_shape, target_path)
-                if not file.endswith(('ortho.tif', 'render.tif', 'dem.tif')):
-                    os.remove(os.path.join(src_geoTiff, file))
+        crop_folder(src_geoTiff, plot_shape, target_path)
     else:
         crop_from_orthomosaic(src_geoTiff, plot_shape, target_path)
-        if not file.endswith(('ortho.tif', 'render.tif', 'dem.tif')):
-            os.remove(os.path.join(src_geoTiff, file))
\ No newline at end of file
+        if not src_geoTiff.endswith(scratch.KEEP):
+            for path in (src_geoTiff, src_geoTiff + scratch.SIDECAR):
+                if os.path.exists(path):
+                    os.remove(path)
\ No newline at end of file
@@ -3,33 +3,131 @@ import argparse
 import numpy as np
 import rasterio
 import ckwrap  # ckmeans
+import catalog
+import run_state
+import raster_profile
+import tracing
+import windowed
 try:
-    import cv2  # for optional morphology (closing)
-    _HAS_CV2 = True
+    from morphology import binary_close  # optional closing; needs OpenCV
+    _HAS_MORPH = True
 except Exception:
-    _HAS_CV2 = False
+    _HAS_MORPH = False
+
+HIST_BINS = 65536  # windowed DEM masks: ckmeans on a histogram of the 0..255 scaled values
+
+def _mask_profile(src, nodata_val=0):
+    return raster_profile.output_profile(src.profile, "mask", count=1, dtype="uint8", nodata=nodata_val)
+
+def _mask_block(src, profile):
+    return windowed.common_block(src.block_shapes[0], (profile["blockysize"], profile["blockxsize"]))
 
 def _write_mask_like(src, mask_array, out_path, nodata_val=0):
-    profile = src.profile.copy()
-    profile.update({
-        "count": 1,
-        "dtype": "uint8",
-        "nodata": nodata_val,
-        "compress": "LZW"
-    })
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    with rasterio.open(out_path, "w", **profile) as dst:
+    with rasterio.open(out_path, "w", **_mask_profile(src, nodata_val)) as dst:
         dst.write(mask_array.astype(np.uint8), 1)
+        raster_profile.add_overviews(dst, "nearest")
+
+def _vi_threshold(band, lower_threshold, upper_threshold):
+    # build binary mask (uint8) on valid pixels only
+    mask = np.zeros(band.shape, dtype=np.uint8)
+    valid = ~np.ma.getmaskarray(band)
+    if lower_threshold is None:
+        sel = valid & (band <= upper_threshold)
+    elif upper_threshold is None:
+        sel = valid & (band >= lower_threshold)
+    else:
+        sel = valid & (band >= lower_threshold) & (band <= upper_threshold)
+    mask[sel] = 255
+    return mask
+
+# ---------- windowed variants (rasters larger than --memory-budget, see windowed.py) ----------
+def _dem_bytes_per_px(src):
+    return 3 * np.dtype(src.dtypes[0]).itemsize + 4   # DEM, scaled copy, comparison, masks
+
+def _vi_bytes_per_px(src, band_index):
+    return np.dtype(src.dtypes[band_index - 1]).itemsize + 8   # band, masks, closing buffers
+
+@tracing.traced()
+def _dem_mask_windowed(src, out_fp, k, budget):
+    """
+    DEM mask of a raster larger than `budget`, block by block: a min/max pass,
+    ckmeans on a weighted histogram (HIST_BINS bins) of the scaled values
+    instead of on every pixel, then the threshold pass. The break lies within
+    one bin (255 / HIST_BINS) of the whole-raster ckmeans break.
+    """
+    profile = _mask_profile(src)
+    wins = windowed.windows(src.width, src.height, _mask_block(src, profile), _dem_bytes_per_px(src), budget)
+
+    def dem_in(core):
+        dem = src.read(1, window=core, masked=True)
+        return np.ma.masked_where((dem == -9999) | dem.mask, dem)
+
+    vmin = vmax = None
+    for core, _ in wins:
+        dem = dem_in(core)
+        if dem.count():
+            vmin = dem.min() if vmin is None else min(vmin, dem.min())
+            vmax = dem.max() if vmax is None else max(vmax, dem.max())
+
+    thresh = None
+    if vmin is not None:
+        denom = max(1e-12, float(vmax - vmin))
+        counts = np.zeros(HIST_BINS, dtype=np.int64)
+        for core, _ in wins:
+            vals = ((dem_in(core) - vmin) / denom * 255.0).compressed().astype(np.float32)
+            counts += np.histogram(vals, bins=HIST_BINS, range=(0.0, 255.0))[0]
+        used = np.flatnonzero(counts)
+        centres = (used + 0.5) * (255.0 / HIST_BINS)
+        k_use = max(1, min(k, used.size))
+        with tracing.span("ckwrap.ckmeans", plot=os.path.basename(out_fp), pixels=int(counts.sum())):
+            km = ckwrap.ckmeans(centres, k_use, weights=counts[used].astype(np.float64))
+        thresh = km.centers[1 if k_use >= 2 else 0]
+
+    with rasterio.open(out_fp, "w", **profile) as dst:
+        for core, _ in wins:
+            mask = np.zeros((core.height, core.width), dtype=np.uint8)
+            if thresh is not None:
+                scaled = (dem_in(core) - vmin) / denom * 255.0
+                mask[~scaled.mask & (scaled >= thresh)] = 255
+            dst.write(mask, 1, window=core)
+        raster_profile.add_overviews(dst, "nearest")
+
+@tracing.traced()
+def _vi_mask_windowed(src, out_fp, band_index, lower_threshold, upper_threshold, close_k, budget):
+    """VI mask of a raster larger than `budget`; windows overlap by the closing's reach."""
+    halo = windowed.morph_halo(close_k, close_k)   # dilate then erode
+    profile = _mask_profile(src)
+    wins = windowed.windows(src.width, src.height, _mask_block(src, profile),
+                            _vi_bytes_per_px(src, band_index), budget, halo=halo)
+    with rasterio.open(out_fp, "w", **profile) as dst:
+        for core, read in wins:
+            mask = _vi_threshold(src.read(band_index, window=read, masked=True),
+                                 lower_threshold, upper_threshold)
+            if close_k:
+                mask = binary_close(mask, close_k, shape="rect")
+            dst.write(mask[windowed.core_slices(core, read)], 1, window=core)
+        raster_profile.add_overviews(dst, "nearest")
 
-def generate_masks_dem(image_folder, mask_folder, k=3):
+@tracing.traced()
+def generate_masks_dem(image_folder, mask_folder, k=3, cat=None, force=False, memory_budget=None):
     os.makedirs(mask_folder, exist_ok=True)
-    for fn in os.listdir(image_folder):
+    # chips unchanged since their mask was written (same k) are skipped; see run_state.py
+    state = run_state.open_state(image_folder, "4_dem_mask",
+                                 {"mask_folder": os.path.abspath(mask_folder), "k": k}, force=force)
+    for fn in catalog.listdir(cat or catalog.for_folder(image_folder), image_folder):
         if not fn.lower().endswith(".tif"):
             continue
         in_fp = os.path.join(image_folder, fn)
         out_fp = os.path.join(mask_folder, fn)
+        if run_state.is_fresh(state, fn, [in_fp], [out_fp]):
+            continue
         try:
             with rasterio.open(in_fp) as src:
+                if not windowed.fits(src.width, src.height, _dem_bytes_per_px(src), memory_budget):
+                    _dem_mask_windowed(src, out_fp, k, memory_budget)
+                    run_state.mark_done(state, fn, [in_fp], outputs=[out_fp])
+                    continue
                 dem = src.read(1, masked=True)  # honor nodata
                 # also mask legacy -9999 if present
                 dem = np.ma.masked_where((dem == -9999) | dem.mask, dem)
@@ -37,6 +135,7 @@ def generate_masks_dem(image_folder, mask_folder, k=3):
                 if dem.count() == 0:
                     mask = np.zeros(dem.shape, dtype=np.uint8)
                     _write_mask_like(src, mask, out_fp)
+                    run_state.mark_done(state, fn, [in_fp], outputs=[out_fp])
                     continue
 
                 vmin = dem.min()
@@ -49,7 +148,8 @@ def generate_masks_dem(image_folder, mask_folder, k=3):
                     mask = np.zeros(dem.shape, dtype=np.uint8)
                 else:
                     k_use = max(1, min(k, vals.size))
-                    km = ckwrap.ckmeans(vals, k_use)
+                    with tracing.span("ckwrap.ckmeans", plot=fn, pixels=int(vals.size)):
+                        km = ckwrap.ckmeans(vals, k_use)
                     center_idx = 1 if k_use >= 2 else 0
                     thresh = km.centers[center_idx]
 
@@ -58,73 +158,89 @@ def generate_masks_dem(image_folder, mask_folder, k=3):
                     mask[valid & (scaled >= thresh)] = 255
 
                 _write_mask_like(src, mask, out_fp)
+                run_state.mark_done(state, fn, [in_fp], outputs=[out_fp])
         except Exception as e:
             print(f"[DEM] skip {in_fp}: {e}")
-    print(f"[DEM] masks saved → {mask_folder}")
+    run_state.save(state)
+    print(f"[DEM] masks saved ({run_state.recomputed(state)} rewritten) → {mask_folder}")
 
+@tracing.traced()
 def generate_masks_vi(image_folder, mask_folder,
                       lower_threshold=None, upper_threshold=None,
-                      morph_close=5, band_index=1):
+                      morph_close=5, band_index=1, cat=None, force=False, memory_budget=None):
     if lower_threshold is None and upper_threshold is None:
         raise ValueError("Provide at least one of lower_threshold or upper_threshold.")
     os.makedirs(mask_folder, exist_ok=True)
 
-    kernel = None
-    if _HAS_CV2 and morph_close and morph_close > 1:
-        kernel = np.ones((morph_close, morph_close), np.uint8)
+    do_close = bool(_HAS_MORPH and morph_close and morph_close > 1)
+    state = run_state.open_state(image_folder, "4_vi_mask",
+                                 {"mask_folder": os.path.abspath(mask_folder), "lt": lower_threshold,
+                                  "ut": upper_threshold, "morph_close": morph_close if do_close else 0,
+                                  "band": band_index}, force=force)
 
-    for fn in os.listdir(image_folder):
+    for fn in catalog.listdir(cat or catalog.for_folder(image_folder), image_folder):
         if not fn.lower().endswith(".tif"):
             continue
         in_fp = os.path.join(image_folder, fn)
         out_fp = os.path.join(mask_folder, fn)
+        if run_state.is_fresh(state, fn, [in_fp], [out_fp]):
+            continue
         try:
             with rasterio.open(in_fp) as src:
+                if not windowed.fits(src.width, src.height, _vi_bytes_per_px(src, band_index), memory_budget):
+                    _vi_mask_windowed(src, out_fp, band_index, lower_threshold, upper_threshold,
+                                      morph_close if do_close else 0, memory_budget)
+                    run_state.mark_done(state, fn, [in_fp], outputs=[out_fp])
+                    continue
                 band = src.read(band_index, masked=True)  # masked array
-
-                # build binary mask (uint8) on valid pixels only
-                mask = np.zeros(band.shape, dtype=np.uint8)
-                valid = ~band.mask
-                if lower_threshold is None:
-                    sel = valid & (band <= upper_threshold)
-                elif upper_threshold is None:
-                    sel = valid & (band >= lower_threshold)
-                else:
-                    sel = valid & (band >= lower_threshold) & (band <= upper_threshold)
-                mask[sel] = 255
+                mask = _vi_threshold(band, lower_threshold, upper_threshold)
 
                 # optional morphology closing to fill small holes
-                if kernel is not None:
-                    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+                if do_close:
+                    with tracing.span("binary_close", plot=fn, pixels=int(mask.size)):
+                        mask = binary_close(mask, morph_close, shape="rect")
 
                 _write_mask_like(src, mask, out_fp)
+                run_state.mark_done(state, fn, [in_fp], outputs=[out_fp])
         except Exception as e:
             print(f"[VI] skip {in_fp}: {e}")
-    print(f"[VI] masks saved → {mask_folder}")
+    run_state.save(state)
+    print(f"[VI] masks saved ({run_state.recomputed(state)} rewritten) → {mask_folder}")
+
+def generate_masks_for_date(root,
+                            vi_subdir='OSAVI_by_plot',
+                            dem_subdir='dem_by_plot',
+                            vi_lt=None, vi_ut=None,
+                            morph_close=5, cat=None, force=False, memory_budget=None):
+    """DEM and VI masks of one date folder into <root>/masks/<layer>_mask."""
+    cat = cat or catalog.for_folder(root)
+    present = catalog.subdirs(cat, root)
+
+    dem_image_folder = os.path.join(root, dem_subdir)
+    if dem_subdir in present:
+        dem_mask_folder = os.path.join(root, "masks",
+                                       os.path.basename(dem_image_folder).split("_")[0] + "_mask")
+        generate_masks_dem(dem_image_folder, dem_mask_folder, cat=cat, force=force,
+                           memory_budget=memory_budget)
+
+    vi_image_folder = os.path.join(root, vi_subdir)
+    if vi_subdir in present:
+        vi_mask_folder = os.path.join(root, "masks",
+                                      os.path.basename(vi_image_folder).split("_")[0] + "_mask")
+        generate_masks_vi(vi_image_folder, vi_mask_folder,
+                          lower_threshold=vi_lt, upper_threshold=vi_ut,
+                          morph_close=morph_close, cat=cat, force=force, memory_budget=memory_budget)
 
 def generate_masks_for_batch(batch_folder,
                              vi_subdir='OSAVI_by_plot',
                              dem_subdir='dem_by_plot',
                              vi_lt=None, vi_ut=None,
-                             morph_close=5):
-    for folder in os.listdir(batch_folder):
-        root = os.path.join(batch_folder, folder)
-        if not os.path.isdir(root):
-            continue
-
-        dem_image_folder = os.path.join(root, dem_subdir)
-        if os.path.isdir(dem_image_folder):
-            dem_mask_folder = os.path.join(root, "masks",
-                                           os.path.basename(dem_image_folder).split("_")[0] + "_mask")
-            generate_masks_dem(dem_image_folder, dem_mask_folder)
-
-        vi_image_folder = os.path.join(root, vi_subdir)
-        if os.path.isdir(vi_image_folder):
-            vi_mask_folder = os.path.join(root, "masks",
-                                          os.path.basename(vi_image_folder).split("_")[0] + "_mask")
-            generate_masks_vi(vi_image_folder, vi_mask_folder,
-                              lower_threshold=vi_lt, upper_threshold=vi_ut,
-                              morph_close=morph_close)
+                             morph_close=5, force=False, memory_budget=None):
+    cat = catalog.load(batch_folder)
+    for folder in catalog.subdirs(cat):
+        generate_masks_for_date(os.path.join(batch_folder, folder), vi_subdir=vi_subdir, dem_subdir=dem_subdir,
+                                vi_lt=vi_lt, vi_ut=vi_ut, morph_close=morph_close, cat=cat, force=force,
+                                memory_budget=memory_budget)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate GeoTIFF masks for VI (flexible) and DEM (ckmeans), preserving CRS.")
@@ -148,8 +264,16 @@ if __name__ == "__main__":
     parser.add_argument("--vi-lt", type=float, default=None, help="Batch: VI lower threshold.")
     parser.add_argument("--vi-ut", type=float, default=None, help="Batch: VI upper threshold.")
     parser.add_argument("--vi-morph", type=int, default=5, help="Batch: morphology kernel (pixels). 0=off.")
+    parser.add_argument("--force", action="store_true",
+                        help="Rewrite every mask, ignoring <chip folder>/.run_state.")
+    parser.add_argument("--memory-budget", type=str, default=None,
+                        help="Process rasters larger than this (e.g. 2GB) block by block.")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
 
     args = parser.parse_args()
+    tracing.start(args.trace)
+    memory_budget = windowed.parse_budget(args.memory_budget)
 
     if args.batchpath:
         generate_masks_for_batch(
@@ -158,7 +282,9 @@ if __name__ == "__main__":
             dem_subdir=args.dem_subdir,
             vi_lt=args.vi_lt,
             vi_ut=args.vi_ut,
-            morph_close=args.vi_morph
+            morph_close=args.vi_morph,
+            force=args.force,
+            memory_budget=memory_budget
         )
     else:
         # infer mode if not provided
@@ -168,10 +294,12 @@ if __name__ == "__main__":
             mode = "dem" if "dem" in in_lower else "vi"
 
         if mode == "dem":
-            generate_masks_dem(args.ipath, args.mpath)
+            generate_masks_dem(args.ipath, args.mpath, force=args.force, memory_budget=memory_budget)
         else:
             generate_masks_vi(args.ipath, args.mpath,
                               lower_threshold=args.lt,
                               upper_threshold=args.ut,
                               morph_close=args.morph,
-                              band_index=args.band)
+                              band_index=args.band,
+                              force=args.force,
+                              memory_budget=memory_budget)
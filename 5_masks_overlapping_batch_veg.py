@@ -1,75 +1,141 @@
 # python 5_masks_overlapping_batch_veg.py --ipath F:\...\masks --opath F:\...\masks_overlapping --op AND
 # python 5_masks_overlapping_batch_veg.py --batchpath F:\AS\batch1 --op OR
+# python 5_masks_overlapping_batch_veg.py --batchpath F:\AS\batch1 --with-mulch   (veg + mulch in one pass)
 import os
 import argparse
+from contextlib import ExitStack
 import numpy as np
 import rasterio
-from rasterio.warp import reproject, Resampling
-import cv2
+from reproject_plan import reproject_nearest
+from morphology import close_open, approximation_bound
+import catalog
+import run_state
+import raster_profile
+import tracing
+import windowed
 
-def _postprocess_morph(mask_bool, k_close=0, k_open=0):
+def _postprocess_morph(mask_bool, k_close=0, k_open=0, mode="exact"):
     """
     mask_bool: HxW bool
     k_close, k_open: odd kernel sizes in pixels; 0 disables the op.
+    mode: "exact" (identical to cv2 ellipse) or "approx" (octagon, see morphology.py)
     Returns uint8 (0/255)
     """
-    out_u8 = (mask_bool.astype(np.uint8) * 255)
+    return close_open(mask_bool, k_close=k_close, k_open=k_open, mode=mode)
 
-    if k_close and k_close > 1:
-        kernelclose = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k_close, k_close))
-        out_u8 = cv2.morphologyEx(out_u8, cv2.MORPH_CLOSE, kernelclose)
-    if k_open and k_open > 1:
-        kernelopen = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k_open, k_open))
-        out_u8 = cv2.morphologyEx(out_u8, cv2.MORPH_OPEN, kernelopen)
+def _list_mask_dirs(root, cat):
+    return catalog.subdirs(cat, root)   # hidden folders are not catalogued
 
-    return out_u8
-
-def _list_mask_dirs(root):
-    return [d for d in os.listdir(root)
-            if os.path.isdir(os.path.join(root, d)) and not d.startswith(".")]
-
-def _list_common_filenames(root, subdirs, exts=(".tif", ".tiff")):
+def _list_common_filenames(root, subdirs, cat, exts=(".tif", ".tiff")):
     sets = []
     for sd in subdirs:
         p = os.path.join(root, sd)
-        names = set(fn for fn in os.listdir(p) if fn.lower().endswith(exts))
+        names = set(fn for fn in catalog.listdir(cat, p) if fn.lower().endswith(exts))
         sets.append(names)
     return sorted(list(set.intersection(*sets))) if sets else []
 
+def _binarize(arr, nodata):
+    arr = np.ma.masked_where(arr.mask | (arr == -9999) | ((nodata is not None) & (arr == nodata)), arr)
+    bin_mask = np.zeros(arr.shape, dtype=bool)
+    valid = ~arr.mask
+    bin_mask[valid & (arr > 0)] = True
+    return bin_mask
+
 def _read_and_binarize(fp):
     with rasterio.open(fp) as src:
-        arr = src.read(1, masked=True)
-        nodata = src.nodata
-        arr = np.ma.masked_where(arr.mask | (arr == -9999) | ((nodata is not None) & (arr == nodata)), arr)
-        bin_mask = np.zeros(arr.shape, dtype=bool)
-        valid = ~arr.mask
-        bin_mask[valid & (arr > 0)] = True
-        return bin_mask, src.profile
+        return _binarize(src.read(1, masked=True), src.nodata), src.profile
 
 def _reproject_to_ref(bin_mask, src_profile, ref_profile):
-    if (src_profile["crs"] == ref_profile["crs"] and
-        src_profile["transform"] == ref_profile["transform"] and
-        src_profile["width"] == ref_profile["width"] and
-        src_profile["height"] == ref_profile["height"]):
-        return bin_mask
-    out = np.zeros((ref_profile["height"], ref_profile["width"]), dtype=np.uint8)
-    reproject(
-        source=bin_mask.astype(np.uint8),
-        destination=out,
-        src_transform=src_profile["transform"],
-        src_crs=src_profile["crs"],
-        dst_transform=ref_profile["transform"],
-        dst_crs=ref_profile["crs"],
-        resampling=Resampling.nearest,
-        src_nodata=0,
-        dst_nodata=0,
-    )
-    return out.astype(bool)
+    # nearest-neighbour gather through a cached per-grid-pair plan
+    return reproject_nearest(bin_mask, src_profile, ref_profile, fill=False)
+
+def _should_invert(subdir_name, invert_prefixes):
+    s = subdir_name.lower()
+    return any(s.startswith(p.lower()) for p in invert_prefixes)
+
+def _combine(bool_masks, op):
+    stack = np.stack(bool_masks, axis=0)
+    if op.upper() == "AND":
+        return np.all(stack, axis=0)
+    if op.upper() == "OR":
+        return np.any(stack, axis=0)
+    raise ValueError("op must be one of: AND, OR")
+
+def _u8_profile(prof_ref):
+    return raster_profile.output_profile(prof_ref, "mask", count=1, dtype="uint8", nodata=0)
+
+def _write_u8(out_fp, arr_u8, prof_ref):
+    """Write a uint8 mask; False (and a message) if the write failed."""
+    try:
+        with rasterio.open(out_fp, "w", **_u8_profile(prof_ref)) as dst:
+            dst.write(arr_u8, 1)
+            raster_profile.add_overviews(dst, "nearest")
+    except Exception as e:
+        print(f"[write] {out_fp}: {e}")
+        return False
+    return True
 
+def _window_bytes_per_px(n_sources):
+    # per source: values, nodata mask, vegetation + mulch masks; stack, close/open buffers; plan building
+    return windowed.PLAN_BYTES_PER_PX + 8 * n_sources + 8
+
+@tracing.traced()
+def _combine_windowed(paths, invert_flags, out_fp, mulch_fp, op, post_close, post_open,
+                      morph_mode, mulch_op, budget):
+    """
+    One plot whose reference mask (paths[0]) is larger than `budget`: every
+    source is read only under the current window of the reference grid, and
+    the windows overlap by the reach of the closing + opening, so the result
+    matches the whole-raster path.
+    """
+    halo = windowed.morph_halo(post_close, post_close, post_open, post_open)
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(p)) for p in paths]
+        ref = srcs[0]
+        prof_ref = ref.profile
+        dst = stack.enter_context(rasterio.open(out_fp, "w", **_u8_profile(prof_ref)))
+        mdst = stack.enter_context(rasterio.open(mulch_fp, "w", **_u8_profile(prof_ref))) if mulch_fp else None
+        block = windowed.common_block(ref.block_shapes[0], dst.block_shapes[0])
+        for core, read in windowed.windows(ref.width, ref.height, block,
+                                           _window_bytes_per_px(len(srcs)), budget, halo=halo):
+            bin_masks, mulch_masks = [], []
+            for src, inv in zip(srcs, invert_flags):
+                def veg_and_mulch(arr, nodata=src.nodata, inv=inv):
+                    bm = _binarize(arr, nodata)
+                    return [bm, ~bm if inv else bm]   # invert before aligning, as the whole-raster path
+                bm, mm = windowed.read_on_grid(src, prof_ref, read, veg_and_mulch, fill=False)
+                bin_masks.append(bm)
+                mulch_masks.append(mm)
+            rs = windowed.core_slices(core, read)
+            smoothed_u8 = _postprocess_morph(_combine(bin_masks, op), k_close=post_close,
+                                             k_open=post_open, mode=morph_mode)
+            dst.write(smoothed_u8[rs], 1, window=core)
+            if mdst is not None:
+                mulch = _combine([m[rs] for m in mulch_masks], mulch_op)
+                mdst.write(mulch.astype(np.uint8) * 255, 1, window=core)
+        for d in (dst, mdst):
+            if d is not None:
+                raster_profile.add_overviews(d, "nearest")
+
+@tracing.traced()
 def find_overlapping_masks(image_folder, output_folder,
-                           op="AND", post_close=0, post_open=0):
+                           op="AND", post_close=0, post_open=0, morph_mode="exact",
+                           mulch_folder=None, mulch_op="AND",
+                           invert_prefixes=("ndvi", "osavi"), cat=None, force=False, memory_budget=None):
+    """
+    Combine the per-source masks in `image_folder` into `output_folder`.
+    If `mulch_folder` is given, the mulch masks (6_masks_overlapping_batch_mulch.py
+    semantics: vegetation-like sources inverted, no morphology) are produced
+    from the same reads, so each source mask is decoded once per plot.
+    Plots whose source masks and options are unchanged and whose outputs are
+    the ones this step last wrote are skipped (<image_folder>/.run_state; `force` rewrites all).
+    Plots larger than `memory_budget` (bytes) are processed window by window.
+    """
     os.makedirs(output_folder, exist_ok=True)
-    subdirs = _list_mask_dirs(image_folder)
+    if mulch_folder:
+        os.makedirs(mulch_folder, exist_ok=True)
+    cat = cat or catalog.for_folder(image_folder)
+    subdirs = _list_mask_dirs(image_folder, cat)
     if len(subdirs) < 2 and op == "AND":
         print(f"[WARN] Need >=2 subfolders for {op}. Found: {subdirs}")
     if not subdirs:
@@ -77,20 +143,54 @@ def find_overlapping_masks(image_folder, output_folder,
         return
 
     ref_dir = os.path.join(image_folder, subdirs[0])
-    common_files = _list_common_filenames(image_folder, subdirs)
+    common_files = _list_common_filenames(image_folder, subdirs, cat)
     if not common_files:
         print(f"[WARN] No common file names across {subdirs}")
         return
 
+    if morph_mode == "approx":
+        for name, k in (("close", post_close), ("open", post_open)):
+            if k and k > 1 and k % 2 == 1:  # even sizes run exactly
+                b = approximation_bound(k)
+                print(f"[INFO] approx {name} k={k}: kernel differs by {b['se_mismatch_px']} px, "
+                      f"edges shift <= {2 * b['edge_shift_px']:.1f} px vs exact")
+
+    invert = {sd: _should_invert(sd, invert_prefixes) for sd in subdirs}
+    state = run_state.open_state(image_folder, "5_masks_overlapping",
+                                 {"subdirs": subdirs, "op": op, "post_close": post_close, "post_open": post_open,
+                                  "morph_mode": morph_mode, "output_folder": os.path.abspath(output_folder),
+                                  "mulch_folder": os.path.abspath(mulch_folder) if mulch_folder else None,
+                                  "mulch_op": mulch_op, "invert_prefixes": list(invert_prefixes)}, force=force)
+
     for fn in common_files:
+        inputs = [os.path.join(image_folder, sd, fn) for sd in subdirs]
+        outputs = [os.path.join(output_folder, fn)] + ([os.path.join(mulch_folder, fn)] if mulch_folder else [])
+        if run_state.is_fresh(state, fn, inputs, outputs):
+            continue
         bin_masks = []
+        mulch_masks = []
         ref_fp = os.path.join(ref_dir, fn)
+        if memory_budget is not None:
+            try:
+                with rasterio.open(ref_fp) as ref:
+                    big = not windowed.fits(ref.width, ref.height, _window_bytes_per_px(len(inputs)), memory_budget)
+                if big:
+                    _combine_windowed(inputs, [invert[sd] for sd in subdirs], outputs[0],
+                                      outputs[1] if mulch_folder else None, op, post_close, post_open,
+                                      morph_mode, mulch_op, memory_budget)
+                    run_state.mark_done(state, fn, inputs, outputs=outputs)
+                    continue
+            except Exception as e:
+                print(f"[skip] {ref_fp}: {e}")
+                continue
         try:
             bm_ref, prof_ref = _read_and_binarize(ref_fp)
         except Exception as e:
             print(f"[skip] {ref_fp}: {e}")
             continue
         bin_masks.append(bm_ref)
+        if mulch_folder:
+            mulch_masks.append(~bm_ref if invert[subdirs[0]] else bm_ref)
 
         for sd in subdirs[1:]:
             fp = os.path.join(image_folder, sd, fn)
@@ -98,45 +198,45 @@ def find_overlapping_masks(image_folder, output_folder,
                 continue
             try:
                 bm, prof = _read_and_binarize(fp)
-                bm = _reproject_to_ref(bm, prof, prof_ref)
-                bin_masks.append(bm)
+                if mulch_folder:
+                    # invert before aligning, as the mulch script does
+                    mulch_masks.append(_reproject_to_ref(~bm if invert[sd] else bm, prof, prof_ref))
+                bin_masks.append(_reproject_to_ref(bm, prof, prof_ref))
             except Exception as e:
                 print(f"[skip] {fp}: {e}")
 
         if not bin_masks:
             continue
 
-        stack = np.stack(bin_masks, axis=0)
-
-        if op.upper() == "AND":
-            combined = np.all(stack, axis=0)
-        elif op.upper() == "OR":
-            combined = np.any(stack, axis=0)
-        else:
-            raise ValueError("op must be one of: AND, OR")
-
-        smoothed_u8 = _postprocess_morph(combined, k_close=post_close, k_open=post_open)
+        combined = _combine(bin_masks, op)
+        with tracing.span("close_open", plot=fn, pixels=int(combined.size)):
+            smoothed_u8 = _postprocess_morph(combined, k_close=post_close, k_open=post_open,
+                                             mode=morph_mode)
+        if not _write_u8(outputs[0], smoothed_u8, prof_ref):
+            continue
 
-        out_fp = os.path.join(output_folder, fn)
-        try:
-            prof = prof_ref.copy()
-            prof.update(count=1, dtype="uint8", nodata=0, compress="LZW")
-            with rasterio.open(out_fp, "w", **prof) as dst:
-                dst.write(smoothed_u8, 1)
-        except Exception as e:
-            print(f"[write] {out_fp}: {e}")
+        if mulch_folder:
+            mulch_u8 = _combine(mulch_masks, mulch_op).astype(np.uint8) * 255
+            if not _write_u8(outputs[1], mulch_u8, prof_ref):
+                continue
+        run_state.mark_done(state, fn, inputs, outputs=outputs)
+    run_state.save(state)
 
-    print(f"[OK] Combined masks → {output_folder}")
+    print(f"[OK] Combined masks ({run_state.recomputed(state)} of {len(common_files)} rewritten) → {output_folder}")
+    if mulch_folder:
+        print(f"[OK] Mulch masks → {mulch_folder}")
 
-def find_overlapping_masks_for_batch(batch_folder, **kwargs):
-    for folder in os.listdir(batch_folder):
+def find_overlapping_masks_for_batch(batch_folder, with_mulch=False,
+                                     mulch_subdir="masks_overlapping_mulch", **kwargs):
+    cat = catalog.load(batch_folder)
+    for folder in catalog.subdirs(cat):
         root = os.path.join(batch_folder, folder)
-        if not os.path.isdir(root):
-            continue
-        image_folder = os.path.join(root, "masks")
-        if os.path.isdir(image_folder):
+        if "masks" in catalog.subdirs(cat, root):
+            image_folder = os.path.join(root, "masks")
             output_folder = os.path.join(root, "masks_overlapping")
-            find_overlapping_masks(image_folder, output_folder, **kwargs)
+            mulch_folder = os.path.join(root, mulch_subdir) if with_mulch else None
+            find_overlapping_masks(image_folder, output_folder,
+                                   mulch_folder=mulch_folder, cat=cat, **kwargs)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Combine GeoTIFF masks (AND/OR) with CRS preserved.")
@@ -146,18 +246,51 @@ if __name__ == "__main__":
     parser.add_argument("--op", type=str, default="AND", choices=["AND", "OR"])
     parser.add_argument("--post-close", type=int, default=15)
     parser.add_argument("--post-open", type=int, default=2)
+    parser.add_argument("--morph-mode", type=str, default="exact", choices=["exact", "approx"],
+                        help="exact = same pixels as cv2 ellipse; approx = faster octagon kernel.")
+    # joint vegetation + mulch run (replaces a separate 6_masks_overlapping_batch_mulch.py pass)
+    parser.add_argument("--with-mulch", action="store_true",
+                        help="Batch: also write mulch masks from the same reads.")
+    parser.add_argument("--mulch-opath", type=str,
+                        help="Single run: also write mulch masks to this folder.")
+    parser.add_argument("--mulch-subdir", type=str, default="masks_overlapping_mulch")
+    parser.add_argument("--mulch-op", type=str, default="AND", choices=["AND", "OR"])
+    parser.add_argument("--invert-prefix", type=str, default="ndvi,osavi",
+                        help="Comma-separated subfolder prefixes to invert for mulch.")
+    parser.add_argument("--force", action="store_true",
+                        help="Rewrite every mask, ignoring <masks folder>/.run_state.")
+    parser.add_argument("--memory-budget", type=str, default=None,
+                        help="Process masks larger than this (e.g. 2GB) window by window.")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
 
     args = parser.parse_args()
+    tracing.start(args.trace)
+    memory_budget = windowed.parse_budget(args.memory_budget)
+    invert_prefixes = [s.strip() for s in args.invert_prefix.split(",") if s.strip()]
 
     if args.batchpath:
         find_overlapping_masks_for_batch(args.batchpath,
+                                         with_mulch=args.with_mulch,
+                                         mulch_subdir=args.mulch_subdir,
                                          op=args.op,
                                          post_close=args.post_close,
-                                         post_open=args.post_open)
+                                         post_open=args.post_open,
+                                         morph_mode=args.morph_mode,
+                                         mulch_op=args.mulch_op,
+                                         invert_prefixes=invert_prefixes,
+                                         force=args.force,
+                                         memory_budget=memory_budget)
     else:
         if not args.ipath or not args.opath:
             raise SystemExit("Provide --ipath and --opath for single run (or use --batchpath).")
         find_overlapping_masks(args.ipath, args.opath,
                                op=args.op,
                                post_close=args.post_close,
-                               post_open=args.post_open)
+                               post_open=args.post_open,
+                               morph_mode=args.morph_mode,
+                               mulch_folder=args.mulch_opath,
+                               mulch_op=args.mulch_op,
+                               invert_prefixes=invert_prefixes,
+                               force=args.force,
+                               memory_budget=memory_budget)
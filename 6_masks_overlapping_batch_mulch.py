@@ -19,73 +19,125 @@
 
 import os
 import argparse
+from contextlib import ExitStack
 import numpy as np
 import rasterio
-from rasterio.warp import reproject, Resampling
+from reproject_plan import reproject_nearest
+import catalog
+import run_state
+import raster_profile
+import tracing
+import windowed
 
-def _list_mask_dirs(root):
-    return [d for d in os.listdir(root)
-            if os.path.isdir(os.path.join(root, d)) and not d.startswith(".")]
+def _list_mask_dirs(root, cat):
+    return catalog.subdirs(cat, root)   # hidden folders are not catalogued
 
-def _list_common_filenames(root, subdirs, exts=(".tif", ".tiff")):
+def _list_common_filenames(root, subdirs, cat, exts=(".tif", ".tiff")):
     sets = []
     for sd in subdirs:
         p = os.path.join(root, sd)
-        names = set(fn for fn in os.listdir(p) if fn.lower().endswith(exts))
+        names = set(fn for fn in catalog.listdir(cat, p) if fn.lower().endswith(exts))
         sets.append(names)
     return sorted(list(set.intersection(*sets))) if sets else []
 
+def _band1_bool(arr, nodata):
+    arr = np.ma.masked_where(arr.mask | (arr == -9999) | ((nodata is not None) & (arr == nodata)), arr)
+    out = np.zeros(arr.shape, dtype=bool)
+    valid = ~arr.mask
+    out[valid & (arr > 0)] = True
+    return out
+
 def _read_band1_bool(fp):
     with rasterio.open(fp) as src:
-        arr = src.read(1, masked=True)
-        nodata = src.nodata
-        arr = np.ma.masked_where(arr.mask | (arr == -9999) | ((nodata is not None) & (arr == nodata)), arr)
-        out = np.zeros(arr.shape, dtype=bool)
-        valid = ~arr.mask
-        out[valid & (arr > 0)] = True
-        return out, src.profile
+        return _band1_bool(src.read(1, masked=True), src.nodata), src.profile
 
 def _reproject_bool_to_ref(mask_bool, src_profile, ref_profile):
-    if (src_profile["crs"] == ref_profile["crs"] and
-        src_profile["transform"] == ref_profile["transform"] and
-        src_profile["width"] == ref_profile["width"] and
-        src_profile["height"] == ref_profile["height"]):
-        return mask_bool
-    dst = np.zeros((ref_profile["height"], ref_profile["width"]), dtype=np.uint8)
-    reproject(
-        source=mask_bool.astype(np.uint8),
-        destination=dst,
-        src_transform=src_profile["transform"],
-        src_crs=src_profile["crs"],
-        dst_transform=ref_profile["transform"],
-        dst_crs=ref_profile["crs"],
-        resampling=Resampling.nearest,
-        src_nodata=0,
-        dst_nodata=0,
-    )
-    return dst.astype(bool)
+    # nearest-neighbour gather through a cached per-grid-pair plan
+    return reproject_nearest(mask_bool, src_profile, ref_profile, fill=False)
 
 def _should_invert(subdir_name, invert_prefixes):
     s = subdir_name.lower()
     return any(s.startswith(p.lower()) for p in invert_prefixes)
 
+def _u8_profile(prof_ref):
+    return raster_profile.output_profile(prof_ref, "mask", count=1, dtype="uint8", nodata=0)
+
+def _window_bytes_per_px(n_sources):
+    # per source: values, nodata mask, bool mask; stack; plan building
+    return windowed.PLAN_BYTES_PER_PX + 6 * n_sources + 2
+
+@tracing.traced()
+def _combine_windowed(paths, invert_flags, out_fp, op, budget):
+    """One plot whose reference mask (paths[0]) is larger than `budget`, window by window."""
+    if op.upper() not in ("AND", "OR"):
+        raise ValueError("op must be AND or OR")
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(p)) for p in paths]
+        ref = srcs[0]
+        prof_ref = ref.profile
+        dst = stack.enter_context(rasterio.open(out_fp, "w", **_u8_profile(prof_ref)))
+        block = windowed.common_block(ref.block_shapes[0], dst.block_shapes[0])
+        for core, _ in windowed.windows(ref.width, ref.height, block,
+                                        _window_bytes_per_px(len(srcs)), budget):
+            combined = None
+            for src, inv in zip(srcs, invert_flags):
+                def to_bool(arr, nodata=src.nodata, inv=inv):
+                    bm = _band1_bool(arr, nodata)
+                    return ~bm if inv else bm
+                bm = windowed.read_on_grid(src, prof_ref, core, to_bool, fill=False)
+                if combined is None:
+                    combined = bm
+                elif op.upper() == "AND":
+                    combined &= bm
+                else:
+                    combined |= bm
+            dst.write(combined.astype(np.uint8) * 255, 1, window=core)
+        raster_profile.add_overviews(dst, "nearest")
+
+@tracing.traced()
 def combine_mulch_masks(image_folder, output_folder, op="AND",
-                        invert_prefixes=("ndvi", "osavi")):
+                        invert_prefixes=("ndvi", "osavi"), cat=None, force=False, memory_budget=None):
+    """
+    Plots whose source masks and options are unchanged and whose output is
+    the one this step last wrote are skipped (<image_folder>/.run_state; `force` rewrites all).
+    Plots larger than `memory_budget` (bytes) are processed window by window.
+    """
     os.makedirs(output_folder, exist_ok=True)
-    subdirs = _list_mask_dirs(image_folder)
+    cat = cat or catalog.for_folder(image_folder)
+    subdirs = _list_mask_dirs(image_folder, cat)
     if not subdirs:
         print(f"[WARN] No mask subfolders in {image_folder}")
         return
 
     ref_dir = os.path.join(image_folder, subdirs[0])
-    common_files = _list_common_filenames(image_folder, subdirs)
+    common_files = _list_common_filenames(image_folder, subdirs, cat)
     if not common_files:
         print(f"[WARN] No common filenames across: {subdirs}")
         return
 
+    state = run_state.open_state(image_folder, "6_masks_overlapping_mulch",
+                                 {"subdirs": subdirs, "op": op, "invert_prefixes": list(invert_prefixes),
+                                  "output_folder": os.path.abspath(output_folder)}, force=force)
+
     for fn in common_files:
+        inputs = [os.path.join(image_folder, sd, fn) for sd in subdirs]
+        outputs = [os.path.join(output_folder, fn)]
+        if run_state.is_fresh(state, fn, inputs, outputs):
+            continue
         bool_masks = []
         ref_fp = os.path.join(ref_dir, fn)
+        if memory_budget is not None:
+            try:
+                with rasterio.open(ref_fp) as ref:
+                    big = not windowed.fits(ref.width, ref.height, _window_bytes_per_px(len(inputs)), memory_budget)
+                if big:
+                    _combine_windowed(inputs, [_should_invert(sd, invert_prefixes) for sd in subdirs],
+                                      outputs[0], op, memory_budget)
+                    run_state.mark_done(state, fn, inputs, outputs=outputs)
+                    continue
+            except Exception as e:
+                print(f"[skip] {ref_fp}: {e}")
+                continue
         try:
             bm_ref, prof_ref = _read_band1_bool(ref_fp)
         except Exception as e:
@@ -122,28 +174,29 @@ def combine_mulch_masks(image_folder, output_folder, op="AND",
 
         out_u8 = (combined.astype(np.uint8) * 255)
 
-        out_fp = os.path.join(output_folder, fn)
+        out_fp = outputs[0]
         try:
-            prof = prof_ref.copy()
-            prof.update(count=1, dtype="uint8", nodata=0, compress="LZW")
-            with rasterio.open(out_fp, "w", **prof) as dst:
+            with rasterio.open(out_fp, "w", **_u8_profile(prof_ref)) as dst:
                 dst.write(out_u8, 1)
+                raster_profile.add_overviews(dst, "nearest")
         except Exception as e:
             print(f"[write] {out_fp}: {e}")
+            continue
+        run_state.mark_done(state, fn, inputs, outputs=outputs)
+    run_state.save(state)
 
-    print(f"[OK] Mulch masks → {output_folder}")
+    print(f"[OK] Mulch masks ({run_state.recomputed(state)} of {len(common_files)} rewritten) → {output_folder}")
 
 def combine_mulch_masks_batch(batch_folder, subdir_in="masks",
                               subdir_out="masks_overlapping_mulch",
                               **kwargs):
-    for folder in os.listdir(batch_folder):
+    cat = catalog.load(batch_folder)
+    for folder in catalog.subdirs(cat):
         root = os.path.join(batch_folder, folder)
-        if not os.path.isdir(root):
-            continue
-        image_folder = os.path.join(root, subdir_in)
-        if os.path.isdir(image_folder):
+        if subdir_in in catalog.subdirs(cat, root):
+            image_folder = os.path.join(root, subdir_in)
             output_folder = os.path.join(root, subdir_out)
-            combine_mulch_masks(image_folder, output_folder, **kwargs)
+            combine_mulch_masks(image_folder, output_folder, cat=cat, **kwargs)
 
 def main():
     ap = argparse.ArgumentParser(description="Combine per-source mulch masks into georeferenced GeoTIFF (AND/OR).")
@@ -155,7 +208,15 @@ def main():
                     help="Comma-separated subfolder prefixes to invert for mulch.")
     ap.add_argument("--subdir-in", type=str, default="masks")
     ap.add_argument("--subdir-out", type=str, default="masks_overlapping_mulch")
+    ap.add_argument("--force", action="store_true",
+                    help="Rewrite every mask, ignoring <masks folder>/.run_state.")
+    ap.add_argument("--memory-budget", type=str, default=None,
+                    help="Process masks larger than this (e.g. 2GB) window by window.")
+    ap.add_argument("--trace", type=str, default=None,
+                    help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
     args = ap.parse_args()
+    tracing.start(args.trace)
+    memory_budget = windowed.parse_budget(args.memory_budget)
 
     invert_prefixes = [s.strip() for s in args.invert_prefix.split(",") if s.strip()]
 
@@ -166,6 +227,8 @@ def main():
             subdir_out=args.subdir_out,
             op=args.op,
             invert_prefixes=invert_prefixes,
+            force=args.force,
+            memory_budget=memory_budget,
         )
     else:
         if not args.ipath or not args.opath:
@@ -175,6 +238,8 @@ def main():
             args.opath,
             op=args.op,
             invert_prefixes=invert_prefixes,
+            force=args.force,
+            memory_budget=memory_budget,
         )
 
 if __name__ == "__main__":
@@ -18,100 +18,100 @@ Usage examples:
 
   # Different mask subfolder name
   python 7_mulch_height_extract.py --batchpath C:\...\root --mask-subdir masks_overlapping_mulch
+
+Results go to the trait store (<root>/trait_store/mulch_height, see trait_store.py);
+add --excel to also write the legacy <root>/mulch_height/<date>.xlsx.
 """
 
 import os
-import cv2
-import numpy as np
 import pandas as pd
 import argparse
 import fnmatch
-
-def process_image(dem_image_path, final_mask_path, output_dict):
+from dem_traits import read_chip, mulch_baseline, BASELINE_COL
+import trait_store
+import catalog
+import run_state
+import tracing
+import prefetch
+
+@tracing.traced()
+def process_image(dem_image_path, final_mask_path, output_dict, approx=False, chips=None):
     # Date derived from parent name: <date>_...
     date_component = os.path.basename(os.path.dirname(os.path.dirname(dem_image_path))).split('_')[0]
 
-    imarray_dem = cv2.imread(dem_image_path, cv2.IMREAD_UNCHANGED)
-    imarray_mask = cv2.imread(final_mask_path, cv2.IMREAD_UNCHANGED)
+    # (DEM, mask) already decoded by the prefetcher, else read here
+    imarray_dem, imarray_mask = chips or (read_chip(dem_image_path), read_chip(final_mask_path))
 
     if imarray_dem is None or imarray_mask is None:
         print(f"[WARN] Missing DEM or mask for {dem_image_path} (mask at {final_mask_path}). Skipping.")
-        return
+        return None
 
-    # Convert DEM nodata to NaN
-    imarray_dem = imarray_dem.astype(np.float32, copy=False)
-    imarray_dem[imarray_dem == -9999] = np.nan
-
-    # Align shapes if needed
-    if imarray_dem.shape != imarray_mask.shape:
-        min_rows = min(imarray_dem.shape[0], imarray_mask.shape[0])
-        min_cols = min(imarray_dem.shape[1], imarray_mask.shape[1])
-        imarray_dem = imarray_dem[:min_rows, :min_cols]
-        imarray_mask = imarray_mask[:min_rows, :min_cols]
-
-    # Ensure mask is uint8 for OpenCV
-    if imarray_mask.dtype != np.uint8:
-        imarray_mask = imarray_mask.astype(np.uint8, copy=False)
-
-    # Apply mask
-    masked_dem = cv2.bitwise_and(imarray_dem, imarray_dem, mask=imarray_mask)
-    # Pixels unselected by mask become 0; set to NaN explicitly
-    masked_dem[masked_dem == 0] = np.nan
-
-    # Use central 90% ROI (5–95% in both axes)
-    h, w = masked_dem.shape[:2]
-    r0, r1 = int(h * 0.05), int(h * 0.95)
-    c0, c1 = int(w * 0.05), int(w * 0.95)
-    roi = masked_dem[r0:r1, c0:c1]
-
-    # Flatten and compute mid-40% mean (robust to tails)
-    flat = roi.reshape(-1)
-    valid = flat[~np.isnan(flat)]
-    if valid.size == 0:
-        avg_val = np.nan
-    else:
-        valid.sort()
-        lo = int(0.30 * valid.size)
-        hi = int(0.70 * valid.size)
-        mid = valid[lo:hi]
-        avg_val = float(np.nanmean(mid)) if mid.size else np.nan
+    # Mid-40% mean (30–70% ranks) of masked mulch elevations in the central 90% ROI
+    avg_val = mulch_baseline(imarray_dem, imarray_mask, approx=approx)
 
     # Collect row
     dem_data = {
         'Date': date_component,
         'Image ID': os.path.basename(dem_image_path),
-        'Average Height (5%-95%)': avg_val
+        BASELINE_COL: avg_val
     }
     output_dict.setdefault(dem_data['Date'], []).append(dem_data)
+    return dem_data
 
-def trait_extract_dem(input_folder, mask_subdir="masks_overlapping_mulch"):
+@tracing.traced()
+def trait_extract_dem(input_folder, mask_subdir="masks_overlapping_mulch", approx=False, excel=False, cat=None,
+                      force=False, prefetch_depth=prefetch.DEFAULT_DEPTH):
     # Results go next to the input folder
-    output_folder = os.path.join(os.path.dirname(input_folder), "mulch_height")
-    os.makedirs(output_folder, exist_ok=True)
+    base = os.path.dirname(input_folder)
+    cat = cat or catalog.for_folder(input_folder)
+    # plots whose DEM chip and mask are unchanged reuse their recorded row (--force: recompute all)
+    state = run_state.open_state(input_folder, "7_mulch_height",
+                                 {"mask_subdir": mask_subdir, "approx": approx}, force=force)
 
     output_data = {}
-    found_any = False
+    jobs = []   # (image name, inputs, fresh) in walk order
 
-    for root, _, files in os.walk(input_folder):
+    for root, _, files in catalog.walk(cat, input_folder):
         if os.path.basename(root).endswith('dem_by_plot'):
             for file in files:
                 if file.lower().endswith('.tif'):
-                    found_any = True
                     dem_image_path = os.path.join(root, file)
                     image_name = os.path.basename(dem_image_path)
                     final_mask_path = os.path.join(input_folder, mask_subdir, image_name)
-                    process_image(dem_image_path, final_mask_path, output_data)
-
-    if not found_any:
+                    inputs = (dem_image_path, final_mask_path)
+                    jobs.append((image_name, inputs, run_state.is_fresh(state, image_name, inputs)))
+
+    # the next plots' chips are read while one is reduced
+    def load(job):
+        return None if job[2] else (read_chip(job[1][0]), read_chip(job[1][1]))
+
+    for (image_name, inputs, fresh), chips in prefetch.prefetched(jobs, load, depth=prefetch_depth):
+        if fresh:
+            row = run_state.result(state, image_name)
+            output_data.setdefault(row['Date'], []).append(row)
+            continue
+        row = process_image(*inputs, output_data, approx=approx, chips=chips)
+        if row is not None:
+            run_state.mark_done(state, image_name, inputs, row)
+
+    if not jobs:
         print(f"[WARN] No .tif under {input_folder}\\**\\dem_by_plot — nothing to do.")
         return
+    if run_state.save(state) and all(d in trait_store.list_dates(base, 'mulch_height') for d in output_data):
+        print(f"[OK] Up to date: {input_folder}")
+        return
 
-    # Write one Excel per date
+    # One trait-store partition (and optionally one Excel) per date
     for date, data_list in output_data.items():
         df = pd.DataFrame(data_list)
-        out_xlsx = os.path.join(output_folder, f"{date}.xlsx")
-        df.to_excel(out_xlsx, index=False)
-        print(f"[OK] Saved mulch height → {out_xlsx}")
+        print(f"[OK] Saved mulch height → {trait_store.write_traits(base, 'mulch_height', date, df)}")
+        if excel:
+            output_folder = os.path.join(base, "mulch_height")
+            os.makedirs(output_folder, exist_ok=True)
+            out_xlsx = os.path.join(output_folder, f"{date}.xlsx")
+            with tracing.span("to_excel", path=out_xlsx, rows=len(df)):
+                df.to_excel(out_xlsx, index=False)
+            print(f"[OK] Saved mulch height → {out_xlsx}")
 
 def _normalize_patterns(pattern_str):
     """
@@ -133,14 +133,17 @@ def _matches_any(name, patterns):
     n = name.lower()
     return any(fnmatch.fnmatch(n, pat) for pat in patterns)
 
-def trait_extract_dem_batch(batch_folder, folder_pattern="*AS_S2*", mask_subdir="masks_overlapping_mulch"):
+def trait_extract_dem_batch(batch_folder, folder_pattern="*AS_S2*", mask_subdir="masks_overlapping_mulch",
+                            approx=False, excel=False, force=False, prefetch_depth=prefetch.DEFAULT_DEPTH):
     patterns = _normalize_patterns(folder_pattern)
+    cat = catalog.load(batch_folder)
     processed = 0
-    for folder in os.listdir(batch_folder):
+    for folder in catalog.subdirs(cat):
         input_folder = os.path.join(batch_folder, folder)
-        if os.path.isdir(input_folder) and _matches_any(folder, patterns):
+        if _matches_any(folder, patterns):
             print(f"[INFO] Processing: {input_folder}")
-            trait_extract_dem(input_folder, mask_subdir=mask_subdir)
+            trait_extract_dem(input_folder, mask_subdir=mask_subdir, approx=approx, excel=excel, cat=cat,
+                              force=force, prefetch_depth=prefetch_depth)
             processed += 1
     if processed == 0:
         print(f"[WARN] No subfolders matched pattern(s): {patterns} under {batch_folder}")
@@ -153,12 +156,26 @@ if __name__ == "__main__":
                         help="Glob pattern(s) for batch subfolders. Example: '*_Swb_Cl*' or multiple: '*_Swb_Cl*,*AS_S2*'.")
     parser.add_argument("--mask-subdir", type=str, default="masks_overlapping_mulch",
                         help="Name of mask subfolder (default='masks_overlapping_mulch').")
+    parser.add_argument("--approx-stats", action="store_true",
+                        help="Histogram-based percentile means (faster, within one bin width).")
+    parser.add_argument("--excel", action="store_true",
+                        help="Also write mulch_height/<date>.xlsx next to the trait store.")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute every plot, ignoring <date folder>/.run_state.")
+    parser.add_argument("--prefetch", type=int, default=prefetch.DEFAULT_DEPTH,
+                        help="Plots whose chips are read ahead on background threads (0 = read inline).")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
 
     args = parser.parse_args()
+    tracing.start(args.trace)
 
     if args.batchpath:
-        trait_extract_dem_batch(args.batchpath, folder_pattern=args.folder_pattern, mask_subdir=args.mask_subdir)
+        trait_extract_dem_batch(args.batchpath, folder_pattern=args.folder_pattern, mask_subdir=args.mask_subdir,
+                                approx=args.approx_stats, excel=args.excel, force=args.force,
+                                prefetch_depth=args.prefetch)
     elif args.ipath:
-        trait_extract_dem(args.ipath, mask_subdir=args.mask_subdir)
+        trait_extract_dem(args.ipath, mask_subdir=args.mask_subdir, approx=args.approx_stats, excel=args.excel,
+                          force=args.force, prefetch_depth=args.prefetch)
     else:
         raise SystemExit("Provide either --ipath or --batchpath")
@@ -1,9 +1,14 @@
 import os
-import cv2
 import numpy as np
 import pandas as pd
 import argparse
 import fnmatch
+from dem_traits import read_chip, mulch_baseline, canopy_stats, canopy_traits, load_baseline_map, BASELINE_COL
+import trait_store
+import catalog
+import run_state
+import tracing
+import prefetch
 
 # ---------- helpers ----------
 def _normalize_patterns(pattern_str):
@@ -22,173 +27,205 @@ def _matches_any(name, patterns):
     n = name.lower()
     return any(fnmatch.fnmatch(n, pat) for pat in patterns)
 
-def _safe_get_ref_height(reference_df, image_id):
-    if reference_df is None:
-        return np.nan
-    s = reference_df.loc[reference_df['Image ID'] == image_id, 'Average Height (5%-95%)']
-    return float(s.values[0]) if not s.empty else np.nan
+def load_gsd_map(gsd_file):
+    """date (filename column, as str) -> GSD (mm/pix) from gsd_4_all.xlsx."""
+    if not os.path.exists(gsd_file):
+        print(f"[WARN] GSD file not found: {gsd_file}")
+        return {}
+    try:
+        with tracing.span("pd.read_excel", path=gsd_file):
+            gsd_df = pd.read_excel(gsd_file)
+    except Exception as e:
+        print(f"[WARN] Could not read GSD file: {gsd_file} ({e})")
+        return {}
+    return dict(zip(gsd_df['filename'].astype(str), gsd_df['GSD(mm/pix)'].astype(float)))
 
-def _safe_get_gsd_mm(gsd_df, date_component):
-    if gsd_df is None:
+def _px_area_m2(gsd_map, date_component):
+    gsd_mm = gsd_map.get(str(date_component), np.nan)
+    if np.isnan(gsd_mm):
+        print(f"[WARN] No GSD for date {date_component} in gsd_4_all.xlsx")
         return np.nan
-    s = gsd_df.loc[gsd_df['filename'].astype(str) == str(date_component), 'GSD(mm/pix)']
-    return float(s.values[0]) if not s.empty else np.nan
+    return (gsd_mm / 1000.0) ** 2  # (m/pix)^2
+
+def _stats_row(date_component, image_id, stats):
+    coverage_px, avg_top5, volume = stats if stats is not None else (np.nan, np.nan, np.nan)
+    return {'Date': date_component, 'Image ID': image_id,
+            '_px': coverage_px, '_top5': avg_top5, '_sum': volume}
 
 # ---------- core ----------
-def process_image(dem_image_path, final_mask_path, date_component,
-                  reference_df, gsd_df, output_dict):
+@tracing.traced()
+def process_image(dem_image_path, final_mask_path, date_component, output_dict, approx=False, chips=None):
+    """
+    Per-plot canopy stats; traits are applied per date in `_trait_table`.
+    `chips` is the (DEM, mask) pair already decoded by the prefetcher.
+    """
     image_id = os.path.basename(dem_image_path)
 
     # read rasters
-    im_dem = cv2.imread(dem_image_path, cv2.IMREAD_UNCHANGED)
-    im_mask = cv2.imread(final_mask_path, cv2.IMREAD_UNCHANGED)
+    im_dem, im_mask = chips or (read_chip(dem_image_path), read_chip(final_mask_path))
 
     if im_dem is None or im_mask is None:
         print(f"[WARN] Missing DEM or mask → DEM:{dem_image_path} MASK:{final_mask_path}")
-        return
+        return None
 
-    # DEM to float + nodata to NaN
-    im_dem = im_dem.astype(np.float32, copy=False)
-    im_dem[im_dem == -9999] = np.nan
-
-    # ensure mask is single-channel uint8 (0/255)
-    if im_mask.ndim == 3:
-        im_mask = im_mask[:, :, 0]
-    if im_mask.dtype != np.uint8:
-        im_mask = im_mask.astype(np.uint8, copy=False)
-
-    # align shapes conservatively
-    if im_dem.shape != im_mask.shape:
-        h = min(im_dem.shape[0], im_mask.shape[0])
-        w = min(im_dem.shape[1], im_mask.shape[1])
-        im_dem = im_dem[:h, :w]
-        im_mask = im_mask[:h, :w]
-
-    # apply mask
-    masked = cv2.bitwise_and(im_dem, im_dem, mask=im_mask)
-    masked = np.where(im_mask > 0, im_dem, np.nan)
-
-    vals = masked.reshape(-1)
-    vals = vals[~np.isnan(vals)]
-    if vals.size == 0:
-        row = {
-            'Date': date_component,
-            'Image ID': image_id,
-            'Canopy Coverage pixel': np.nan,
-            'Canopy Coverage (m^2)': np.nan,
-            'Relative Average Height (Top 5%) (cm)': np.nan,
-            'Relative Volume (m^3)': np.nan,
-        }
-        output_dict.setdefault(date_component, []).append(row)
-        return
+    row = _stats_row(date_component, image_id, canopy_stats(im_dem, im_mask, approx=approx))
+    output_dict.setdefault(date_component, []).append(row)
+    return row
 
-    # stats
-    n = vals.size
-    k = max(1, int(0.05 * n))
-    top5 = np.partition(vals, n - k)[n - k:]
-    avg_top5 = float(np.nanmean(top5))
-    volume = float(np.nansum(vals))
-    coverage_px = int(n)
+@tracing.traced()
+def process_image_joint(dem_image_path, veg_mask_path, mulch_mask_path, date_component,
+                        output_dict, approx=False, chips=None):
+    """
+    One DEM decode serving both the mulch baseline (step 7 logic) and the
+    canopy traits relative to it; no reference spreadsheet round trip.
+    `chips` is the (DEM, veg mask, mulch mask) triple already decoded by the prefetcher.
+    """
+    image_id = os.path.basename(dem_image_path)
 
-    # GSD (mm/pix) → cm^2/pix
-    gsd_mm = _safe_get_gsd_mm(gsd_df, date_component)
-    if np.isnan(gsd_mm):
-        px_m2 = np.nan
-        print(f"[WARN] No GSD for date {date_component} in gsd_4_all.xlsx")
+    im_dem, im_veg, im_mulch = chips or (read_chip(dem_image_path), read_chip(veg_mask_path),
+                                         read_chip(mulch_mask_path))
+
+    if im_dem is None or im_veg is None:
+        print(f"[WARN] Missing DEM or mask → DEM:{dem_image_path} MASK:{veg_mask_path}")
+        return None
+
+    if im_mulch is None:
+        print(f"[WARN] Missing mulch mask → {mulch_mask_path}")
+        ref_h = np.nan
     else:
-        px_m2 = (gsd_mm / 1000.0) ** 2  # (m/pix)^2
-
-    coverage_m2 = coverage_px * px_m2
-
-    # reference mulch baseline
-    ref_h = _safe_get_ref_height(reference_df, image_id)
-    if np.isnan(ref_h):
-        print(f"[WARN] No reference mulch height for Image ID '{image_id}'")
-    rel_avg_cm = (avg_top5 - ref_h) * 100.0 if not np.isnan(ref_h) else np.nan
-    rel_vol_m3 = ((volume - coverage_px * ref_h) * px_m2) \
-              if not (np.isnan(ref_h) or np.isnan(px_m2)) else np.nan
-
-    row = {
-        'Date': date_component,
-        'Image ID': image_id,
-        'Canopy Coverage pixel': coverage_px,
-        'Canopy Coverage (m^2)': coverage_m2,
-        'Relative Average Height (Top 5%) (cm)': rel_avg_cm,
-        'Relative Volume (m^3)': rel_vol_m3,
-    }
+        ref_h = mulch_baseline(im_dem, im_mulch, approx=approx)
+
+    row = _stats_row(date_component, image_id, canopy_stats(im_dem, im_veg, approx=approx))
+    row['Mulch ' + BASELINE_COL] = ref_h
     output_dict.setdefault(date_component, []).append(row)
+    return row
+
+def _trait_table(rows, baseline_map, gsd_map, date_component):
+    """Vectorized trait columns for one date: hashed baseline / GSD lookups, no per-plot scans."""
+    df = pd.DataFrame(rows)
+    joint = 'Mulch ' + BASELINE_COL in df.columns
+    ref_h = df['Mulch ' + BASELINE_COL] if joint else df['Image ID'].map(baseline_map).astype(float)
+
+    has = df['_px'].notna()
+    missing = df.loc[has & ref_h.isna(), 'Image ID']
+    if len(missing):
+        label = "mulch baseline" if joint else "reference mulch height"
+        print(f"[WARN] No {label} for {len(missing)} Image ID(s): {', '.join(missing.head(10))}"
+              + (" ..." if len(missing) > 10 else ""))
+    px_m2 = _px_area_m2(gsd_map, date_component) if has.any() else np.nan
+
+    traits = canopy_traits(df['_px'], df['_top5'], df['_sum'], ref_h.to_numpy(), px_m2)
+    out = df.drop(columns=['_px', '_top5', '_sum'])
+    for col, vals in traits.items():
+        out[col] = vals
+    if has.all():
+        out['Canopy Coverage pixel'] = out['Canopy Coverage pixel'].astype(np.int64)
+    return out
 
+@tracing.traced()
 def trait_extract_dem(input_folder, mask_subdir="masks_overlapping",
                       reference_subdir="mulch_height",
-                      gsd_file=None):
-    # paths
-    folder_name = os.path.basename(input_folder)
-    output_folder = os.path.join(input_folder, "dem_trait")
-    os.makedirs(output_folder, exist_ok=True)
+                      gsd_file=None, approx=False, mulch_mask_subdir=None,
+                      gsd_map=None, excel=False, cat=None, force=False, prefetch_depth=prefetch.DEFAULT_DEPTH):
+    """
+    Canopy traits per plot for one date folder, written to the trait store
+    (dem_trait family; `excel` also writes <date folder>/dem_trait/<date>.xlsx).
+    With `mulch_mask_subdir` the mulch baseline is computed from the same DEM
+    decode (joint pass) instead of being looked up from step 7's output.
+    `gsd_map` (from load_gsd_map) skips re-reading gsd_4_all.xlsx in batch runs;
+    `cat` (catalog.load of the batch folder) likewise skips the directory scan.
+    Plots whose inputs are unchanged reuse their recorded stats (<date folder>/.run_state;
+    `force` recomputes all); baseline and GSD are always re-applied.
+    The chips of the next `prefetch_depth` plots are read while one is reduced.
+    """
+    base = os.path.dirname(input_folder)
 
     # reference (mulch baseline per image id)
     folder_name = os.path.basename(input_folder)
     date_component = folder_name.split("_")[0]   # e.g. "20231111" from "20231111_Swb_Cl"
-    ref_path = os.path.join(os.path.dirname(input_folder), reference_subdir, f"{date_component}.xlsx")
-
-    reference_df = None
-    if os.path.exists(ref_path):
-        try:
-            reference_df = pd.read_excel(ref_path)
-        except Exception as e:
-            print(f"[WARN] Could not read reference file: {ref_path} ({e})")
+
+    baseline_map = {}
+    if mulch_mask_subdir:
+        print(f"[INFO] Joint pass: mulch baseline from {mulch_mask_subdir}")
     else:
-        print(f"[WARN] Reference not found: {ref_path}")
+        baseline_map = load_baseline_map(base, date_component, reference_subdir)
 
     # GSD table (gsd_4_all.xlsx)
-    if gsd_file is None:
-        gsd_file = os.path.join(os.path.dirname(input_folder), "metashape_report", "gsd_4_all.xlsx")
-    gsd_df = None
-    if os.path.exists(gsd_file):
-        try:
-            gsd_df = pd.read_excel(gsd_file)
-        except Exception as e:
-            print(f"[WARN] Could not read GSD file: {gsd_file} ({e})")
-    else:
-        print(f"[WARN] GSD file not found: {gsd_file}")
+    if gsd_map is None:
+        if gsd_file is None:
+            gsd_file = os.path.join(os.path.dirname(input_folder), "metashape_report", "gsd_4_all.xlsx")
+        gsd_map = load_gsd_map(gsd_file)
 
     # iterate DEMs
+    cat = cat or catalog.for_folder(input_folder)
+    state = run_state.open_state(input_folder, "8_dem_trait",
+                                 {"mask_subdir": mask_subdir, "mulch_mask_subdir": mulch_mask_subdir,
+                                  "approx": approx}, force=force)
     output_data = {}
-    found = False
-    for root, _, files in os.walk(input_folder):
+    jobs = []   # (file, date, inputs, fresh) in walk order
+    for root, _, files in catalog.walk(cat, input_folder):
         if os.path.basename(root).endswith('dem_by_plot'):
             for file in files:
                 if file.lower().endswith('.tif'):
-                    found = True
                     dem_path = os.path.join(root, file)
                     mask_path = os.path.join(input_folder, mask_subdir, file)
                     date_component = os.path.basename(os.path.dirname(os.path.dirname(dem_path))).split('_')[0]
-                    process_image(dem_path, mask_path, date_component,
-                                  reference_df, gsd_df, output_data)
-    if not found:
+                    mulch_path = os.path.join(input_folder, mulch_mask_subdir, file) if mulch_mask_subdir else None
+                    inputs = (dem_path, mask_path) + ((mulch_path,) if mulch_path else ())
+                    jobs.append((file, date_component, inputs, run_state.is_fresh(state, file, inputs)))
+
+    def load(job):
+        return None if job[3] else tuple(read_chip(path) for path in job[2])
+
+    for (file, date_component, inputs, fresh), chips in prefetch.prefetched(jobs, load, depth=prefetch_depth):
+        if fresh:
+            output_data.setdefault(date_component, []).append(run_state.result(state, file))
+            continue
+        if mulch_mask_subdir:
+            row = process_image_joint(*inputs, date_component, output_data, approx=approx, chips=chips)
+        else:
+            row = process_image(*inputs, date_component, output_data, approx=approx, chips=chips)
+        if row is not None:
+            run_state.mark_done(state, file, inputs, row)
+    if not jobs:
         print(f"[WARN] No .tif under {input_folder}\\**\\dem_by_plot")
         return
+    run_state.save(state)
+    print(f"[INFO] {run_state.recomputed(state)} plot(s) recomputed in {input_folder}")
 
-    # write per-date xlsx
+    # one trait-store partition (and optionally one xlsx) per date
     for date, rows in output_data.items():
-        df = pd.DataFrame(rows)
-        out_xlsx = os.path.join(output_folder, f"{date}.xlsx")
-        df.to_excel(out_xlsx, index=False)
-        print(f"[OK] Saved traits → {out_xlsx}")
+        df = _trait_table(rows, baseline_map, gsd_map, date)
+        print(f"[OK] Saved traits → {trait_store.write_traits(base, 'dem_trait', date, df)}")
+        if excel:
+            output_folder = os.path.join(input_folder, "dem_trait")
+            os.makedirs(output_folder, exist_ok=True)
+            out_xlsx = os.path.join(output_folder, f"{date}.xlsx")
+            with tracing.span("to_excel", path=out_xlsx, rows=len(df)):
+                df.to_excel(out_xlsx, index=False)
+            print(f"[OK] Saved traits → {out_xlsx}")
 
 def trait_extract_dem_batch(batch_folder, folder_pattern="*AS_S2*",
                             mask_subdir="masks_overlapping",
                             reference_subdir="mulch_height",
-                            gsd_file=None):
+                            gsd_file=None, approx=False, mulch_mask_subdir=None,
+                            excel=False, force=False, prefetch_depth=prefetch.DEFAULT_DEPTH):
     patterns = _normalize_patterns(folder_pattern)
+    # one GSD table for all dates
+    if gsd_file is None:
+        gsd_file = os.path.join(batch_folder, "metashape_report", "gsd_4_all.xlsx")
+    gsd_map = load_gsd_map(gsd_file)
+    cat = catalog.load(batch_folder)
     count = 0
-    for folder in os.listdir(batch_folder):
+    for folder in catalog.subdirs(cat):
         input_folder = os.path.join(batch_folder, folder)
-        if os.path.isdir(input_folder) and _matches_any(folder, patterns):
+        if _matches_any(folder, patterns):
             print(f"[INFO] Processing {input_folder}")
             trait_extract_dem(input_folder, mask_subdir=mask_subdir,
                               reference_subdir=reference_subdir,
-                              gsd_file=gsd_file)
+                              approx=approx, mulch_mask_subdir=mulch_mask_subdir,
+                              gsd_map=gsd_map, excel=excel, cat=cat, force=force,
+                              prefetch_depth=prefetch_depth)
             count += 1
     if count == 0:
         print(f"[WARN] No subfolders matched {patterns} under {batch_folder}")
@@ -203,21 +240,44 @@ if __name__ == "__main__":
     p.add_argument("--mask-subdir", type=str, default="masks_overlapping",
                    help="Mask subfolder inside each date folder.")
     p.add_argument("--reference-subdir", type=str, default="mulch_height",
-                   help="Subfolder (next to date folder) containing mulch baseline Excel per date.")
+                   help="Legacy subfolder (next to date folder) with mulch baseline Excel per date; "
+                        "only used when the trait store has no mulch_height entry.")
     p.add_argument("--gsd-file", type=str, default=None,
                    help="Path to gsd_4_all.xlsx (default: ../metashape_report/gsd_4_all.xlsx).")
+    p.add_argument("--approx-stats", action="store_true",
+                   help="Histogram-based top-5%% mean (faster, within one bin width).")
+    p.add_argument("--joint", action="store_true",
+                   help="Compute the mulch baseline from the same DEM read (replaces running step 7 first).")
+    p.add_argument("--mulch-mask-subdir", type=str, default="masks_overlapping_mulch",
+                   help="Mulch mask subfolder used by --joint.")
+    p.add_argument("--excel", action="store_true",
+                   help="Also write <date folder>/dem_trait/<date>.xlsx next to the trait store.")
+    p.add_argument("--force", action="store_true",
+                   help="Recompute every plot, ignoring <date folder>/.run_state.")
+    p.add_argument("--prefetch", type=int, default=prefetch.DEFAULT_DEPTH,
+                   help="Plots whose chips are read ahead on background threads (0 = read inline).")
+    p.add_argument("--trace", type=str, default=None,
+                   help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
     args = p.parse_args()
+    tracing.start(args.trace)
+    mulch_mask_subdir = args.mulch_mask_subdir if args.joint else None
 
     if args.batchpath:
         trait_extract_dem_batch(args.batchpath,
                                 folder_pattern=args.folder_pattern,
                                 mask_subdir=args.mask_subdir,
                                 reference_subdir=args.reference_subdir,
-                                gsd_file=args.gsd_file)
+                                gsd_file=args.gsd_file,
+                                approx=args.approx_stats,
+                                mulch_mask_subdir=mulch_mask_subdir,
+                                excel=args.excel, force=args.force, prefetch_depth=args.prefetch)
     elif args.ipath:
         trait_extract_dem(args.ipath,
                           mask_subdir=args.mask_subdir,
                           reference_subdir=args.reference_subdir,
-                          gsd_file=args.gsd_file)
+                          gsd_file=args.gsd_file,
+                          approx=args.approx_stats,
+                          mulch_mask_subdir=mulch_mask_subdir,
+                          excel=args.excel, force=args.force, prefetch_depth=args.prefetch)
     else:
         raise SystemExit("Provide either --ipath or --batchpath")
@@ -12,6 +12,12 @@ import pandas as pd
 import argparse
 import fnmatch
 from skimage import io as skio
+from robust_stats import nan_mean_std_rows
+import trait_store
+import catalog
+import run_state
+import tracing
+import prefetch
 
 def _to_gray_float(arr):
     """Return single-channel float32 image (avg RGB if multi-band)."""
@@ -23,85 +29,154 @@ def _to_gray_float(arr):
         return arr.astype(np.float32).mean(axis=-1)
     return arr[..., 0].astype(np.float32, copy=False)
 
-def _process_one(nodem_path, mask_path, index_prefix, rows):
-    # date from folder name two levels up: <date>_...
-    date_component = os.path.basename(os.path.dirname(os.path.dirname(nodem_path))).split('_')[0]
-    image_id = os.path.basename(nodem_path)
-
-    nodem = None
-    mask = None
+def _read_gray(nodem_path):
     try:
-        nodem = skio.imread(nodem_path, plugin='tifffile')
+        return _to_gray_float(skio.imread(nodem_path, plugin='tifffile'))
     except Exception as e:
         print(f"[WARN] read nodem failed: {nodem_path} ({e})")
-        return
-    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-    if mask is None:
-        print(f"[WARN] missing mask: {mask_path}")
-        return
-
-    gray = _to_gray_float(nodem)
-
-    # align shapes by cropping
-    h = min(gray.shape[0], mask.shape[0])
-    w = min(gray.shape[1], mask.shape[1])
-    gray = gray[:h, :w]
-    mask = mask[:h, :w]
-
-    # simple mask apply
-    vals = np.where(mask > 0, gray, np.nan).ravel()
-    vals = vals[~np.isnan(vals)]
-    if vals.size == 0:
-        mean_v, std_v = np.nan, np.nan
-    else:
-        mean_v = float(np.mean(vals))
-        std_v  = float(np.std(vals))
-
-    key = (date_component, image_id)
-    if key not in rows:
-        rows[key] = {'Date': date_component, 'Image ID': image_id}
-    rows[key][f'{index_prefix}_Average'] = mean_v
-    rows[key][f'{index_prefix}_StdDev'] = std_v
-
-def trait_extract_nodem(ipath, mask_subdir="masks_overlapping"):
-    out_dir = os.path.join(ipath, "nodem_trait")
-    os.makedirs(out_dir, exist_ok=True)
-
-    rows = {}  # (date, image_id) -> dict
-    found = False
-
-    for root, _, files in os.walk(ipath):
+        return None
+
+def _plot_stats(mask, grays, out):
+    """
+    Fill out[j] = (mean, std) for every (j, gray) index chip of one plot.
+    The mask is decoded once; its flat index is computed once per chip shape
+    and all chips of that shape are gathered and reduced together.
+    """
+    by_shape = {}
+    for j, gray in grays:
+        h = min(gray.shape[0], mask.shape[0])
+        w = min(gray.shape[1], mask.shape[1])
+        by_shape.setdefault((h, w), []).append((j, gray))
+    for (h, w), items in by_shape.items():
+        flat = np.flatnonzero(mask[:h, :w] > 0)
+        vals = np.stack([np.ascontiguousarray(g[:h, :w]).ravel()[flat] for _, g in items])
+        out[[j for j, _ in items]] = nan_mean_std_rows(vals)
+
+def _collect_index_dirs(ipath, cat):
+    """[(index_prefix, folder, [tif names])] for every *_by_plot folder except dem_by_plot."""
+    dirs = []
+    for root, _, files in catalog.walk(cat, ipath):
         base = os.path.basename(root)
         if base.endswith('_by_plot') and base != 'dem_by_plot':
-            index_prefix = base.split('_')[0]  # e.g., NDVI_by_plot -> NDVI
-            for fn in files:
-                if fn.lower().endswith(".tif"):
-                    found = True
-                    nodem_path = os.path.join(root, fn)
-                    mask_path  = os.path.join(ipath, mask_subdir, fn)
-                    _process_one(nodem_path, mask_path, index_prefix, rows)
-
-    if not found:
+            tifs = [fn for fn in files if fn.lower().endswith(".tif")]
+            if tifs:
+                dirs.append((base.split('_')[0], root, tifs))  # e.g., NDVI_by_plot -> NDVI
+    return dirs
+
+def _read_plot(mask_path, chips, date_component, fn):
+    """(mask, [(index column, gray chip)]) of one plot; mask None if missing, unreadable chips left out."""
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        return None, []
+    grays = []
+    with tracing.span("read_chips", date=date_component, plot=fn):
+        for j, chip_path in chips:
+            gray = _read_gray(chip_path)
+            if gray is not None:
+                grays.append((j, gray))
+    return mask, grays
+
+@tracing.traced()
+def trait_extract_nodem(ipath, mask_subdir="masks_overlapping", excel=False, cat=None, force=False,
+                        prefetch_depth=prefetch.DEFAULT_DEPTH):
+    """
+    Per-plot mean/std of every *_by_plot layer, written to the trait store
+    (nodem_trait family); `excel` also writes <ipath>/nodem_trait/<date>.xlsx.
+    `cat` (catalog.load of the batch folder) skips the directory scan.
+    Plots whose mask and chips are unchanged reuse their recorded stats
+    (<ipath>/.run_state; `force` recomputes all). The mask and chips of the
+    next `prefetch_depth` plots are read while one is reduced.
+    """
+
+    index_dirs = _collect_index_dirs(ipath, cat or catalog.for_folder(ipath))
+    if not index_dirs:
         print(f"[WARN] no VI/NoDEM TIFFs under {ipath}\\**\\*_by_plot (excluding dem_by_plot)")
         return
 
-    df = pd.DataFrame(list(rows.values()))
-    if df.empty:
+    # indices (columns) and plots (rows) in first-seen order
+    prefixes = list(dict.fromkeys(pref for pref, _, _ in index_dirs))
+    col_of = {pref: i for i, pref in enumerate(prefixes)}
+    plots = {}  # (date, image_id) -> [(index column, chip path)]
+    for pref, root, tifs in index_dirs:
+        # date from folder name two levels up: <date>_...
+        date_component = os.path.basename(os.path.dirname(root)).split('_')[0]
+        for fn in tifs:
+            plots.setdefault((date_component, fn), []).append((col_of[pref], os.path.join(root, fn)))
+
+    keys = list(plots)
+    stats = np.full((len(keys), len(prefixes), 2), np.nan)   # plots x indices x (mean, std)
+    seen = np.zeros((len(keys), len(prefixes)), dtype=bool)
+    has_mask = np.zeros(len(keys), dtype=bool)
+    state = run_state.open_state(ipath, "9_nodem_trait", {"mask_subdir": mask_subdir}, force=force)
+
+    # plot-major: one mask decode per plot, shared by all index chips
+    jobs = []
+    for i, (date_component, fn) in enumerate(keys):
+        mask_path = os.path.join(ipath, mask_subdir, fn)
+        unit = f"{date_component}/{fn}"
+        inputs = [mask_path] + [chip_path for _, chip_path in plots[(date_component, fn)]]
+        jobs.append((i, unit, inputs, run_state.is_fresh(state, unit, inputs)))
+
+    def load(job):
+        i, _, inputs, fresh = job
+        return None if fresh else _read_plot(inputs[0], plots[keys[i]], *keys[i])
+
+    for (i, unit, inputs, fresh), loaded in prefetch.prefetched(jobs, load, depth=prefetch_depth):
+        date_component, fn = keys[i]
+        if fresh:
+            has_mask[i] = True
+            for pref, mean_std in run_state.result(state, unit).items():
+                stats[i, col_of[pref]] = mean_std
+                seen[i, col_of[pref]] = True
+            continue
+        with tracing.span("plot", date=date_component, plot=fn) as sp:
+            mask, grays = loaded
+            if mask is None:
+                print(f"[WARN] missing mask: {inputs[0]}")
+                continue
+            has_mask[i] = True
+            for j, _ in grays:
+                seen[i, j] = True
+            sp.set(layers=len(grays), pixels=int(sum(g.size for _, g in grays)))
+            _plot_stats(mask, grays, stats[i])
+        run_state.mark_done(state, unit, inputs,
+                            {prefixes[j]: stats[i, j].tolist() for j in np.flatnonzero(seen[i])})
+    run_state.save(state)
+    print(f"[INFO] {run_state.recomputed(state)} plot(s) recomputed in {ipath}")
+
+    if not has_mask.any():
         print(f"[WARN] no valid rows for {ipath}")
         return
 
-    for date, g in df.groupby('Date'):
-        out_path = os.path.join(out_dir, f"{date}.xlsx")
-        g.drop(columns=['Date']).to_excel(out_path, index=False)
-        print(f"[OK] saved → {out_path}")
+    rows = np.flatnonzero(has_mask)
+    cols = [j for j in range(len(prefixes)) if seen[:, j].any()]
+    columns = {'Date': [keys[i][0] for i in rows], 'Image ID': [keys[i][1] for i in rows]}
+    for j in cols:
+        columns[f'{prefixes[j]}_Average'] = stats[rows, j, 0]
+        columns[f'{prefixes[j]}_StdDev'] = stats[rows, j, 1]
+    df = pd.DataFrame(columns)   # one block, not ~100 column inserts
 
-def trait_extract_nodem_batch(batchpath, folder_pattern="*AS_S2*", mask_subdir="masks_overlapping"):
+    base = os.path.dirname(ipath)
+    for date, g in df.groupby('Date'):
+        print(f"[OK] saved → {trait_store.write_traits(base, 'nodem_trait', date, g)}")
+        if excel:
+            out_dir = os.path.join(ipath, "nodem_trait")
+            os.makedirs(out_dir, exist_ok=True)
+            out_path = os.path.join(out_dir, f"{date}.xlsx")
+            with tracing.span("to_excel", path=out_path, rows=len(g)):
+                g.drop(columns=['Date']).to_excel(out_path, index=False)
+            print(f"[OK] saved → {out_path}")
+
+def trait_extract_nodem_batch(batchpath, folder_pattern="*AS_S2*", mask_subdir="masks_overlapping",
+                              excel=False, force=False, prefetch_depth=prefetch.DEFAULT_DEPTH):
+    cat = catalog.load(batchpath)
     processed = 0
-    for folder in os.listdir(batchpath):
+    for folder in catalog.subdirs(cat):
         ipath = os.path.join(batchpath, folder)
-        if os.path.isdir(ipath) and fnmatch.fnmatch(folder, folder_pattern):
+        if fnmatch.fnmatch(folder, folder_pattern):
             print(f"[INFO] {ipath}")
-            trait_extract_nodem(ipath, mask_subdir=mask_subdir)
+            trait_extract_nodem(ipath, mask_subdir=mask_subdir, excel=excel, cat=cat, force=force,
+                                prefetch_depth=prefetch_depth)
             processed += 1
     if processed == 0:
         print(f"[WARN] no subfolders matched '{folder_pattern}' under {batchpath}")
@@ -114,11 +189,22 @@ if __name__ == "__main__":
                    help="Glob for batch subfolders (e.g., '*_Swb_Cl*')")
     p.add_argument("--mask-subdir", type=str, default="masks_overlapping",
                    help="Mask subfolder name (default: masks_overlapping)")
+    p.add_argument("--excel", action="store_true",
+                   help="Also write <date folder>/nodem_trait/<date>.xlsx next to the trait store.")
+    p.add_argument("--force", action="store_true",
+                   help="Recompute every plot, ignoring <date folder>/.run_state.")
+    p.add_argument("--prefetch", type=int, default=prefetch.DEFAULT_DEPTH,
+                   help="Plots whose mask and chips are read ahead on background threads (0 = read inline).")
+    p.add_argument("--trace", type=str, default=None,
+                   help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
     args = p.parse_args()
+    tracing.start(args.trace)
 
     if args.batchpath:
-        trait_extract_nodem_batch(args.batchpath, folder_pattern=args.folder_pattern, mask_subdir=args.mask_subdir)
+        trait_extract_nodem_batch(args.batchpath, folder_pattern=args.folder_pattern, mask_subdir=args.mask_subdir,
+                                  excel=args.excel, force=args.force, prefetch_depth=args.prefetch)
     elif args.ipath:
-        trait_extract_nodem(args.ipath, mask_subdir=args.mask_subdir)
+        trait_extract_nodem(args.ipath, mask_subdir=args.mask_subdir, excel=args.excel, force=args.force,
+                            prefetch_depth=args.prefetch)
     else:
         raise SystemExit("Provide either --ipath or --batchpath")
@@ -1,175 +1,240 @@
 # suffix 'AS_S2'
 # python 9_trait_extract_nodem_rgb_test.py --batchpath E:\AS\low_altitude_RGB\low_altitude_RGB\veg_preview
+# python 9_trait_extract_spectral_rgb.py --ipath E:\AS\...\veg_preview\site1 --workers 8
+# python 9_trait_extract_spectral_rgb.py --ipath E:\AS\...\veg_preview\site1 --benchmark-scales 20   (then pick --decode-scale)
 import os
+import time
 import cv2
 import numpy as np
 import pandas as pd
-import skimage
-from skimage import io, img_as_float
-import imagecodecs
-import matplotlib.pyplot as plt
-from pathlib import Path
-from skimage.feature import canny
-from skimage.color import gray2rgb
 import argparse
-
-def process_image_nodem(nodem_image_path, output_data_nodem, root):
-    date_component = os.path.basename(root)
-    imarray_nodem = cv2.imread(nodem_image_path)
-    imarray_nodem = cv2.cvtColor(imarray_nodem, cv2.COLOR_BGR2RGB)
-    
-    image = imarray_nodem.astype(np.float32)
-
-    non_black_mask = np.any(image != 0, axis=-1)
-
-    # Apply the mask to set black pixels to NaN
-    image_masked = image.copy()
-    image_masked[~non_black_mask] = np.nan
-
-    R, G, B = image_masked[:, :, 0], image_masked[:, :, 1], image_masked[:, :, 2]
-
-    epsilon = 1e-6
-
-    # Compute vegetation indices @ https://www.sciencedirect.com/science/article/pii/S0168169924009566#s0080
-    indices = {
-        "Kawashima Index": (R - B) / (R + B + epsilon),
-        "Green-Red Ratio Index": R / (G + epsilon),
-        "VARI": (G - R) / (G + R - B + epsilon),  # Visible Atmospherically Resistant Index
-        "CIVE": 0.441 * R - 0.811 * G + 0.385 * B + 18.78745,  # Color Index of Vegetation Extraction
-        "NGRDI": (G - R) / (G + R + epsilon),  # Normalized Green-Red Difference Index
-        "Excess Red Vegetation Index": 1.4 * R - G,
-        "ExG-ExR": (3 * G - 2.4 * R - B),  # Excess Green minus Excess Red Index
-        "GLI": (2 * G - R - B) / (2 * G + R + B + epsilon),  # Green Leaf Index
-        "PCAI": 0.994 * np.abs(R - B) + 0.961 * np.abs(G - B) + 0.914 * np.abs(G - R),  # PCA Index
-        "MGBVI": (G**2 - R**2) / (G**2 + R**2 + epsilon),  # Modified Green-Blue Vegetation Index
-        "RGBVI": (G**2 - B * R) / (G**2 + B * R + epsilon),  # Red Green Blue Vegetation Index
-        "NDYI": (G - B) / (G + B + epsilon),  # Normalized Difference Yellowness Index
-        "CFI": G - R,  # Color Feature Index
-        "Normalized Red": R / (R + G + B + epsilon),
-        "Normalized Green": G / (R + G + B + epsilon),
-        "TCVI": (1.4 * (2 * R - 2 * B)) / (2 * R - G - 2 * B + 255 * 0.4 + epsilon),  # True Color Vegetation Index
-    }
-    
-    # # Create a nested dictionary for each image and date if it doesn't exist
-    # if (image_id, date_component) not in output_data_nodem:
-        # output_data_nodem[(image_id, date)] = {'Date': date_component, 'Image ID': image_id}
-
-    # for name, index_values in indices.items():
-        # flattened_values = index_values.flatten()
-        # valid_values = np.where((flattened_values <= -1e10) | (flattened_values >= 1e10) | (flattened_values == 0), np.nan, flattened_values)
-        # valid_values = valid_values[~np.isnan(valid_values)]
-
-        # if len(valid_values) > 0:
-            # lower_bound, upper_bound = np.percentile(valid_values, [5, 95])
-            # valid_values = valid_values[(valid_values >= lower_bound) & (valid_values <= upper_bound)]
-            # output_data_nodem[(image_id, date)][f"{name}_Avg"] = np.nanmean(valid_values)
-            # output_data_nodem[(image_id, date)][f"{name}_StdDev"] = np.nanstd(valid_values)
-        # else:
-            # output_data_nodem[(image_id, date)][f"{name}_Avg"] = np.nan
-            # output_data_nodem[(image_id, date)][f"{name}_StdDev"] = np.nan
-    
+from concurrent.futures import ProcessPoolExecutor
+from robust_stats import percentile_bounds, mean_std
+import trait_store
+import catalog
+import run_state
+import tracing
+
+EPSILON = 1e-6
+
+# libjpeg DCT-domain downscaling: decode cost drops roughly with the pixel count
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Vegetation indices @ https://www.sciencedirect.com/science/article/pii/S0168169924009566#s0080
+# Each entry maps the R, G, B vectors of the non-black pixels (float32) to one index vector;
+# they are evaluated one at a time so only one index vector is alive per worker.
+RGB_INDICES = [
+    ("Kawashima Index", lambda R, G, B: (R - B) / (R + B + EPSILON)),
+    ("Green-Red Ratio Index", lambda R, G, B: R / (G + EPSILON)),
+    ("VARI", lambda R, G, B: (G - R) / (G + R - B + EPSILON)),  # Visible Atmospherically Resistant Index
+    ("CIVE", lambda R, G, B: 0.441 * R - 0.811 * G + 0.385 * B + 18.78745),  # Color Index of Vegetation Extraction
+    ("NGRDI", lambda R, G, B: (G - R) / (G + R + EPSILON)),  # Normalized Green-Red Difference Index
+    ("Excess Red Vegetation Index", lambda R, G, B: 1.4 * R - G),
+    ("ExG-ExR", lambda R, G, B: (3 * G - 2.4 * R - B)),  # Excess Green minus Excess Red Index
+    ("GLI", lambda R, G, B: (2 * G - R - B) / (2 * G + R + B + EPSILON)),  # Green Leaf Index
+    ("PCAI", lambda R, G, B: 0.994 * np.abs(R - B) + 0.961 * np.abs(G - B) + 0.914 * np.abs(G - R)),  # PCA Index
+    ("MGBVI", lambda R, G, B: (G**2 - R**2) / (G**2 + R**2 + EPSILON)),  # Modified Green-Blue Vegetation Index
+    ("RGBVI", lambda R, G, B: (G**2 - B * R) / (G**2 + B * R + EPSILON)),  # Red Green Blue Vegetation Index
+    ("NDYI", lambda R, G, B: (G - B) / (G + B + EPSILON)),  # Normalized Difference Yellowness Index
+    ("CFI", lambda R, G, B: G - R),  # Color Feature Index
+    ("Normalized Red", lambda R, G, B: R / (R + G + B + EPSILON)),
+    ("Normalized Green", lambda R, G, B: G / (R + G + B + EPSILON)),
+    ("TCVI", lambda R, G, B: (1.4 * (2 * R - 2 * B)) / (2 * R - G - 2 * B + 255 * 0.4 + EPSILON)),  # True Color Vegetation Index
+]
+
+def _trimmed_stats(values):
+    """Mean/std of the finite, nonzero values inside their own 5-95% percentile range."""
+    valid = values[(values > -1e10) & (values < 1e10) & (values != 0)]  # also drops NaN
+    if valid.size == 0:
+        return np.nan, np.nan
+    lower_bound, upper_bound = percentile_bounds(valid, 5, 95)
+    return mean_std(valid[(valid >= lower_bound) & (valid <= upper_bound)])
+
+def _index_stats(imarray_nodem, nodem_data):
+    non_black_mask = np.any(imarray_nodem != 0, axis=-1)
+    B, G, R = (imarray_nodem[..., c][non_black_mask].astype(np.float32) for c in range(3))
+    del non_black_mask
+
+    for name, index_fn in RGB_INDICES:
+        nodem_data[f"{name}_Avg"], nodem_data[f"{name}_StdDev"] = _trimmed_stats(index_fn(R, G, B))
+    return nodem_data
+
+def process_image_nodem(nodem_image_path, date_component, decode_scale=1):
+    """
+    One row of {index}_Avg / {index}_StdDev over the non-black pixels of a JPG,
+    decoded at 1/decode_scale resolution (see --benchmark-scales for the error).
+    """
     nodem_data = {'Date': date_component, 'Image ID': os.path.basename(nodem_image_path)}
 
-    for name, index_values in indices.items():
-        flattened_values = index_values.flatten()
-        valid_values = np.where((flattened_values <= -1e10) | (flattened_values >= 1e10) | (flattened_values == 0), np.nan, flattened_values)
-        valid_values = valid_values[~np.isnan(valid_values)]
-
-        if len(valid_values) > 0:
-            lower_bound, upper_bound = np.percentile(valid_values, [5, 95])
-            valid_values = valid_values[(valid_values >= lower_bound) & (valid_values <= upper_bound)]
-            nodem_data[f"{name}_Avg"] = np.nanmean(valid_values)
-            nodem_data[f"{name}_StdDev"] = np.nanstd(valid_values)
-        else:
-            nodem_data[f"{name}_Avg"] = np.nan
-            nodem_data[f"{name}_StdDev"] = np.nan
-
-    output_data_nodem.append(nodem_data) # Append the dictionary to the list
-    
-    
-    # for name, index_values in indices.items():
-        # flattened_values = index_values.flatten()
-        # valid_values = np.where((flattened_values <= -1e10) | (flattened_values >= 1e10) | (flattened_values == 0), np.nan, flattened_values)
-        # valid_values = valid_values[~np.isnan(valid_values)]
-
-        # if len(valid_values) > 0:
-            # lower_bound, upper_bound = np.percentile(valid_values, [5, 95])
-            # valid_values = valid_values[(valid_values >= lower_bound) & (valid_values <= upper_bound)]
-            # nodem_data = {
-                # 'Date': date_component,
-                # 'Image ID': os.path.basename(nodem_image_path),
-                # f"{name}_Avg": np.nanmean(valid_values),
-                # f"{name}_StdDev": np.nanstd(valid_values)
-            # }
-        # else:
-            # nodem_data = {
-                # 'Date': date_component,
-                # 'Image ID': os.path.basename(nodem_image_path),
-                # f"{name}_Avg": np.nan,
-                # f"{name}_StdDev": np.nan
-            # }
- 
-    # output_dict_nodem.setdefault((os.path.basename(nodem_image_path), nodem_data['Date']), {}).update(nodem_data)
-
-def trait_extract_nodem(input_folder):
-    output_folder = os.path.join(os.path.dirname(os.path.dirname(input_folder)), "nodem_trait_RGB")
-    os.makedirs(output_folder, exist_ok=True)
-
-    # Create an empty dictionary to store data for each date
-    output_data_nodem = []
-
-    # Iterate through all subfolders and process images
-    for root, dirs, files in os.walk(input_folder):
-        # date_component = os.path.basename(input_folder).split('_')[0]
+    with tracing.span("cv2.imread", date=date_component, plot=nodem_data['Image ID']) as sp:
+        imarray_nodem = cv2.imread(nodem_image_path, DECODE_FLAGS[decode_scale])  # BGR uint8
+        sp.set(pixels=int(imarray_nodem.shape[0] * imarray_nodem.shape[1]) if imarray_nodem is not None else 0)
+    if imarray_nodem is None:
+        print(f"[WARN] could not read {nodem_image_path}")
+        return nodem_data
+    with tracing.span("rgb_indices", date=date_component, plot=nodem_data['Image ID'],
+                      pixels=int(imarray_nodem.shape[0] * imarray_nodem.shape[1])):
+        return _index_stats(imarray_nodem, nodem_data)
+
+def _process_image_args(args):
+    return process_image_nodem(*args)
+
+def _list_jobs(input_folder, cat=None):
+    """(JPG path, date) for every image under an 8-digit date folder."""
+    jobs = []
+    for root, dirs, files in catalog.walk(cat or catalog.for_folder(input_folder), input_folder):
         if os.path.basename(root).isdigit() and len(os.path.basename(root)) == 8:
             for file in files:
                 if file.endswith('.JPG'):
-                    nodem_image_path = os.path.join(root, file)
-                    # image_name = os.path.basename(nodem_image_path)
-                    process_image_nodem(nodem_image_path, output_data_nodem, root)
-
-    df = pd.DataFrame(output_data_nodem)
+                    jobs.append((os.path.join(root, file), os.path.basename(root)))
+    return jobs
+
+def benchmark_decode_scales(input_folder, sample=20, scales=(2, 4, 8)):
+    """
+    Decode time and per-index _Avg/_StdDev deviation of each reduced decode
+    scale against full resolution, on up to `sample` evenly spaced JPGs.
+    Writes <output>/decode_scale_report.xlsx and returns the report DataFrame.
+    """
+    jobs = _list_jobs(input_folder)
+    if not jobs:
+        print(f"[WARN] no .JPG under 8-digit date folders in {input_folder}")
+        return None
+    jobs = [jobs[i] for i in np.unique(np.linspace(0, len(jobs) - 1, min(sample, len(jobs))).astype(int))]
+
+    def run(scale):
+        rows, decode_s = [], 0.0
+        t_all = time.perf_counter()
+        for path, date in jobs:
+            t0 = time.perf_counter()
+            img = cv2.imread(path, DECODE_FLAGS[scale])
+            decode_s += time.perf_counter() - t0
+            row = {'Date': date, 'Image ID': os.path.basename(path)}
+            rows.append(_index_stats(img, row) if img is not None else row)
+        total_s = time.perf_counter() - t_all
+        return pd.DataFrame(rows).set_index(['Date', 'Image ID']), decode_s, total_s
+
+    full, full_s, full_total = run(1)
+    report = []
+    for scale in scales:
+        red, red_s, red_total = run(scale)
+        diff = (red - full).abs()
+        rel = diff / full.abs().where(full.abs() > 0)
+        for name, _ in RGB_INDICES:
+            entry = {'Scale': f"1/{scale}", 'Index': name,
+                     'Decode speedup': full_s / red_s, 'Total speedup': full_total / red_total}
+            for stat in ("Avg", "StdDev"):
+                col = f"{name}_{stat}"
+                entry[f"{stat} max abs dev"] = diff[col].max()
+                entry[f"{stat} max rel dev"] = rel[col].max()
+            # relative error is meaningless for indices averaging near 0 (VARI, CFI, ...):
+            # also express the mean shift in units of the full-resolution within-image spread
+            entry["Avg max dev / StdDev"] = (diff[f"{name}_Avg"] / full[f"{name}_StdDev"]).max()
+            report.append(entry)
+        worst = max(e["Avg max dev / StdDev"] for e in report[-len(RGB_INDICES):])
+        worst_sd = max(e["StdDev max rel dev"] for e in report[-len(RGB_INDICES):])
+        print(f"[INFO] 1/{scale}: decode {full_s / red_s:.1f}x, decode+indices {full_total / red_total:.1f}x faster; worst mean shift "
+              f"{worst:.3f} StdDev, worst StdDev change {worst_sd:.1%}")
+
+    report = pd.DataFrame(report)
+    output_folder = os.path.join(os.path.dirname(os.path.dirname(input_folder)), "nodem_trait_RGB")
+    os.makedirs(output_folder, exist_ok=True)
+    out_path = os.path.join(output_folder, "decode_scale_report.xlsx")
+    report.to_excel(out_path, index=False)
+    print(f"[OK] {len(jobs)} JPGs benchmarked → {out_path}")
+    return report
+
+@tracing.traced()
+def trait_extract_nodem(input_folder, workers=None, decode_scale=1, excel=False, cat=None, force=False):
+    """
+    Rows go to the trait store (nodem_trait_RGB); `excel` also writes nodem_trait_RGB/<date>.xlsx.
+    JPGs unchanged since the last run reuse their recorded row (<input_folder>/.run_state;
+    `force` recomputes all).
+    """
+    base = os.path.dirname(os.path.dirname(input_folder))
+
+    all_jobs = _list_jobs(input_folder, cat)
+    if not all_jobs:
+        print(f"[WARN] no .JPG under 8-digit date folders in {input_folder}")
+        return
+
+    state = run_state.open_state(input_folder, "9_nodem_trait_RGB", {"decode_scale": decode_scale}, force=force)
+    rows = {}
+    jobs = []
+    for path, date in all_jobs:
+        unit = os.path.relpath(path, input_folder).replace(os.sep, "/")
+        if run_state.is_fresh(state, unit, [path]):
+            rows[unit] = run_state.result(state, unit)
+        else:
+            jobs.append((path, date, decode_scale))
 
-    # Save the data for each date to a separate Excel file with dir structure
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as ex:
+            new_rows = list(ex.map(_process_image_args, jobs, chunksize=4))
+    else:
+        new_rows = [process_image_nodem(*job) for job in jobs]
+    for (path, _, _), row in zip(jobs, new_rows):
+        unit = os.path.relpath(path, input_folder).replace(os.sep, "/")
+        rows[unit] = row
+        run_state.mark_done(state, unit, [path], row)
+    run_state.save(state)
+    print(f"[INFO] {len(jobs)} of {len(all_jobs)} JPG(s) recomputed in {input_folder}")
+
+    # listing order, as before
+    df = pd.DataFrame([rows[os.path.relpath(path, input_folder).replace(os.sep, "/")] for path, _ in all_jobs])
+
+    # One trait-store partition (and optionally one Excel file) per date
     for date, data_list in df.groupby('Date'):
-        # Create a DataFrame from the list of dictionaries
-        date_df = data_list.drop(columns=['Date'])
-        parent_dir = date.replace('/', '_')  # Replace '/' with '_'
-
-        # Save the DataFrame to an Excel file within the date-specific folder with the date as the file name
-        output_excel_path = os.path.join(output_folder, f'{date}.xlsx')
-        date_df.to_excel(output_excel_path, index=False)
-        
-    print("non-dem All data saved in separate Excel files by date and parent directory.")
-    # Flatten output_data_nodem into a list of dictionaries
-    # data_list = []
-    # for (image_id, date), data in output_data_nodem.items():
-        # data_list.append(data)
-
-    # df = pd.DataFrame(data_list)
-
-    # for date, data_list in df.groupby('Date'):
-        # date_df = data_list.drop(columns=['Date'])
-        # parent_dir = date.replace('/', '_')
-
-        # output_excel_path = os.path.join(output_folder, f'{date}.xlsx')
-        # date_df.to_excel(output_excel_path, index=False)
-
-    # print("non-dem All data saved in separate Excel files by date.")
-def trait_extract_nodem_4_batch(batch_folder):
-    for folder in os.listdir(batch_folder):
+        trait_store.write_traits(base, "nodem_trait_RGB", date, data_list)
+        if excel:
+            output_folder = os.path.join(base, "nodem_trait_RGB")
+            os.makedirs(output_folder, exist_ok=True)
+            output_excel_path = os.path.join(output_folder, f'{date}.xlsx')
+            with tracing.span("to_excel", path=output_excel_path, rows=len(data_list)):
+                data_list.drop(columns=['Date']).to_excel(output_excel_path, index=False)
+
+    print(f"non-dem All data saved by date → {trait_store.family_dir(base, 'nodem_trait_RGB')}")
+
+def trait_extract_nodem_4_batch(batch_folder, workers=None, decode_scale=1, excel=False, force=False):
+    cat = catalog.load(batch_folder)
+    for folder in catalog.subdirs(cat):
         input_folder = os.path.join(batch_folder, folder)
-        trait_extract_nodem(input_folder)
-            
+        trait_extract_nodem(input_folder, workers=workers, decode_scale=decode_scale, excel=excel, cat=cat,
+                            force=force)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="nodem extraction from images with masks.")
     parser.add_argument("--ipath", type=str, default=None, help="Path to folder on 1 date.")
     parser.add_argument("--batchpath", type=str, default=None, help="Path to the folder containing multidates data")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes for the JPGs (default: all cores; 1 = in-process).")
+    parser.add_argument("--decode-scale", type=int, default=1, choices=sorted(DECODE_FLAGS),
+                        help="Decode JPGs at 1/N resolution (libjpeg DCT scaling). 1 = full resolution.")
+    parser.add_argument("--benchmark-scales", type=int, default=None, metavar="N",
+                        help="Only report decode speedup and index deviation of 1/2, 1/4, 1/8 "
+                             "against full resolution on N sample JPGs (use with --ipath).")
+    parser.add_argument("--excel", action="store_true",
+                        help="Also write nodem_trait_RGB/<date>.xlsx next to the trait store.")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute every JPG, ignoring <ipath>/.run_state.")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
 
     args = parser.parse_args()
-
-    if args.batchpath is not None:
-        trait_extract_nodem_4_batch(args.batchpath)
+    tracing.start(args.trace)
+
+    if args.benchmark_scales:
+        if not args.ipath:
+            raise SystemExit("--benchmark-scales needs --ipath")
+        benchmark_decode_scales(args.ipath, sample=args.benchmark_scales)
+    elif args.batchpath is not None:
+        trait_extract_nodem_4_batch(args.batchpath, workers=args.workers, decode_scale=args.decode_scale,
+                                    excel=args.excel, force=args.force)
     else:
-        trait_extract_nodem(args.ipath)
-
+        trait_extract_nodem(args.ipath, workers=args.workers, decode_scale=args.decode_scale, excel=args.excel,
+                            force=args.force)
@@ -0,0 +1,361 @@
+"""
+benchmark_pipeline.py
+---------------------
+Throughput benchmark of the pipeline stages on a synthetic field, at several
+scales (number of plots). Nothing real is needed. Each scale gets a fresh tree:
+
+  <workdir>/n<plots>/
+    <date>_bench_20m_/orthos/<date>_ortho.tif         5 bands (B, G, R, RE, NIR), float32, nodata collar
+    <date>_bench_20m_/orthos/<date>_dem.tif           ground plane (tilted, noisy), a raised mulch bed and a plant mound per plot
+    <date>_bench_20m_/orthos/<date>_ortho_NDVI.tif    VI layers as step 2 (QGIS) writes them
+    <date>_bench_20m_/orthos/<date>_ortho_OSAVI.tif
+    plots.shp                                         one circle per plot
+    metashape_report/gsd_4_all.xlsx
+    rgb/site/<date>/IMG_<n>.JPG                       plant on black background, one per plot
+
+Each stage (pipeline.py tasks: crop, masks, overlap, mulch, mulch_height, dem,
+spectral, merge; plus spectral_rgb from step 9 RGB) runs in a fresh process
+with --force semantics. The results are written as JSON:
+
+  {"machine": {...}, "config": {...},
+   "results": [{"plots", "stage", "seconds", "pixels", "pixels_per_s", "plots_per_s", "peak_rss_mb"}, ...]}
+
+`pixels` is the ground pixels the stage reads: the full field for crop, the
+plot chips (dem_by_plot) for the chip stages, the JPGs for spectral_rgb, and
+none for merge. peak_rss_mb is the peak resident set of the stage's process
+(VmHWM on Linux, ru_maxrss on other Unix, psutil on Windows if installed,
+else null).
+
+Usage:
+    python benchmark_pipeline.py --scales 16,64,256 --out bench.json
+    python benchmark_pipeline.py --scales 1024 --plot-px 300 --dates 3 --stages crop,dem,spectral,merge
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import cv2
+import fiona
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ("crop", "masks", "overlap", "mulch", "mulch_height", "dem", "spectral", "merge", "spectral_rgb")
+CHIP_STAGES = ("masks", "overlap", "mulch", "mulch_height", "dem", "spectral")
+CRS = "EPSG:32617"
+NODATA = -10000.0
+DEM_NODATA = -32767.0
+
+# reflectance (B, G, R, RE, NIR) of bare mulch and of canopy
+MULCH_REFL = np.array([0.05, 0.06, 0.07, 0.10, 0.15], dtype=np.float32)
+PLANT_REFL = np.array([0.03, 0.08, 0.04, 0.25, 0.50], dtype=np.float32)
+BED_HEIGHT = 0.15   # m, raised mulch bed under each plant
+
+
+def _peak_rss_mb():
+    # VmHWM is per address space; ru_maxrss survives exec on Linux and would
+    # report the parent's peak (the field generator) for every stage
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    if resource is not None:
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / 1024.0 / (1024.0 if sys.platform == "darwin" else 1.0)   # bytes on macOS
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2**20
+    except (ImportError, AttributeError):
+        return None
+
+
+# ---------- synthetic field ----------
+
+def _layout(n_plots, plot_px):
+    """Grid of plot centres (row, col in pixels) and the field size."""
+    cols = math.ceil(math.sqrt(n_plots))
+    rows = math.ceil(n_plots / cols)
+    pitch = int(plot_px * 1.5)
+    margin = plot_px   # includes the nodata collar
+    centres = [(margin + r * pitch + pitch // 2, margin + c * pitch + pitch // 2)
+               for r in range(rows) for c in range(cols)][:n_plots]
+    return centres, rows * pitch + 2 * margin, cols * pitch + 2 * margin, pitch
+
+
+def _strip(y0, height, width, centres, plot_px, rng, collar):
+    """(surface height m above the ground plane, canopy fraction 0..1, valid mask) of rows y0 .. y0+height."""
+    yy, xx = np.mgrid[y0:y0 + height, 0:width].astype(np.float32)
+    canopy = np.zeros((height, width), dtype=np.float32)
+    bed = np.zeros((height, width), dtype=np.float32)
+    radius = 0.35 * plot_px
+    for cy, cx in centres:
+        if cy + plot_px < y0 or cy - plot_px > y0 + height:
+            continue
+        d2 = ((yy - cy) ** 2 + (xx - cx) ** 2) / radius ** 2
+        canopy = np.maximum(canopy, np.clip(1.0 - d2, 0, None) * 0.30)   # 30 cm mound
+        # raised mulch bed out to 0.45 plot_px: passes the DEM threshold of step 4 but not
+        # OSAVI, so steps 6/7 find bare mulch (DEM AND NOT OSAVI) around every plant
+        bed[d2 <= (0.45 / 0.35) ** 2] = BED_HEIGHT
+    canopy *= (1.0 + 0.1 * rng.standard_normal(canopy.shape)).astype(np.float32)
+    # ragged collar along the field edge, as in real orthos
+    field_h, field_w, width_px = collar
+    edge = width_px * (1.0 + 0.5 * np.sin(yy / 37.0) * np.cos(xx / 53.0))
+    valid = (yy >= edge) & (xx >= edge) & (yy < field_h - edge) & (xx < field_w - edge)
+    return bed + canopy, np.clip(canopy / 0.05, 0, 1), valid
+
+
+def make_field(base, date, n_plots, plot_px=200, gsd_mm=5.0, seed=0):
+    """Write one date folder of the synthetic field; returns its path and pixel count."""
+    rng = np.random.default_rng(seed)
+    centres, height, width, pitch = _layout(n_plots, plot_px)
+    orthos = os.path.join(base, f"{date}_bench_20m_", "orthos")
+    os.makedirs(orthos, exist_ok=True)
+    gsd = gsd_mm / 1000.0
+    profile = {"driver": "GTiff", "width": width, "height": height, "crs": CRS, "dtype": "float32",
+               "transform": from_origin(500000.0, 4000000.0, gsd, gsd), "compress": "LZW"}
+    paths = {name: os.path.join(orthos, f"{date}_{name}.tif")
+             for name in ("ortho", "dem", "ortho_NDVI", "ortho_OSAVI")}
+    counts = {"ortho": 5, "dem": 1, "ortho_NDVI": 1, "ortho_OSAVI": 1}
+    dsts = {name: rasterio.open(p, "w", count=counts[name],
+                                nodata=DEM_NODATA if name == "dem" else NODATA, **profile)
+            for name, p in paths.items()}
+    try:
+        for y0 in range(0, height, pitch):
+            h = min(pitch, height - y0)
+            surface, frac, valid = _strip(y0, h, width, centres, plot_px, rng, (height, width, plot_px // 2))
+            yy, xx = np.mgrid[y0:y0 + h, 0:width].astype(np.float32)
+            mulch = 100.0 + 2e-4 * xx * gsd * 1000 + 1e-4 * yy * gsd * 1000
+            dem = mulch + surface + 0.005 * rng.standard_normal(surface.shape).astype(np.float32)
+            refl = (MULCH_REFL[:, None, None] * (1 - frac) + PLANT_REFL[:, None, None] * frac
+                    + 0.01 * rng.standard_normal((5, h, width)).astype(np.float32))
+            red, nir = refl[2], refl[4]
+            ndvi = (nir - red) / (nir + red + 1e-6)
+            osavi = (nir - red) / (nir + red + 0.16)
+            win = Window(0, y0, width, h)
+            dsts["ortho"].write(np.where(valid, refl, NODATA).astype(np.float32), window=win)
+            dsts["dem"].write(np.where(valid, dem, DEM_NODATA).astype(np.float32), 1, window=win)
+            dsts["ortho_NDVI"].write(np.where(valid, ndvi, NODATA).astype(np.float32), 1, window=win)
+            dsts["ortho_OSAVI"].write(np.where(valid, osavi, NODATA).astype(np.float32), 1, window=win)
+    finally:
+        for dst in dsts.values():
+            dst.close()
+    return os.path.dirname(orthos), width * height
+
+
+def make_plots_shp(path, n_plots, plot_px=200, gsd_mm=5.0):
+    centres, _, _, _ = _layout(n_plots, plot_px)
+    gsd = gsd_mm / 1000.0
+    r = 0.5 * plot_px * gsd
+    angles = np.linspace(0, 2 * np.pi, 33)
+    schema = {"geometry": "Polygon", "properties": {"id": "int", "plot": "str"}}
+    with fiona.open(path, "w", driver="ESRI Shapefile", crs=CRS, schema=schema) as dst:
+        for i, (cy, cx) in enumerate(centres):
+            x, y = 500000.0 + cx * gsd, 4000000.0 - cy * gsd
+            ring = [(x + r * math.cos(a), y + r * math.sin(a)) for a in angles]
+            dst.write({"geometry": {"type": "Polygon", "coordinates": [ring]},
+                       "properties": {"id": i, "plot": f"P{i:04d}"}})
+
+
+def make_gsd_table(base, dates, gsd_mm=5.0):
+    folder = os.path.join(base, "metashape_report")
+    os.makedirs(folder, exist_ok=True)
+    pd.DataFrame({"filename": dates, "GSD(mm/pix)": gsd_mm, "flight_altitude(m)": 20.0}).to_excel(
+        os.path.join(folder, "gsd_4_all.xlsx"), index=False)
+
+
+def make_jpgs(folder, n, px=1000, seed=0):
+    """n RGB JPGs: a green plant blob on a black background (step 9 RGB ignores black)."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    yy, xx = np.mgrid[0:px, 0:px].astype(np.float32)
+    for i in range(n):
+        cy, cx = px / 2 + rng.normal(0, px / 20, 2)
+        blob = ((yy - cy) ** 2 + (xx - cx) ** 2) < (0.3 * px) ** 2
+        img = np.zeros((px, px, 3), dtype=np.uint8)
+        bgr = np.clip(rng.normal([40, 140, 60], 20, (int(blob.sum()), 3)), 1, 255)
+        img[blob] = bgr.astype(np.uint8)
+        cv2.imwrite(os.path.join(folder, f"IMG_{i:04d}.JPG"), img)
+    return n * px * px
+
+
+def make_tree(base, n_plots, dates, plot_px=200, gsd_mm=5.0, jpg_px=1000):
+    """Synthetic tree for one scale; returns {"field_px", "jpg_px", "folders"}."""
+    folders, field_px = [], 0
+    for i, date in enumerate(dates):
+        folder, px = make_field(base, date, n_plots, plot_px=plot_px, gsd_mm=gsd_mm, seed=i)
+        folders.append(folder)
+        field_px += px
+    make_plots_shp(os.path.join(base, "plots.shp"), n_plots, plot_px=plot_px, gsd_mm=gsd_mm)
+    make_gsd_table(base, dates, gsd_mm=gsd_mm)
+    jpg = sum(make_jpgs(os.path.join(base, "rgb", "site", date), n_plots, px=jpg_px, seed=i)
+              for i, date in enumerate(dates))
+    return {"field_px": field_px, "jpg_px": jpg, "folders": folders}
+
+
+def _chip_pixels(folders):
+    total = 0
+    for folder in folders:
+        chips = os.path.join(folder, "dem_by_plot")
+        for f in os.listdir(chips) if os.path.isdir(chips) else []:
+            if not f.endswith(".tif"):
+                continue
+            with rasterio.open(os.path.join(chips, f)) as src:
+                total += src.width * src.height
+    return total
+
+
+def _check_mulch(base, folders, stage):
+    """The field must exercise the real mulch path: non-empty mulch masks, finite mulch heights."""
+    if stage == "mulch":
+        for folder in folders:
+            chips = os.path.join(folder, "masks_overlapping_mulch")
+            empty = []
+            for f in sorted(os.listdir(chips)):
+                if f.endswith(".tif"):
+                    with rasterio.open(os.path.join(chips, f)) as src:
+                        if not src.read(1).any():
+                            empty.append(f)
+            assert not empty, f"{len(empty)} empty mulch mask(s) in {chips}, e.g. {empty[0]}"
+    elif stage == "mulch_height":
+        import dem_traits
+        import trait_store
+        heights = trait_store.read_traits(base, "mulch_height")[dem_traits.BASELINE_COL]
+        assert len(heights) and np.isfinite(heights.to_numpy(dtype=float)).all(), \
+            f"non-finite mulch heights in {base}: {heights.isna().sum()} of {len(heights)} NaN"
+
+
+# ---------- timing ----------
+
+def _run_stage(stage, base, folders, opts):
+    """Child process: one stage over every date; returns (seconds, peak RSS MB)."""
+    import pipeline
+    import importlib
+    if stage == "spectral_rgb":
+        fn = importlib.import_module("9_trait_extract_spectral_rgb").trait_extract_nodem
+        t0 = time.perf_counter()
+        fn(os.path.join(base, "rgb", "site"), workers=1, force=True)
+    elif pipeline.STAGES[stage][0] == "global":
+        t0 = time.perf_counter()
+        pipeline.TASKS[stage](base, None, opts)
+    else:
+        t0 = time.perf_counter()
+        for folder in folders:
+            pipeline.TASKS[stage](base, folder, opts)
+    return time.perf_counter() - t0, _peak_rss_mb()
+
+
+def bench_scale(workdir, n_plots, stages, dates, plot_px=200, gsd_mm=5.0, jpg_px=1000, quiet=True):
+    """Generate one scale and time each stage in STAGES order; returns result rows."""
+    base = os.path.join(workdir, f"n{n_plots}")
+    shutil.rmtree(base, ignore_errors=True)
+    t0 = time.perf_counter()
+    tree = make_tree(base, n_plots, dates, plot_px=plot_px, gsd_mm=gsd_mm, jpg_px=jpg_px)
+    print(f"[INFO] {n_plots} plots x {len(dates)} date(s): {tree['field_px'] / 1e6:.1f} Mpx field "
+          f"generated in {time.perf_counter() - t0:.1f}s")
+
+    opts = {"shp": os.path.join(base, "plots.shp"), "vi_lt": 0.3, "force": True}
+    import pipeline
+    opts = {**pipeline.DEFAULT_OPTS, **opts}
+    ctx = multiprocessing.get_context("spawn")   # fresh process: per-stage peak RSS
+    # stages feed each other: unselected earlier ones still run, untimed
+    last = max([STAGES.index(s) for s in stages if s != "spectral_rgb"], default=-1)
+    rows = []
+    for stage in (s for s in STAGES if s in stages or STAGES.index(s) <= last):
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx,
+                                 initializer=_silence if quiet else None) as pool:
+            seconds, rss = pool.submit(_run_stage, stage, base, tree["folders"], opts).result()
+        _check_mulch(base, tree["folders"], stage)
+        if stage not in stages:
+            continue
+        if stage == "crop":
+            pixels = tree["field_px"]
+        elif stage in CHIP_STAGES:
+            pixels = tree.setdefault("chip_px", _chip_pixels(tree["folders"]))
+        elif stage == "spectral_rgb":
+            pixels = tree["jpg_px"]
+        else:
+            pixels = None
+        plots = n_plots * len(dates)
+        rows.append({"plots": plots, "stage": stage, "seconds": round(seconds, 4),
+                     "pixels": pixels, "pixels_per_s": round(pixels / seconds) if pixels else None,
+                     "plots_per_s": round(plots / seconds, 2),
+                     "peak_rss_mb": round(rss, 1) if rss is not None else None})
+        print(f"[OK] {stage:<13} {seconds:8.2f}s  {plots / seconds:8.1f} plots/s"
+              + (f"  {pixels / seconds / 1e6:8.2f} Mpx/s" if pixels else "")
+              + (f"  {rss:7.0f} MB" if rss is not None else ""))
+    return rows
+
+
+def _silence():
+    sys.stdout = open(os.devnull, "w")
+
+
+def main(scales, stages=STAGES, n_dates=1, plot_px=200, gsd_mm=5.0, jpg_px=1000,
+         workdir=None, keep=False, out="benchmark_results.json", quiet=True):
+    own_dir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="uav_bench_")
+    dates = [f"202401{d + 1:02d}" for d in range(n_dates)]
+    results = []
+    try:
+        for n in scales:
+            results.extend(bench_scale(workdir, n, stages, dates, plot_px=plot_px, gsd_mm=gsd_mm,
+                                       jpg_px=jpg_px, quiet=quiet))
+    finally:
+        if own_dir and not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpu_count": os.cpu_count(), "numpy": np.__version__, "rasterio": rasterio.__version__,
+                    "gdal": rasterio.__gdal_version__, "opencv": cv2.__version__},
+        "config": {"scales": list(scales), "stages": [s for s in STAGES if s in stages], "dates": n_dates,
+                   "plot_px": plot_px, "gsd_mm": gsd_mm, "jpg_px": jpg_px,
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[OK] {len(results)} result(s) → {out}" + (f" (inputs kept in {workdir})" if keep or not own_dir else ""))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on a synthetic field at several scales.")
+    parser.add_argument("--scales", type=str, default="16,64,256",
+                        help="Comma-separated plot counts (default: 16,64,256).")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES),
+                        help=f"Comma-separated stages (default: {','.join(STAGES)}).")
+    parser.add_argument("--dates", type=int, default=1, help="Date folders per scale (default 1).")
+    parser.add_argument("--plot-px", type=int, default=200, help="Plot diameter in pixels (default 200).")
+    parser.add_argument("--gsd-mm", type=float, default=5.0, help="Ground sampling distance, mm/pix (default 5).")
+    parser.add_argument("--jpg-px", type=int, default=1000, help="Side of the synthetic RGB JPGs (default 1000).")
+    parser.add_argument("--workdir", type=str, default=None, help="Where to generate inputs (default: a temp dir).")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated inputs.")
+    parser.add_argument("--verbose", action="store_true", help="Show the stages' own output.")
+    parser.add_argument("--out", type=str, default="benchmark_results.json", help="JSON results file.")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise SystemExit(f"Unknown stage(s): {unknown}; choose from {list(STAGES)}")
+    main([int(s) for s in args.scales.split(",") if s.strip()], stages=stages, n_dates=args.dates,
+         plot_px=args.plot_px, gsd_mm=args.gsd_mm, jpg_px=args.jpg_px, workdir=args.workdir,
+         keep=args.keep, out=args.out, quiet=not args.verbose)
@@ -0,0 +1,302 @@
+"""
+catalog.py
+----------
+One-pass index of a base directory, so the stages stop re-walking the tree.
+
+  <base>/.uav_catalog.json
+    {"version": 1, "dirs": {"<rel dir>": {"mtime_ns": ..., "subdirs": [...],
+                                          "files": {"<name>": {size, mtime_ns, kind, date, layer[, raster]}}}}}
+
+`load(base)` rescans with os.scandir, but only the directories whose mtime
+changed (a directory's mtime changes when entries are added, removed or
+renamed; unchanged directories cost one stat). A file rewritten in place does
+not change its directory's mtime, so `raster_info` checks a record against
+the file's stat before trusting it and rebuilds it if the file changed;
+`load(base, full=True)` re-stats everything. Hidden
+entries (the index itself, .zonal_cache, ...) are not indexed.
+
+kind: ortho | dem | render | raster | by_plot | mask | trait | other
+date: 8-digit date from the nearest dated folder (or trait file/partition name)
+layer: by_plot -> '<layer>' of '<layer>_by_plot'; mask -> mask folder(s), e.g.
+       'masks/NDVI_mask'; trait -> family folder
+raster: width, height, count, dtype, crs, transform, nodata (read from the
+GeoTIFF header for HEADER_KINDS; `headers="all"` also covers chips and masks)
+
+Query with `walk`, `subdirs`, `files`, `dates`, `raster_info`.
+"""
+
+import os
+import re
+import json
+import rasterio
+
+INDEX_NAME = ".uav_catalog.json"
+VERSION = 1
+HEADER_KINDS = ("ortho", "dem", "render", "raster")
+RASTER_EXTS = (".tif", ".tiff")
+TABLE_EXTS = (".xlsx", ".parquet")
+DATE_RE = re.compile(r"^(?:date=)?(\d{8})")
+
+
+def _rel(cat, path):
+    rel = os.path.relpath(os.path.abspath(path), cat["base"])
+    return "" if rel == "." else rel.replace(os.sep, "/")
+
+
+def _abs(cat, rel):
+    return os.path.join(cat["base"], *rel.split("/")) if rel else cat["base"]
+
+
+def classify(rel_dir, name):
+    """(kind, date, layer) of one file from its place in the tree."""
+    parts = rel_dir.split("/") if rel_dir else []
+    low = name.lower()
+    date = next((m.group(1) for m in map(DATE_RE.match, parts) if m), None)
+    parent = parts[-1] if parts else ""
+
+    if low.endswith(TABLE_EXTS):
+        family = next((p for p in parts if "trait" in p.lower() or p == "mulch_height"), None)
+        if family is not None:
+            if date is None:
+                m = DATE_RE.match(name)
+                date = m.group(1) if m else None
+            return "trait", date, family
+        return "other", date, None
+    if not low.endswith(RASTER_EXTS):
+        return "other", date, None
+    if parent.endswith("_by_plot"):
+        return "by_plot", date, parent[:-len("_by_plot")]
+    mask_at = next((i for i, p in enumerate(parts) if p.lower().startswith("mask")), None)
+    if mask_at is not None:
+        return "mask", date, "/".join(parts[mask_at:])
+    if low.endswith(("ortho.tif", "ortho.tiff")):
+        return "ortho", date, None
+    if low.endswith(("dem.tif", "dem.tiff")):
+        return "dem", date, None
+    if "render" in low:
+        return "render", date, None
+    return "raster", date, None
+
+
+def _raster_header(path):
+    try:
+        with rasterio.open(path) as src:
+            return {"width": src.width, "height": src.height, "count": src.count,
+                    "dtype": src.dtypes[0], "crs": src.crs.to_string() if src.crs else None,
+                    "transform": list(src.transform)[:6], "nodata": src.nodata}
+    except Exception as e:
+        print(f"[WARN] Could not read raster header {path}: {e}")
+        return None
+
+
+def _scan_dir(cat, rel, old, headers):
+    """Fresh entry for one directory; reuses file records whose size and mtime are unchanged."""
+    path = _abs(cat, rel)
+    old_files = (old or {}).get("files", {})
+    files, subdirs = {}, []
+    with os.scandir(path) as it:
+        for e in it:
+            if e.name.startswith("."):   # the index itself, .zonal_cache, ...
+                continue
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(e.name)
+                continue
+            st = e.stat()
+            prev = old_files.get(e.name)
+            if prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns:
+                files[e.name] = prev
+                continue
+            kind, date, layer = classify(rel, e.name)
+            rec = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "kind": kind, "date": date, "layer": layer}
+            if kind != "other" and e.name.lower().endswith(RASTER_EXTS) and (headers == "all" or kind in headers):
+                rec["raster"] = _raster_header(e.path)
+            files[e.name] = rec
+    # directory order as os.listdir returns it: stages that take "the first
+    # subfolder" as reference (e.g. step 5's grid) behave exactly as before
+    return {"mtime_ns": os.stat(path).st_mtime_ns, "subdirs": subdirs, "files": files}
+
+
+def _refresh(cat, rel, headers, full):
+    """Depth-first refresh below `rel`; returns the number of directories rescanned."""
+    old_dirs = cat["dirs"]
+    new_dirs, rescanned = {}, 0
+    stack = [rel]
+    while stack:
+        r = stack.pop()
+        try:
+            mtime = os.stat(_abs(cat, r)).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        old = old_dirs.get(r)
+        if full or old is None or old["mtime_ns"] != mtime:
+            entry = _scan_dir(cat, r, None if full else old, headers)
+            rescanned += 1
+        else:
+            entry = old
+        new_dirs[r] = entry
+        stack.extend(f"{r}/{s}" if r else s for s in reversed(entry["subdirs"]))
+
+    prefix = f"{rel}/" if rel else ""
+    for r in list(old_dirs):
+        if r == rel or r.startswith(prefix):
+            del old_dirs[r]
+    old_dirs.update(new_dirs)
+    return rescanned
+
+
+def load(base, refresh=True, subtree=None, headers=HEADER_KINDS, full=False, persist=True):
+    """
+    Catalog of `base` (read from <base>/.uav_catalog.json, refreshed and saved).
+    `subtree` limits the refresh to one folder below base (e.g. a date folder);
+    `full` ignores the cached directory mtimes and re-stats every file.
+    `persist=False` keeps the refresh in memory (pipeline workers, which run
+    concurrently and leave saving the index to the orchestrator).
+    """
+    base = os.path.abspath(base)
+    index_path = os.path.join(base, INDEX_NAME)
+    cat = None
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                cat = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Ignoring unreadable catalog {index_path}: {e}")
+        if cat is not None and cat.get("version") != VERSION:
+            cat = None
+    if cat is None:
+        cat = {"version": VERSION, "dirs": {}}
+    cat["base"] = base
+
+    if refresh:
+        rel = _rel(cat, subtree) if subtree else ""
+        rescanned = _refresh(cat, rel, headers, full)
+        if rescanned and persist:
+            save(cat)
+    return cat
+
+
+def save(cat):
+    # rewritten in place: creating/renaming a file would bump the base folder's mtime
+    # and force a rescan of it on every load (a torn write is simply rebuilt)
+    index_path = os.path.join(cat["base"], INDEX_NAME)
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump({k: v for k, v in cat.items() if k != "base"}, f, separators=(",", ":"))
+
+
+def for_folder(folder, **kwargs):
+    """
+    Catalog containing `folder`, refreshed only below it. Rooted at the nearest
+    ancestor that already has an index, else at the batch folder (parent of the
+    nearest dated folder), else at the parent of `folder`.
+    """
+    folder = os.path.abspath(folder)
+    root, dated, p = None, None, folder
+    while True:
+        if dated is None and DATE_RE.match(os.path.basename(p)):
+            dated = p
+        up = os.path.dirname(p)
+        if up == p:
+            break
+        p = up
+        if os.path.exists(os.path.join(p, INDEX_NAME)):
+            root = p
+            break
+    if root is None:
+        root = os.path.dirname(dated or folder)
+    return load(root, subtree=folder, **kwargs)
+
+
+def walk(cat, folder=None):
+    """os.walk replacement over the catalog: yields (dirpath, subdirs, files) top-down."""
+    stack = [_rel(cat, folder) if folder else ""]
+    while stack:
+        r = stack.pop()
+        entry = cat["dirs"].get(r)
+        if entry is None:
+            continue
+        yield _abs(cat, r), list(entry["subdirs"]), list(entry["files"])
+        stack.extend(f"{r}/{s}" if r else s for s in reversed(entry["subdirs"]))
+
+
+def subdirs(cat, folder=None):
+    """Names of the immediate subfolders of `folder` (default: base)."""
+    entry = cat["dirs"].get(_rel(cat, folder) if folder else "")
+    return list(entry["subdirs"]) if entry else []
+
+
+def listdir(cat, folder):
+    """File names directly in `folder` ([] if the folder is not in the catalog)."""
+    entry = cat["dirs"].get(_rel(cat, folder))
+    return list(entry["files"]) if entry else []
+
+
+def files(cat, folder=None, kind=None, date=None, layer=None, suffix=None):
+    """Absolute paths of the files below `folder` matching every given filter."""
+    out = []
+    suffix = suffix.lower() if suffix else None
+    for dirpath, _, _ in walk(cat, folder):
+        for name, rec in cat["dirs"][_rel(cat, dirpath)]["files"].items():
+            if kind is not None and rec["kind"] != kind:
+                continue
+            if date is not None and rec["date"] != str(date):
+                continue
+            if layer is not None and rec["layer"] != layer:
+                continue
+            if suffix is not None and not name.lower().endswith(suffix):
+                continue
+            out.append(os.path.join(dirpath, name))
+    return out
+
+
+def dates(cat, kind=None):
+    """Sorted dates present in the catalog (optionally only for one kind)."""
+    return sorted({rec["date"] for d in cat["dirs"].values() for rec in d["files"].values()
+                   if rec["date"] and (kind is None or rec["kind"] == kind)})
+
+
+def _record(cat, path):
+    """
+    File record of `path`, checked against its stat: a record whose size or
+    mtime no longer match (rewritten in place) is rebuilt in the catalog.
+    None if the file is not catalogued or is gone.
+    """
+    rel, name = _rel(cat, os.path.dirname(path)), os.path.basename(path)
+    entry = cat["dirs"].get(rel)
+    rec = entry["files"].get(name) if entry else None
+    if rec is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        del entry["files"][name]
+        return None
+    if rec["size"] != st.st_size or rec["mtime_ns"] != st.st_mtime_ns:
+        fresh = {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                 "kind": rec["kind"], "date": rec["date"], "layer": rec["layer"]}
+        if "raster" in rec:
+            fresh["raster"] = _raster_header(path)
+        rec = entry["files"][name] = fresh
+    return rec
+
+
+def raster_info(cat, path):
+    """Header dict of a raster file (cached, re-read if the file changed since), or None."""
+    rec = _record(cat, path)
+    return rec.get("raster") if rec else None
+
+
+if __name__ == "__main__":
+    import argparse
+    from collections import Counter
+
+    parser = argparse.ArgumentParser(description="Build/refresh the dataset catalog (.uav_catalog.json).")
+    parser.add_argument("base_dir", type=str, help="Base directory to index")
+    parser.add_argument("--full", action="store_true", help="Re-stat every file (after in-place rewrites).")
+    parser.add_argument("--all-headers", action="store_true",
+                        help="Also read raster headers of chips and masks (slow on large trees).")
+    args = parser.parse_args()
+
+    cat = load(args.base_dir, full=args.full, headers="all" if args.all_headers else HEADER_KINDS)
+    kinds = Counter(rec["kind"] for d in cat["dirs"].values() for rec in d["files"].values())
+    print(f"[OK] {len(cat['dirs'])} folders, {sum(kinds.values())} files, dates {dates(cat)}")
+    print(f"[INFO] {dict(kinds)} → {os.path.join(cat['base'], INDEX_NAME)}")
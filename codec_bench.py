@@ -0,0 +1,301 @@
+"""
+codec_bench.py
+--------------
+Picks the GeoTIFF codec per layer type from a sample of real intermediates
+and writes codec_profile.json, which raster_profile.py (and so every crop,
+mask and render writer) loads.
+
+Layer types and the readers the pipeline decodes them with:
+
+  mask    masks/*, masks_overlapping*    rasterio (steps 5/6), OpenCV (steps 7-9)
+  dem     dem_by_plot chips              rasterio (step 4), OpenCV (steps 7/8)
+  vi      NDVI_by_plot, OSAVI_by_plot..  rasterio (step 4), tifffile (step 9)
+  ortho   ortho_by_plot chips            tifffile (step 9)
+  render  *render_by_plot chips          tifffile (step 9)
+
+Candidates: no compression, LZW, DEFLATE and ZSTD levels, each with the
+predictor variants (1 none, 2 horizontal, 3 floating point for floats), and
+LERC / LERC_DEFLATE / LERC_ZSTD lossless. LERC with an error bound is tried
+only for layers given in --max-error (e.g. vi=0.001). Every sample is
+written with the shared tiled layout, then read back with each of the
+layer's readers (best of --repeat). A candidate is kept only if every reader
+decodes it (OpenCV has no ZSTD/LERC) and the pixels match, or stay within
+the bound.
+
+The score is the time one intermediate costs over its life: one write plus
+one read per reader, each moving the file over storage at --storage-mb-s
+(the files were just written, so the reads themselves hit the page cache;
+the transfer term models a network share). 0 means local disk. Run with
+--workdir on the share itself to measure its write speed too.
+
+  {"machine": {...}, "config": {...},
+   "layers": {"mask": {"compress": "ZSTD", "zstd_level": 9, "predictor": 2}, ...},
+   "results": [{"layer", "label", "codec", "ok", "size_mb", "ratio", "write_s",
+                "read_s": {reader: s}, "max_error", "cost_s"}, ...]}
+
+Usage:
+    python codec_bench.py D:\\test --storage-mb-s 100
+    python codec_bench.py D:\\test --layers vi,dem --max-error vi=0.001 --sample 30 --out codec_profile.json
+"""
+
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+os.environ.setdefault("OPENCV_LOG_LEVEL", "OFF")   # failed decodes are expected and reported per codec
+import numpy as np
+import cv2
+import rasterio
+import tifffile
+
+import catalog
+import raster_profile
+
+LAYER_READERS = {
+    "mask": ("gdal", "cv2"),
+    "dem": ("gdal", "cv2"),
+    "vi": ("gdal", "tifffile"),
+    "ortho": ("tifffile",),
+    "render": ("tifffile",),
+}
+DEFLATE_LEVELS = (1, 6, 9)
+ZSTD_LEVELS = (1, 9, 15)
+LERC_CODECS = ("LERC", "LERC_DEFLATE", "LERC_ZSTD")
+
+
+# ---------- readers ----------
+def _read_gdal(path):
+    with rasterio.open(path) as src:
+        return src.read()
+
+
+def _read_cv2(path):
+    arr = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if arr is None:
+        raise ValueError("OpenCV could not decode it")
+    return arr
+
+
+def _read_tifffile(path):
+    return tifffile.imread(path)
+
+
+READERS = {"gdal": _read_gdal, "cv2": _read_cv2, "tifffile": _read_tifffile}
+
+
+# ---------- sample ----------
+def sample_files(base, layers, n, seed=0):
+    """{layer: up to n chip/mask paths}, drawn reproducibly from the catalog."""
+    cat = catalog.load(base)
+    found = {layer: [] for layer in layers}
+    if "mask" in found:
+        found["mask"] = catalog.files(cat, kind="mask")
+    for path in catalog.files(cat, kind="by_plot"):
+        layer = raster_profile.chip_layer(os.path.basename(os.path.dirname(path))[:-len("_by_plot")])
+        if layer in found:
+            found[layer].append(path)
+    rng = random.Random(seed)
+    return {layer: rng.sample(sorted(paths), min(n, len(paths))) for layer, paths in found.items()}
+
+
+# ---------- candidates ----------
+def candidates(is_float, max_error=None):
+    preds = (1, 2, 3) if is_float else (1, 2)
+    out = [{"compress": "NONE"}]
+    out += [{"compress": "LZW", "predictor": p} for p in preds]
+    out += [{"compress": "DEFLATE", "zlevel": z, "predictor": p} for z in DEFLATE_LEVELS for p in preds]
+    out += [{"compress": "ZSTD", "zstd_level": z, "predictor": p} for z in ZSTD_LEVELS for p in preds]
+    out += [{"compress": c, "max_z_error": 0} for c in LERC_CODECS]
+    if is_float and max_error:
+        out += [{"compress": c, "max_z_error": max_error} for c in ("LERC", "LERC_ZSTD")]
+    return out
+
+
+def label(codec):
+    parts = [codec["compress"]]
+    if "zlevel" in codec:
+        parts.append(f"z{codec['zlevel']}")
+    if "zstd_level" in codec:
+        parts.append(f"z{codec['zstd_level']}")
+    if "predictor" in codec:
+        parts.append(f"p{codec['predictor']}")
+    if codec.get("max_z_error"):
+        parts.append(f"e{codec['max_z_error']:g}")
+    return " ".join(parts)
+
+
+# ---------- measurement ----------
+def _best(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def _write(path, profile, arr, codec):
+    with rasterio.open(path, "w", **raster_profile.output_profile(profile, codec_opts=codec)) as dst:
+        dst.write(arr)
+
+
+def _max_error(path, profile, arr):
+    """Largest deviation of the written file from `arr` over valid pixels (inf if nodata/NaN moved)."""
+    back = _read_gdal(path)
+    if not np.issubdtype(arr.dtype, np.floating):
+        return float(np.abs(back.astype(np.int64) - arr.astype(np.int64)).max()) if arr.size else 0.0
+    nan_a, nan_b = np.isnan(arr), np.isnan(back)
+    if not np.array_equal(nan_a, nan_b):
+        return float("inf")
+    valid = ~nan_a
+    nodata = profile.get("nodata")
+    if nodata is not None and not np.isnan(nodata):
+        if not np.array_equal(arr == nodata, back == nodata):
+            return float("inf")
+        valid &= arr != nodata
+    return float(np.abs(back[valid].astype(np.float64) - arr[valid]).max()) if valid.any() else 0.0
+
+
+def bench_layer(layer, paths, tmpdir, storage_mb_s=0.0, max_error=None, repeat=3):
+    """One result row per candidate codec for the sample `paths` of one layer type."""
+    samples = []
+    for p in paths:
+        with rasterio.open(p) as src:
+            samples.append((src.profile, src.read()))
+    raw = sum(arr.nbytes for _, arr in samples)
+    is_float = np.issubdtype(samples[0][1].dtype, np.floating)
+    readers = LAYER_READERS[layer]
+    rows = []
+    for codec in candidates(is_float, max_error):
+        row = {"layer": layer, "label": label(codec), "codec": codec, "files": len(samples),
+               "raw_mb": round(raw / 1e6, 3), "ok": False}
+        write_s, size, err = 0.0, 0, 0.0
+        read_s = {r: 0.0 for r in readers}
+        try:
+            for i, (profile, arr) in enumerate(samples):
+                out = os.path.join(tmpdir, f"{layer}_{i}.tif")
+                write_s += _best(lambda: _write(out, profile, arr, codec), repeat)
+                size += os.path.getsize(out)
+                for r in readers:
+                    try:
+                        read_s[r] += _best(lambda: READERS[r](out), repeat)
+                    except Exception as e:
+                        raise RuntimeError(f"{r}: {e}") from None
+                err = max(err, _max_error(out, profile, arr))
+        except Exception as e:
+            row["error"] = str(e)[:200]
+            rows.append(row)
+            continue
+        transfer = size / (storage_mb_s * 1e6) if storage_mb_s else 0.0
+        row.update(ok=err <= (max_error or 0.0) * (1 + 1e-6),
+                   size_mb=round(size / 1e6, 3), ratio=round(raw / size, 3), write_s=round(write_s, 4),
+                   read_s={r: round(s, 4) for r, s in read_s.items()}, max_error=err,
+                   cost_s=round(write_s + transfer + sum(s + transfer for s in read_s.values()), 4))
+        if not row["ok"]:
+            row["error"] = f"max error {err:g} over the bound"
+        rows.append(row)
+    return rows
+
+
+def recommend(rows):
+    """Cheapest codec that every reader decodes within the error bound (None if none did)."""
+    ok = [r for r in rows if r["ok"]]
+    return min(ok, key=lambda r: (r["cost_s"], r["size_mb"])) if ok else None
+
+
+def _print_layer(layer, rows, best, top=8):
+    print(f"\n[{layer}] {rows[0]['files']} file(s), {rows[0]['raw_mb']:.1f} MB raw; readers: "
+          f"{', '.join(LAYER_READERS[layer])}")
+    print(f"  {'codec':<22} {'MB':>8} {'ratio':>6} {'write s':>8} {'read s':>8} {'cost s':>8}")
+    ranked = sorted((r for r in rows if r["ok"]), key=lambda r: r["cost_s"])
+    for r in ranked[:top]:
+        mark = "*" if r is best else " "
+        print(f" {mark}{r['label']:<22} {r['size_mb']:8.2f} {r['ratio']:6.2f} {r['write_s']:8.3f} "
+              f"{sum(r['read_s'].values()):8.3f} {r['cost_s']:8.3f}")
+    failed = sorted({r["error"].split(":")[0] for r in rows if not r["ok"]})
+    if failed:
+        print(f"  excluded: {sum(not r['ok'] for r in rows)} codec(s) ({'; '.join(failed)})")
+
+
+def main(base, layers=raster_profile.LAYERS, sample=12, storage_mb_s=100.0, max_errors=None,
+         repeat=3, workdir=None, out=None, seed=0):
+    out = out or raster_profile.PROFILE_PATH
+    max_errors = max_errors or {}
+    files = sample_files(base, layers, sample, seed=seed)
+    tmpdir = tempfile.mkdtemp(prefix="uav_codec_", dir=workdir)
+    results, chosen = [], {}
+    try:
+        for layer in layers:
+            if not files.get(layer):
+                print(f"[WARN] No {layer} rasters under {base}; keeping the default codec")
+                continue
+            rows = bench_layer(layer, files[layer], tmpdir, storage_mb_s=storage_mb_s,
+                               max_error=max_errors.get(layer), repeat=repeat)
+            best = recommend(rows)
+            _print_layer(layer, rows, best)
+            results.extend(rows)
+            if best is not None:
+                chosen[layer] = best["codec"]
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "cpu_count": os.cpu_count(), "rasterio": rasterio.__version__,
+                    "gdal": rasterio.__gdal_version__, "opencv": cv2.__version__,
+                    "tifffile": tifffile.__version__},
+        "config": {"base": os.path.abspath(base), "layers": list(layers), "sample": sample,
+                   "storage_mb_s": storage_mb_s, "max_error": max_errors, "repeat": repeat,
+                   "workdir": workdir, "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "layers": chosen,
+        "results": results,
+    }
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print()
+    for layer, codec in chosen.items():
+        print(f"[OK] {layer:<7} → {label(codec)}")
+    print(f"[OK] Codec profile → {out}")
+    return report
+
+
+def _parse_max_errors(text):
+    out = {}
+    for item in (text or "").split(","):
+        if item.strip():
+            layer, _, value = item.partition("=")
+            out[layer.strip()] = float(value)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark GeoTIFF codecs on real intermediates and "
+                                                 "write the per-layer codec profile.")
+    parser.add_argument("base_dir", type=str, help="Base directory with the date folders.")
+    parser.add_argument("--layers", type=str, default=",".join(raster_profile.LAYERS),
+                        help=f"Comma-separated layer types (default: {','.join(raster_profile.LAYERS)}).")
+    parser.add_argument("--sample", type=int, default=12, help="Files per layer type (default 12).")
+    parser.add_argument("--storage-mb-s", type=float, default=100.0,
+                        help="Storage throughput in MB/s used to weigh file size (default 100; 0 = local).")
+    parser.add_argument("--max-error", type=str, default="",
+                        help="Allow lossy LERC per float layer, e.g. 'vi=0.001,dem=0.002'.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repeats, best counts (default 3).")
+    parser.add_argument("--workdir", type=str, default=None,
+                        help="Where to write the trial files (default: system temp; use the share to measure it).")
+    parser.add_argument("--out", type=str, default=None,
+                        help=f"Profile file (default: {raster_profile.PROFILE_PATH}).")
+    args = parser.parse_args()
+
+    layers = [s.strip() for s in args.layers.split(",") if s.strip()]
+    unknown = [s for s in layers if s not in raster_profile.LAYERS]
+    if unknown:
+        raise SystemExit(f"Unknown layer(s): {unknown}; choose from {list(raster_profile.LAYERS)}")
+    main(args.base_dir, layers=layers, sample=args.sample, storage_mb_s=args.storage_mb_s,
+         max_errors=_parse_max_errors(args.max_error), repeat=args.repeat, workdir=args.workdir,
+         out=args.out)
@@ -0,0 +1,100 @@
+"""
+dem_traits.py
+-------------
+DEM-chip kernels shared by 7_mulch_height_extract.py (mulch baseline) and
+8_trait_extract_dem.py (canopy coverage / height / volume), so both steps,
+and the combined single-read pass in step 8, compute identical numbers.
+"""
+
+import os
+import cv2
+import numpy as np
+import pandas as pd
+
+from robust_stats import masked_values, inter_percentile_mean, top_k_mean
+import trait_store
+import tracing
+
+BASELINE_COL = 'Average Height (5%-95%)'
+TRAIT_COLS = [
+    'Canopy Coverage pixel',
+    'Canopy Coverage (m^2)',
+    'Relative Average Height (Top 5%) (cm)',
+    'Relative Volume (m^3)',
+]
+
+
+def read_chip(path):
+    """cv2 decode of a single-band chip (first channel if multi-band); None if unreadable."""
+    with tracing.span("read_chip", path=path) as sp:
+        arr = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        sp.set(pixels=int(arr.shape[0] * arr.shape[1]) if arr is not None else 0)
+    if arr is not None and arr.ndim == 3:
+        arr = arr[:, :, 0]
+    return arr
+
+
+def align(dem, mask):
+    """Crop DEM and mask to their common top-left extent (views, no copies)."""
+    if dem.shape != mask.shape:
+        h = min(dem.shape[0], mask.shape[0])
+        w = min(dem.shape[1], mask.shape[1])
+        dem = dem[:h, :w]
+        mask = mask[:h, :w]
+    return dem, mask
+
+
+def mulch_baseline(dem, mulch_mask, approx=False):
+    """Mean of the 30–70% ranked mulch elevations inside the central 90% ROI."""
+    dem, mulch_mask = align(dem, mulch_mask)
+    h, w = dem.shape[:2]
+    r0, r1 = int(h * 0.05), int(h * 0.95)
+    c0, c1 = int(w * 0.05), int(w * 0.95)
+    valid = masked_values(dem[r0:r1, c0:c1], mulch_mask[r0:r1, c0:c1])
+    return inter_percentile_mean(valid, 0.30, 0.70, approx=approx)
+
+
+def canopy_stats(dem, veg_mask, approx=False):
+    """
+    (coverage_px, top-5% mean elevation, elevation sum) over the vegetation
+    mask, or None when the mask selects no valid pixel.
+    """
+    dem, veg_mask = align(dem, veg_mask)
+    vals = masked_values(dem, veg_mask)
+    if vals.size == 0:
+        return None
+    return int(vals.size), top_k_mean(vals, 0.05, approx=approx), float(vals.sum(dtype=np.float64))
+
+
+def load_baseline_map(base, date_component, reference_subdir="mulch_height"):
+    """
+    Image ID -> mulch baseline (m) for one date: from the trait store written
+    by step 7, else the legacy <base>/<reference_subdir>/<date>.xlsx; {} if neither.
+    """
+    ref = trait_store.read_traits(base, "mulch_height", dates=[date_component], columns=[BASELINE_COL])
+    if ref.empty:
+        ref_path = os.path.join(base, reference_subdir, f"{date_component}.xlsx")
+        if not os.path.exists(ref_path):
+            print(f"[WARN] No mulch baseline for {date_component} in the trait store or {ref_path}")
+            return {}
+        try:
+            with tracing.span("pd.read_excel", path=ref_path):
+                ref = pd.read_excel(ref_path)
+        except Exception as e:
+            print(f"[WARN] Could not read reference file: {ref_path} ({e})")
+            return {}
+    return dict(zip(ref['Image ID'].astype(str), ref[BASELINE_COL].astype(float)))
+
+
+def canopy_traits(coverage_px, avg_top5, elev_sum, ref_h, px_m2):
+    """
+    Trait columns from `canopy_stats` outputs, the mulch baseline (m) and the
+    pixel area (m^2). Scalars or per-plot arrays; a NaN input gives NaN traits.
+    """
+    coverage_px = np.asarray(coverage_px, dtype=np.float64)
+    return {
+        'Canopy Coverage pixel': coverage_px,
+        'Canopy Coverage (m^2)': coverage_px * px_m2,
+        'Relative Average Height (Top 5%) (cm)': (np.asarray(avg_top5) - ref_h) * 100.0,
+        'Relative Volume (m^3)': (np.asarray(elev_sum) - coverage_px * ref_h) * px_m2,
+    }
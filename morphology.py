@@ -0,0 +1,282 @@
+"""
+morphology.py
+-------------
+Binary morphology for mask post-processing with decomposed structuring elements.
+
+mode="exact"
+    Pixel-identical to cv2.morphologyEx with the same kernel.  Small ellipses
+    go straight to OpenCV, whose SIMD per-kernel-point loop is fastest there;
+    from DECOMPOSE_MIN_K up the ellipse is decomposed row by row: one
+    horizontal line dilation per distinct row run (each grown incrementally
+    from the previous, shorter run), OR-ed in with the matching vertical
+    shift.  That is O(k) instead of O(k^2) work per pixel.  Rectangles go
+    straight to OpenCV, which already filters them separably.
+
+mode="approx"
+    The ellipse is replaced by an octagon built from a separable square
+    ((2p+1) x (2p+1), two line passes) followed by q iterations of the 3 x 3
+    cross, i.e. O(k) work per pixel with tiny constant factors.  (p, q) are
+    chosen so the octagon best matches OpenCV's k x k ellipse;
+    `approximation_bound(k)` reports how far the two structuring elements
+    still differ, and `compare_modes` measures the actual pixel difference
+    on a given mask.
+
+All functions take a 2-D bool or uint8 (0/255) mask and return uint8 (0/255).
+`close_open_batch` runs the same operation over a sequence of chips; kernel
+decompositions and octagon parameters are cached per k.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import cv2
+
+MODES = ("exact", "approx")
+
+_CROSS = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+
+# below this ellipse size OpenCV's direct kernel is faster than the row decomposition
+DECOMPOSE_MIN_K = 25
+
+
+@lru_cache(maxsize=64)
+def _kernel(k, shape):
+    if shape == "rect":
+        return np.ones((k, k), np.uint8)
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k, k))
+
+
+@lru_cache(maxsize=64)
+def _row_runs(k, shape):
+    """
+    Decompose the kernel into horizontal runs.
+    Returns (anchor_x, anchor_y, [(dy, c0, c1), ...]) with one entry per
+    non-empty kernel row; c0/c1 are inclusive column offsets from the anchor.
+    """
+    se = _kernel(k, shape)
+    ay, ax = se.shape[0] // 2, se.shape[1] // 2
+    runs = []
+    for r in range(se.shape[0]):
+        cols = np.flatnonzero(se[r])
+        if cols.size == 0:
+            continue
+        if cols[-1] - cols[0] + 1 != cols.size:
+            raise ValueError("Structuring element rows must be contiguous for decomposition.")
+        runs.append((r - ay, int(cols[0]) - ax, int(cols[-1]) - ax))
+    return ax, ay, tuple(runs)
+
+
+def _as_u8(mask):
+    if mask.dtype == bool:
+        return mask.astype(np.uint8) * 255
+    return (mask > 0).astype(np.uint8) * 255
+
+
+def _hshift(img, dx):
+    """out[:, x] = img[:, x + dx], zero-filled."""
+    out = np.zeros_like(img)
+    w = img.shape[1]
+    if abs(dx) >= w:
+        return out
+    if dx >= 0:
+        out[:, :w - dx] = img[:, dx:]
+    else:
+        out[:, -dx:] = img[:, :w + dx]
+    return out
+
+
+def _line_dilations(img, runs):
+    """Horizontal line dilations for each distinct (c0, c1), grown incrementally when runs are nested."""
+    out = {}
+    prev, prev_run = None, None
+    for c0, c1 in sorted({(c0, c1) for _, c0, c1 in runs}, key=lambda r: r[1] - r[0]):
+        if prev is not None and c0 <= prev_run[0] and c1 >= prev_run[1]:
+            # grow the previous run by (prev_c0 - c0) on the left, (c1 - prev_c1) on the right
+            left, right = prev_run[0] - c0, c1 - prev_run[1]
+            base = prev
+        else:
+            left, right = -c0, c1
+            base = img
+        if left == 0 and right == 0:
+            cur = base
+        elif left >= 0 and right >= 0:
+            kern = np.ones((1, left + right + 1), np.uint8)
+            cur = cv2.dilate(base, kern, anchor=(left, 0))
+        else:
+            # run does not straddle the anchor (even-sized kernels): dilate, then shift
+            kern = np.ones((1, right + left + 1), np.uint8)
+            cur = _hshift(cv2.dilate(base, kern, anchor=(0, 0)), -left)
+        out[(c0, c1)] = cur
+        prev, prev_run = cur, (c0, c1)
+    return out
+
+
+def _dilate_decomposed(img, k, shape):
+    _, _, runs = _row_runs(k, shape)
+    lines = _line_dilations(img, runs)
+    h = img.shape[0]
+    out = np.zeros_like(img)
+    for dy, c0, c1 in runs:
+        # out[y] |= line[y + dy]
+        src = lines[(c0, c1)]
+        if dy >= 0:
+            if dy >= h:
+                continue
+            np.maximum(out[:h - dy], src[dy:], out=out[:h - dy])
+        else:
+            if -dy >= h:
+                continue
+            np.maximum(out[-dy:], src[:h + dy], out=out[-dy:])
+    return out
+
+
+def _octagon_dilate(img, p, q):
+    if p > 0:
+        img = cv2.dilate(img, _kernel(2 * p + 1, "rect"))
+    if q > 0:
+        img = cv2.dilate(img, _CROSS, iterations=q)
+    return img
+
+
+def _octagon_erode(img, p, q):
+    if p > 0:
+        img = cv2.erode(img, _kernel(2 * p + 1, "rect"))
+    if q > 0:
+        img = cv2.erode(img, _CROSS, iterations=q)
+    return img
+
+
+def _embedded_ellipse(k, n):
+    exact = np.zeros((n, n), bool)
+    lo = n // 2 - k // 2
+    exact[lo:lo + k, lo:lo + k] = _kernel(k, "ellipse").astype(bool)
+    return exact
+
+
+@lru_cache(maxsize=64)
+def _octagon_params(k):
+    """
+    (p, q) of the octagon that best matches the k x k ellipse, plus the
+    octagon itself on a (2k+1) x (2k+1) grid.
+    """
+    n = 2 * k + 1
+    point = np.zeros((n, n), np.uint8)
+    point[k, k] = 255
+    exact = _embedded_ellipse(k, n)
+    r = k // 2
+    best = None
+    for p in range(r + 1):
+        for q in range(r + 1 - p):
+            se = _octagon_dilate(point, p, q) > 0
+            err = np.count_nonzero(se ^ exact)
+            if best is None or err < best[0]:
+                best = (err, p, q, se)
+    _, p, q, se = best
+    return p, q, se
+
+
+def _dilate(img, k, shape, mode):
+    # even sizes have no centred octagon; they are small enough to run exactly
+    if mode == "approx" and k % 2 == 1:
+        p, q, _ = _octagon_params(k)
+        return _octagon_dilate(img, p, q)
+    if shape == "rect" or k < DECOMPOSE_MIN_K:
+        return cv2.dilate(img, _kernel(k, shape))
+    return _dilate_decomposed(img, k, shape)
+
+
+def _erode(img, k, shape, mode):
+    if mode == "approx" and k % 2 == 1:
+        p, q, _ = _octagon_params(k)
+        return _octagon_erode(img, p, q)
+    if shape == "rect" or k < DECOMPOSE_MIN_K:
+        return cv2.erode(img, _kernel(k, shape))
+    # erosion is the complement of the dilated complement (the ellipse is
+    # point-symmetric); beyond the border counts as foreground, as in cv2.erode
+    return 255 - _dilate_decomposed(255 - img, k, shape)
+
+
+def _check(k, shape, mode):
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of: {', '.join(MODES)}")
+    if shape not in ("ellipse", "rect"):
+        raise ValueError("shape must be 'ellipse' or 'rect'")
+    if mode == "approx" and shape != "ellipse":
+        raise ValueError("approx mode only applies to ellipses")
+
+
+def dilate(mask, k, shape="ellipse", mode="exact"):
+    _check(k, shape, mode)
+    return _dilate(_as_u8(mask), k, shape, mode)
+
+
+def erode(mask, k, shape="ellipse", mode="exact"):
+    _check(k, shape, mode)
+    return _erode(_as_u8(mask), k, shape, mode)
+
+
+def binary_close(mask, k, shape="ellipse", mode="exact"):
+    """Closing (dilate then erode); k <= 1 returns the mask unchanged as uint8."""
+    img = _as_u8(mask)
+    if not k or k <= 1:
+        return img
+    _check(k, shape, mode)
+    return _erode(_dilate(img, k, shape, mode), k, shape, mode)
+
+
+def binary_open(mask, k, shape="ellipse", mode="exact"):
+    """Opening (erode then dilate); k <= 1 returns the mask unchanged as uint8."""
+    img = _as_u8(mask)
+    if not k or k <= 1:
+        return img
+    _check(k, shape, mode)
+    return _dilate(_erode(img, k, shape, mode), k, shape, mode)
+
+
+def close_open(mask, k_close=0, k_open=0, shape="ellipse", mode="exact"):
+    """Closing followed by opening, the post-processing used for vegetation masks."""
+    out = binary_close(mask, k_close, shape=shape, mode=mode)
+    return binary_open(out, k_open, shape=shape, mode=mode)
+
+
+def close_open_batch(masks, k_close=0, k_open=0, shape="ellipse", mode="exact"):
+    """Apply `close_open` to every chip in `masks`; yields uint8 results lazily."""
+    for m in masks:
+        yield close_open(m, k_close, k_open, shape=shape, mode=mode)
+
+
+def approximation_bound(k):
+    """
+    How far the approx-mode structuring element is from OpenCV's k x k ellipse.
+
+    Returns a dict with
+      se_mismatch_px   pixels in the symmetric difference of the two SEs
+      edge_shift_px    Hausdorff distance between the two SEs; a single
+                       dilation/erosion can only differ from exact mode within
+                       this distance of an object edge (2x for close/open)
+    """
+    if k % 2 == 0:
+        return {"se_mismatch_px": 0, "edge_shift_px": 0.0}  # even sizes always run exactly
+    _, _, approx = _octagon_params(k)
+    exact = _embedded_ellipse(k, approx.shape[0])
+
+    def _directed(a, b):
+        pa = np.argwhere(a)
+        pb = np.argwhere(b)
+        if pa.size == 0 or pb.size == 0:
+            return 0.0
+        d = np.sqrt(((pa[:, None, :] - pb[None, :, :]) ** 2).sum(-1))
+        return float(d.min(axis=1).max())
+
+    return {
+        "se_mismatch_px": int(np.count_nonzero(exact ^ approx)),
+        "edge_shift_px": max(_directed(exact, approx), _directed(approx, exact)),
+    }
+
+
+def compare_modes(mask, k_close=0, k_open=0, shape="ellipse"):
+    """Measure the pixel difference between exact and approx close/open on one mask."""
+    a = close_open(mask, k_close, k_open, shape=shape, mode="exact")
+    b = close_open(mask, k_close, k_open, shape=shape, mode="approx")
+    n_diff = int(np.count_nonzero(a != b))
+    return {"diff_px": n_diff, "diff_frac": n_diff / a.size if a.size else 0.0}
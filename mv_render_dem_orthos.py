@@ -1,8 +1,9 @@
 import os
 import shutil
-import glob
+import fnmatch
 import argparse
 from typing import Iterable, List
+import catalog
 
 def move_image_files(base_path: str,
                      folder_pattern: str,
@@ -21,17 +22,18 @@ def move_image_files(base_path: str,
     # Make suffix matching case-insensitive
     suffixes = tuple(s.lower() for s in file_suffixes)
 
-    # Ensure the pattern is recursive (**), and add wildcards if user passed a bare token
+    # Add wildcards if user passed a bare token
     if not any(ch in folder_pattern for ch in "*?["):
         folder_pattern = f"*{folder_pattern}*"
-    pattern = os.path.join(os.path.abspath(base_path), "**", folder_pattern)
 
-    # Find all matching folders (recursive)
-    folders = [p for p in glob.glob(pattern, recursive=True) if os.path.isdir(p)]
+    # Find all matching folders (recursive) from the catalog instead of a recursive glob
+    cat = catalog.load(base_path)
+    folders = [d for d, _, _ in catalog.walk(cat)
+               if d != cat["base"] and fnmatch.fnmatch(os.path.basename(d), folder_pattern)]
 
     for folder in folders:
         dest_dir = os.path.join(folder, dest_subfolder)
-        for root, _, files in os.walk(folder):
+        for root, _, files in catalog.walk(cat, folder):
             # Skip scanning the destination folder itself
             if os.path.abspath(root).startswith(os.path.abspath(dest_dir) + os.sep):
                 continue
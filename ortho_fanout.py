@@ -0,0 +1,369 @@
+"""
+ortho_fanout.py
+---------------
+One decode of the multispectral ortho, shared by several consumers through
+multiprocessing.shared_memory, instead of each stage decoding the whole file
+again.
+
+    producer (this process) ── ortho rows r0..r1 ──> ring slot k ──┬─> crop: ortho chips (<tpath>/ortho_by_plot)
+                                                                   └─> vi:   VI chips (<tpath>/<VI>_by_plot)
+
+The producer reads full-width row bands (a multiple of the file's block
+height) straight into a ring of SLOTS shared-memory slots and hands each
+slot to every consumer process. Consumers map the slots once and read the
+rows in place (no copy through a pipe). A slot is reused when all consumers
+have released it, so at most SLOTS bands are in memory however large the
+ortho is; --memory-budget sizes the bands (SLOTS bands must fit).
+
+  crop  the ortho chips of step 3 (3_cropFromOrthomosaic2.py), pixel for
+        pixel: each plot's window is assembled from the bands it spans,
+        pixels outside the polygon set to nodata, written with the shared
+        profile (raster_profile.py)
+  vi    the VI layers of step 2 (2_multiOmRasterCalculation4.py), computed
+        per plot window with numpy from the same expressions, and written
+        directly as chips. The full-field VI rasters, which step 3 crops and
+        then deletes, are never written. As in QGIS's raster calculator the
+        values are computed in double precision and stored as float32, and
+        nodata input pixels, division by zero and undefined results (sqrt or
+        log10 of negatives, ...) become nodata (-FLT_MAX)
+
+The render (step 1) stays with QGIS: its contrast stretch needs the band
+statistics of the whole ortho before the first pixel is written.
+
+With both consumers, crop must skip the ortho afterwards:
+crop_folder(..., skip=('ortho.tif',)), as pipeline.py --fanout does.
+
+Usage:
+    python ortho_fanout.py -sgt D:\\test\\20240214_Swb_Cl\\orthos -shp D:\\test\\plots.shp -tpath D:\\test\\20240214_Swb_Cl
+    python ortho_fanout.py -sgt ..\\orthos\\20240214_ortho.tif -shp plots.shp -tpath .. --vi NDVI,OSAVI --memory-budget 1GB
+"""
+
+import os
+import queue
+import argparse
+import importlib
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import rasterio
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import Window
+import raster_profile
+import tracing
+import windowed
+
+SLOTS = 4
+DEFAULT_BAND_ROWS = 512
+CONSUMERS = ("crop", "vi")
+VI_NODATA = -3.4028234663852886e+38   # QgsRasterCalculator's output nodata (-FLT_MAX)
+
+# ortho band order (step 2): B@1, G@2, R@3, RE@4, NIR@5
+VI_BANDS = ("B", "G", "R", "RE", "NIR")
+
+# the VI layers of step 2, in its raster calculator syntax (^ is power);
+# the key is the file suffix (<ortho>_NDVI.tif -> NDVI_by_plot)
+VI_EXPRESSIONS = {
+    "ARI2": "(1 / (G) - 1 / (RE)) * ( NIR)",
+    "ARVI2": "-0.18 + 1.17 * (( NIR - R ) / ( NIR + R ))",
+    "ATSAVI": "1.22 * (NIR - 1.22 * R - 0.03)/(1.22 * NIR + R - 1.22 * 0.03 + 0.08 * (1 + 1.22 * 1.22))",
+    "B": "B",
+    "BNDVI": "( NIR - B ) / ( NIR + B )",
+    "CCCI": "( NIR - RE ) * ( NIR + R ) / ( NIR + RE ) / ( NIR - R )",
+    "CI": "( R - B ) / ( R )",
+    "CIG": "( NIR / G ) - 1",
+    "CIRE": "(NIR / RE) - 1",
+    "CIVE": "0.441 * R - 0.811 * G + 0.385 * B + 18.78745",
+    "CVI": "( NIR * ( R ) / ( G * G ))",
+    "DVI": "(NIR) / (R)",
+    "EVI": "2.5 * (( NIR - R ) / (( NIR + 6 * R - 7.5 * B ) + 1))",
+    "EVI2": "2.4 * ( NIR - R ) / ( NIR + R + 1 )",
+    "ExG": "2 * G - R - B",
+    "G": "G",
+    "GARI": "( NIR - (G - (B - R)) ) / ( NIR - (G + (B - R)) )",
+    "GBNDVI": "( NIR - (G + B) ) / ( NIR + (G + B) )",
+    "GDVI": "( NIR - G )",
+    "GEMI": "((2 * ((NIR ^ 2) - (R ^ 2)) + 1.5 * NIR + 0.5 * R)/(NIR + R + 0.5))"
+            "*(1 - 0.25*((2 * ((NIR ^ 2) - (R ^ 2)) + 1.5 * NIR + 0.5 * R)/(NIR + R + 0.5)))"
+            " - (R - 0.125)/(1 - R)",
+    "GLI": "(2 * G - R - B) / (2 * G + R + B)",
+    "GRNDVI": "( NIR - (G + R) ) / ( NIR + (G + R) )",
+    "GRVI": "(NIR) / (G)",
+    "GSAVI": "( NIR - G ) / ( NIR + G + 0.5 ) * (1.5)",
+    "H": "atan((2 * R - G - B) / (30.5 * (G - B)))",
+    "I": "(1 / 30.5) * (R + G + B)",
+    "IF": "(2 * R - G - B) / (G - B)",
+    "IO": "(R) / (B)",
+    "IPVI": "( NIR / (( NIR + R ) / 2) ) * (( NIR - R ) / ( NIR + R ) + 1)",
+    "LogR": "log10(NIR / R)",
+    "MSAVI": "((2 * NIR + 1) - ((((2 * NIR + 1) ^ 2) - 8 * (NIR - R)) ^ (1/2))) / 2",
+    "MSRNirRed": "(( NIR / R ) - 1) / (sqrt( NIR / R ) + 1)",
+    "NDRE": "( NIR - RE ) / ( NIR + RE )",
+    "NDVI": "( NIR - R ) / ( NIR + R )",
+    "NDVIrededge": "( RE - R ) / ( RE + R )",
+    "NGRDI": "( G - R ) / ( G + R )",
+    "NIR": "NIR",
+    "NormG": "(G) / (NIR + R + G)",
+    "NormNIR": "(NIR) / (NIR + R + G)",
+    "NormR": "(R) / (NIR + R + G)",
+    "OSAVI": "( NIR - R ) / ( NIR + R + 0.16 ) * ( 1 + 0.16 )",
+    "PNDVI": "( NIR - (G + R + B) ) / ( NIR + (G + R + B) )",
+    "R": "R",
+    "RBNDVI": "( NIR - (R + B) ) / ( NIR + (R + B) )",
+    "RE": "RE",
+    "RGR": "(R) / (G)",
+    "RI": "( R - G ) / ( R + G )",
+    "RRI1": "(NIR) / (RE)",
+    "RRI2": "(RE) / (R)",
+    "SQRTIRR": "sqrt(NIR / R)",
+    "SRNIRRed": "(NIR) / (R)",
+    "TNDVI": "sqrt((NIR - R) / (NIR + R) + 0.5)",
+    "WDRVI": "(0.1 * NIR - R) / (0.1 * NIR + R)",
+}
+
+_FUNCS = {"sqrt": np.sqrt, "log10": np.log10, "atan": np.arctan}
+
+
+def _crop_module():
+    return importlib.import_module("3_cropFromOrthomosaic2")
+
+
+# ---------- consumers ----------
+
+def _plot_windows(src, plots):
+    """Per plot: its window rows/cols, outside-polygon mask and transform, as mask(crop=True) computes them."""
+    out = []
+    for plot_id, geom in plots:
+        shape_mask, transform, window = raster_geometry_mask(src, [geom], crop=True)
+        r0, c0 = int(window.row_off), int(window.col_off)
+        out.append({"id": plot_id, "rows": (r0, r0 + shape_mask.shape[0]),
+                    "cols": (c0, c0 + shape_mask.shape[1]), "mask": shape_mask, "transform": transform})
+    return sorted(out, key=lambda p: p["rows"][0])
+
+
+def _assembler(plots, bands, dtype, on_chip):
+    """
+    feed(r0, block) for (count, rows, width) row bands in order: copies each
+    plot's part of the band into its chip and calls on_chip(plot) once the
+    chip is complete. Only chips spanning the current band are held.
+    """
+    active, nxt = [], 0
+
+    def feed(r0, block):
+        nonlocal nxt
+        r1 = r0 + block.shape[1]
+        while nxt < len(plots) and plots[nxt]["rows"][0] < r1:
+            p = plots[nxt]
+            p["chip"] = np.empty((len(bands),) + p["mask"].shape, dtype=dtype)
+            active.append(p)
+            nxt += 1
+        for p in list(active):
+            (p0, p1), (c0, c1) = p["rows"], p["cols"]
+            a, b = max(p0, r0), min(p1, r1)
+            if a < b:
+                p["chip"][:, a - p0:b - p0] = block[bands, a - r0:b - r0, c0:c1]
+            if p1 <= r1:
+                active.remove(p)
+                on_chip(p)
+                del p["chip"]
+
+    return feed
+
+
+def _crop_sink(src, plots, target_path, vis):
+    """Ortho chips as step 3 writes them."""
+    name = os.path.splitext(os.path.basename(src.name))[0].split('_')[-1]
+    folder = os.path.join(target_path, name + "_by_plot")
+    os.makedirs(folder, exist_ok=True)
+    meta = src.meta
+    nodata = src.nodata if src.nodata is not None else 0
+
+    def write(p):
+        chip = p["chip"]
+        chip[:, p["mask"]] = nodata
+        out_meta = raster_profile.output_profile(meta, raster_profile.chip_layer(name),
+                                                 height=chip.shape[1], width=chip.shape[2],
+                                                 transform=p["transform"])
+        with rasterio.open(os.path.join(folder, p["id"] + ".tif"), "w", **out_meta) as dest:
+            dest.write(chip)
+            raster_profile.add_overviews(dest, "average")
+
+    return _assembler(plots, list(range(src.count)), np.dtype(src.dtypes[0]), write)
+
+
+def _vi_sink(src, plots, target_path, vis):
+    """VI chips: step 2's layers computed on each plot window."""
+    if src.count < len(VI_BANDS):
+        raise ValueError(f"{src.name}: {src.count} band(s), the VI layers need {len(VI_BANDS)} ({', '.join(VI_BANDS)})")
+    codes = [(vi, compile(VI_EXPRESSIONS[vi].replace("^", "**"), vi, "eval")) for vi in vis]
+    folders = {vi: os.path.join(target_path, vi + "_by_plot") for vi in vis}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    meta = dict(src.meta, count=1, dtype="float32", nodata=VI_NODATA)
+    nodata = src.nodata
+
+    def write(p):
+        chip = p["chip"]
+        bad = p["mask"].copy()
+        if nodata is not None:
+            bad |= (chip == nodata).any(axis=0)
+        env = {b: chip[i].astype(np.float64) for i, b in enumerate(VI_BANDS)}
+        env.update(_FUNCS)
+        for vi, code in codes:
+            with np.errstate(all="ignore"):
+                val = np.asarray(eval(code, {"__builtins__": {}}, env), dtype=np.float64).astype(np.float32)
+            val[bad | ~np.isfinite(val)] = VI_NODATA
+            out_meta = raster_profile.output_profile(meta, raster_profile.chip_layer(vi),
+                                                     height=val.shape[0], width=val.shape[1],
+                                                     transform=p["transform"])
+            with rasterio.open(os.path.join(folders[vi], p["id"] + ".tif"), "w", **out_meta) as dest:
+                dest.write(val, 1)
+                raster_profile.add_overviews(dest, "average")
+
+    return _assembler(plots, list(range(len(VI_BANDS))), np.dtype(src.dtypes[0]), write)
+
+
+SINKS = {"crop": _crop_sink, "vi": _vi_sink}
+
+
+def _consume(name, ortho, shape_file, target_path, vis, shm_names, count, width, dtype, inbox, release):
+    """Consumer process: map the ring, feed every band handed over, release its slot."""
+    shms = [shared_memory.SharedMemory(name=n) for n in shm_names]
+    try:
+        with rasterio.open(ortho) as src:
+            feed = SINKS[name](src, _plot_windows(src, _crop_module().read_plots(shape_file)), target_path, vis)
+        while True:
+            msg = inbox.get()
+            if msg is None:
+                break
+            k, r0, n = msg
+            block = np.ndarray((count, n, width), dtype=dtype, buffer=shms[k].buf)
+            with tracing.span("fanout." + name, rows=n):
+                feed(r0, block)
+            del block
+            release.put(("done", k))
+    except Exception:
+        release.put(("error", name, traceback.format_exc()))
+    finally:
+        for shm in shms:
+            shm.close()
+
+
+# ---------- producer ----------
+
+def _collect(release, pending, free, procs):
+    """Wait for one release; a slot released by every consumer goes back to `free`."""
+    while True:
+        try:
+            msg = release.get(timeout=1.0)
+            break
+        except queue.Empty:
+            # a consumer that finished exits with 0 (after its releases), one that failed
+            # sent an "error" first; anything else crashed
+            dead = [p for p in procs if p.exitcode not in (None, 0)]
+            if dead:
+                raise RuntimeError(f"{dead[0].name} exited (code {dead[0].exitcode}) before the last band")
+    if msg[0] == "error":
+        raise RuntimeError(f"{msg[1]} consumer failed:\n{msg[2]}")
+    k = msg[1]
+    pending[k] -= 1
+    if pending[k] == 0:
+        free.append(k)
+
+
+@tracing.traced()
+def fanout(ortho, shape_file, target_path, consumers=CONSUMERS, vis=None, slots=SLOTS, memory_budget=None):
+    """Decode `ortho` once and feed every consumer ('crop', 'vi') from the shared ring."""
+    vis = list(vis) if vis else list(VI_EXPRESSIONS)
+    unknown = [c for c in consumers if c not in SINKS] + [v for v in vis if v not in VI_EXPRESSIONS]
+    if unknown:
+        raise ValueError(f"Unknown consumer(s)/VI layer(s): {unknown}")
+    os.makedirs(target_path, exist_ok=True)
+
+    with rasterio.open(ortho) as src:
+        count, height, width = src.count, src.height, src.width
+        dtype = np.dtype(src.dtypes[0])
+        bh = src.block_shapes[0][0]
+        rows = windowed.band_rows(width, src.block_shapes[0], count * dtype.itemsize * slots, memory_budget,
+                                  default=max(bh, DEFAULT_BAND_ROWS // bh * bh))
+        rows = min(rows, height)
+        ctx = multiprocessing.get_context()
+        shms, procs = [], []
+        try:
+            shms = [shared_memory.SharedMemory(create=True, size=count * rows * width * dtype.itemsize)
+                    for _ in range(slots)]
+            release = ctx.Queue()
+            inboxes = [ctx.Queue() for _ in consumers]
+            procs = [ctx.Process(target=_consume, name=f"fanout-{c}", daemon=True,
+                                 args=(c, ortho, shape_file, target_path, vis, [s.name for s in shms],
+                                       count, width, dtype.str, q, release))
+                     for c, q in zip(consumers, inboxes)]
+            for p in procs:
+                p.start()
+
+            free, pending = list(range(slots)), [0] * slots
+            for r0 in range(0, height, rows):
+                while not free:
+                    _collect(release, pending, free, procs)
+                k = free.pop(0)
+                n = min(rows, height - r0)
+                block = np.ndarray((count, n, width), dtype=dtype, buffer=shms[k].buf)
+                with tracing.span("fanout.decode", rows=n):
+                    src.read(window=Window(0, r0, width, n), out=block)
+                del block
+                pending[k] = len(procs)
+                for q in inboxes:
+                    q.put((k, r0, n))
+            for q in inboxes:
+                q.put(None)
+            while any(pending):
+                _collect(release, pending, free, procs)
+            for p in procs:
+                p.join()
+        finally:
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+    print(f"[OK] {os.path.basename(ortho)}: {', '.join(consumers)} from one read "
+          f"({-(-height // rows)} band(s) of {rows} rows)")
+
+
+def fanout_folder(src_folder, shape_file, target_path, **kwargs):
+    """fanout() for every *ortho.tif in src_folder."""
+    hits = [f for f in sorted(os.listdir(src_folder)) if f.endswith("ortho.tif")]
+    if not hits:
+        print(f"[WARN] No ortho.tif in {src_folder}")
+    for f in hits:
+        fanout(os.path.join(src_folder, f), shape_file, target_path, **kwargs)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Decode the ortho once and write its chips and VI chips from shared memory.")
+    ap.add_argument("-sgt", "--geoTiff", required=True,
+                    help="Ortho (...ortho.tif) or folder containing it")
+    ap.add_argument("-shp", "--shapeFile", required=True,
+                    help="Plot shapefile")
+    ap.add_argument("-tpath", "--targetPath", required=True,
+                    help="Target path (the date folder; chips go to <layer>_by_plot)")
+    ap.add_argument("--consumers", type=str, default=",".join(CONSUMERS),
+                    help=f"Comma-separated consumers (default: {','.join(CONSUMERS)}).")
+    ap.add_argument("--vi", type=str, default=None,
+                    help="Comma-separated VI layers to write (default: all of step 2's).")
+    ap.add_argument("--slots", type=int, default=SLOTS, help=f"Ring slots (default: {SLOTS}).")
+    ap.add_argument("--memory-budget", type=str, default=None,
+                    help="Memory for the ring (e.g. 1GB); sets the rows per band.")
+    ap.add_argument("--trace", type=str, default=None,
+                    help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
+    args = ap.parse_args()
+    tracing.start(args.trace)
+
+    kwargs = dict(consumers=[c.strip() for c in args.consumers.split(",") if c.strip()],
+                  vis=[v.strip() for v in args.vi.split(",") if v.strip()] if args.vi else None,
+                  slots=args.slots, memory_budget=windowed.parse_budget(args.memory_budget))
+    if os.path.isdir(args.geoTiff):
+        fanout_folder(args.geoTiff, args.shapeFile, args.targetPath, **kwargs)
+    else:
+        fanout(args.geoTiff, args.shapeFile, args.targetPath, **kwargs)
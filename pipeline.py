@@ -0,0 +1,482 @@
+"""
+pipeline.py
+-----------
+Runs the processing stages in-process as a DAG of (date folder x stage) units
+on a process pool, instead of chaining the CLI scripts by hand.
+
+    render ─┐
+    vi ─────┴─ crop ─ masks ─┬─ overlap ─────────────┬─ spectral ─┬─ merge (all dates)
+                             │                       ├─ dem ──────┘
+                             └─ mulch ─ mulch_height ┘
+    gsd (all dates) ─────────────────────────────────┘
+
+A unit runs as soon as its own date's dependencies are done, so a late date's
+crop can run while an early date's traits finish. Workers import the stage
+modules once and keep them loaded. Catalogs are refreshed per unit in memory
+only; the orchestrator saves the index before and after the run.
+
+render and vi need QGIS. They still run as subprocesses with the QGIS Python
+interpreter (--qgis-python). With --fanout the vi stage runs ortho_fanout.py
+instead: one read of the ortho feeds both the VI chips and the ortho chips,
+and crop leaves the ortho alone.
+
+With --stage-dir each date is copied to local scratch first (stage_in unit),
+its stages run on the local copy, and their outputs are copied back
+(stage_out unit, which also runs after a failed stage so finished outputs
+are not lost) before merge reads the trait store. Staged dates stay cached
+under --stage-quota, least recently used evicted first (staging.py).
+
+Intermediates (scratch.py: the VI rasters step 2 writes for crop) are deleted
+once every consumer of their date has finished; a failed crop keeps them for
+the re-run. With --scratch-quota a producer (vi) waits while the
+intermediates on disk plus its estimated output would pass the quota, so
+earlier dates are cropped and reclaimed before later ones are computed.
+
+With --with-mulch the overlap stage also writes the mulch masks (step 5's
+fused pass) and the mulch stage is dropped. With --joint the dem stage takes
+its mulch baseline from the mulch masks and mulch_height is dropped. A unit
+whose dependency failed is skipped. The other dates carry on.
+
+Usage:
+    python pipeline.py D:\\test --shp D:\\test\\plots.shp --folder-pattern "*_Swb_Cl*"
+    python pipeline.py D:\\test --stages masks,overlap,mulch,mulch_height,dem,spectral,merge --workers 4
+"""
+
+import os
+import sys
+import time
+import fnmatch
+import argparse
+import importlib
+import subprocess
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import catalog
+import tracing
+import windowed
+import ortho_fanout
+import prefetch
+import scratch
+import staging
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# stage -> (scope, dependencies); "date" stages depend on the same date's units,
+# "global" stages on every date's (or, from a date stage, the global unit)
+STAGES = {
+    "gsd":          ("global", ()),
+    "render":       ("date", ()),
+    "vi":           ("date", ()),
+    "crop":         ("date", ("render", "vi")),
+    "masks":        ("date", ("crop",)),
+    "overlap":      ("date", ("masks",)),
+    "mulch":        ("date", ("masks",)),
+    "mulch_height": ("date", ("mulch",)),
+    "dem":          ("date", ("overlap", "mulch_height", "gsd")),
+    "spectral":     ("date", ("overlap",)),
+    "merge":        ("global", ("dem", "spectral")),
+}
+
+MODULES = {
+    "gsd": "0_gsd_from_rasters",
+    "crop": "3_cropFromOrthomosaic2",
+    "masks": "4_generate_mask_on_1orbatch",
+    "overlap": "5_masks_overlapping_batch_veg",
+    "mulch": "6_masks_overlapping_batch_mulch",
+    "mulch_height": "7_mulch_height_extract",
+    "dem": "8_trait_extract_dem",
+    "spectral": "9_trait_extract_spectral",
+    "merge": "10_merge_dem_nodem",
+}
+
+# stage options (the CLI flags of the scripts); run() fills in what is not given
+DEFAULT_OPTS = {
+    "shp": None, "ortho_subdir": "orthos", "qgis_python": sys.executable,
+    "vi_subdir": "OSAVI_by_plot", "vi_lt": None, "vi_ut": None, "vi_morph": 5,
+    "op": "AND", "post_close": 15, "post_open": 2, "morph_mode": "exact",
+    "with_mulch": False, "joint": False, "approx": False, "excel": False, "force": False,
+    "memory_budget": None, "fanout": False, "prefetch": prefetch.DEFAULT_DEPTH,
+    "stage_dir": None, "stage_quota": None, "scratch_quota": None, "keep_intermediates": False,
+}
+
+# date units added around a date's stages with --stage-dir
+STAGING = ("stage_in", "stage_out")
+
+SKIP_DIRS = ("metashape_report", "trait_store", "mulch_height", "dem_trait", "nodem_trait", "merged_trait")
+
+
+def _module(stage):
+    # imported once per worker process and kept in sys.modules
+    return importlib.import_module(MODULES[stage])
+
+
+def _qgis(script, opts, *args):
+    subprocess.run([opts["qgis_python"], os.path.join(HERE, script), *args], check=True, cwd=HERE)
+
+
+# ---------- tasks: one per stage, called as task(base, folder, opts) ----------
+
+def task_gsd(base, folder, opts):
+    _module("gsd").main(base, cat=catalog.load(base, persist=False))
+
+
+def task_render(base, folder, opts):
+    orthos = os.path.join(folder, opts["ortho_subdir"])
+    cat = catalog.load(base, subtree=folder, persist=False)
+    hits = [f for f in catalog.listdir(cat, orthos) if f.endswith("ortho.tif")]
+    if not hits:
+        print(f"[skip] no ortho.tif in {orthos}")
+        return
+    _qgis("1_rasterRenderRGB.py", opts, "-s", os.path.join(orthos, hits[0]))
+
+
+def task_vi(base, folder, opts):
+    if opts["fanout"]:
+        if not opts["shp"]:
+            raise ValueError("vi with --fanout needs --shp")
+        ortho_fanout.fanout_folder(os.path.join(folder, opts["ortho_subdir"]), opts["shp"], folder,
+                                   memory_budget=opts["memory_budget"])
+        return
+    _qgis("2_multiOmRasterCalculation4.py", opts, "-s", os.path.join(folder, opts["ortho_subdir"]))
+
+
+def task_crop(base, folder, opts):
+    if not opts["shp"]:
+        raise ValueError("crop needs --shp")
+    _module("crop").crop_folder(os.path.join(folder, opts["ortho_subdir"]), opts["shp"], folder,
+                                skip=("ortho.tif",) if opts["fanout"] else (), reclaim=False)
+
+
+def task_masks(base, folder, opts):
+    cat = catalog.load(base, subtree=folder, persist=False)
+    _module("masks").generate_masks_for_date(folder, vi_subdir=opts["vi_subdir"], vi_lt=opts["vi_lt"],
+                                             vi_ut=opts["vi_ut"], morph_close=opts["vi_morph"],
+                                             cat=cat, force=opts["force"], memory_budget=opts["memory_budget"])
+
+
+def task_overlap(base, folder, opts):
+    cat = catalog.load(base, subtree=folder, persist=False)
+    mulch = os.path.join(folder, "masks_overlapping_mulch") if opts["with_mulch"] else None
+    _module("overlap").find_overlapping_masks(os.path.join(folder, "masks"),
+                                              os.path.join(folder, "masks_overlapping"),
+                                              op=opts["op"], post_close=opts["post_close"],
+                                              post_open=opts["post_open"], morph_mode=opts["morph_mode"],
+                                              mulch_folder=mulch, cat=cat, force=opts["force"],
+                                              memory_budget=opts["memory_budget"])
+
+
+def task_mulch(base, folder, opts):
+    cat = catalog.load(base, subtree=folder, persist=False)
+    _module("mulch").combine_mulch_masks(os.path.join(folder, "masks"),
+                                         os.path.join(folder, "masks_overlapping_mulch"),
+                                         cat=cat, force=opts["force"], memory_budget=opts["memory_budget"])
+
+
+def task_mulch_height(base, folder, opts):
+    cat = catalog.load(base, subtree=folder, persist=False)
+    _module("mulch_height").trait_extract_dem(folder, approx=opts["approx"], excel=opts["excel"],
+                                              cat=cat, force=opts["force"], prefetch_depth=opts["prefetch"])
+
+
+def task_dem(base, folder, opts):
+    cat = catalog.load(base, subtree=folder, persist=False)
+    _module("dem").trait_extract_dem(folder, approx=opts["approx"],
+                                     mulch_mask_subdir="masks_overlapping_mulch" if opts["joint"] else None,
+                                     excel=opts["excel"], cat=cat, force=opts["force"],
+                                     prefetch_depth=opts["prefetch"])
+
+
+def task_spectral(base, folder, opts):
+    cat = catalog.load(base, subtree=folder, persist=False)
+    _module("spectral").trait_extract_nodem(folder, excel=opts["excel"], cat=cat, force=opts["force"],
+                                            prefetch_depth=opts["prefetch"])
+
+
+def task_merge(base, folder, opts):
+    _module("merge").merge_all(Path(base), excel=opts["excel"])
+
+
+def task_stage_in(base, folder, opts):
+    staging.stage_in(base, folder, opts["stage_dir"], quota=opts["stage_quota"])
+
+
+def task_stage_out(base, folder, opts):
+    staging.stage_out(base, folder, opts["stage_dir"])
+
+
+TASKS = {stage: globals()[f"task_{stage}"] for stage in tuple(STAGES) + STAGING}
+
+
+def _run_unit(stage, base, folder, opts):
+    """Worker entry point; returns the wall time in seconds."""
+    t0 = time.perf_counter()
+    with tracing.span(stage, cat="pipeline", date=os.path.basename(folder) if folder else None):
+        TASKS[stage](base, folder, opts)
+    return time.perf_counter() - t0
+
+
+# ---------- DAG ----------
+
+def stage_deps(stages, with_mulch=False, joint=False):
+    """Dependencies among the selected `stages`, after --with-mulch / --joint rewiring."""
+    deps = {s: list(STAGES[s][1]) for s in STAGES}
+    if with_mulch:   # overlap writes the mulch masks
+        deps["mulch_height"] = ["overlap"]
+    if joint:        # mulch baseline from the mulch masks, not from step 7
+        deps["dem"] = ["overlap", "mulch", "gsd"]
+
+    def resolve(stage, seen=()):
+        # a dependency that is not selected is taken as done already, but
+        # its own selected dependencies still apply (e.g. dem -> [mulch_height] -> mulch)
+        out = []
+        for d in deps[stage]:
+            if d in stages:
+                out.append(d)
+            elif d not in seen:
+                out.extend(resolve(d, seen + (d,)))
+        return list(dict.fromkeys(out))
+
+    return {s: resolve(s) for s in stages}
+
+
+def build_units(base, stages, folder_pattern, with_mulch=False, joint=False, staged=False):
+    """
+    Units as {(stage, folder): [dependency units]}; global units have folder None.
+    Stages are kept in STAGES order. `staged` wraps each date's units in
+    stage_in / stage_out units.
+    """
+    stages = [s for s in STAGES if s in stages]
+    deps = stage_deps(stages, with_mulch=with_mulch, joint=joint)
+    cat = catalog.load(base)
+    folders = [os.path.join(base, name) for name in catalog.subdirs(cat)
+               if name not in SKIP_DIRS and fnmatch.fnmatch(name, folder_pattern)]
+
+    units = {}
+    for s in stages:
+        scope = STAGES[s][0]
+        for folder in (folders if scope == "date" else [None]):
+            need = []
+            for d in deps[s]:
+                if STAGES[d][0] == "global":
+                    need.append((d, None))
+                elif folder is None:
+                    need.extend((d, f) for f in folders)
+                else:
+                    need.append((d, folder))
+            units[(s, folder)] = need
+    if staged and any(STAGES[s][0] == "date" for s in stages):
+        units = _with_staging(units, folders, stages)
+    return units, folders
+
+
+def _with_staging(units, folders, stages):
+    """stage_in before a date's first stage (after gsd), stage_out after its last; merge after stage_out."""
+    first = {u: need for u, need in units.items() if u[1] is None and not any(d[1] for d in need)}
+    last = {u: need for u, need in units.items() if u[1] is None and u not in first}
+    out = dict(first)
+    for f in folders:
+        out[("stage_in", f)] = [("gsd", None)] if "gsd" in stages else []
+    for u, need in units.items():
+        if u[1] is not None:
+            out[u] = need + [("stage_in", u[1])]
+    for f in folders:
+        out[("stage_out", f)] = [u for u in units if u[1] == f]
+    for u, need in last.items():
+        out[u] = need + [("stage_out", f) for f in folders]
+    return out
+
+
+def run(base, stages=tuple(STAGES), folder_pattern="*", workers=None, **opts):
+    """Run the DAG; returns {unit: "ok" | "failed" | "skipped"}."""
+    base = os.path.abspath(base)
+    opts = {**DEFAULT_OPTS, **opts}
+    with_mulch, joint = opts["with_mulch"], opts["joint"]
+    if with_mulch:
+        stages = [s for s in stages if s != "mulch"]
+    if joint:
+        stages = [s for s in stages if s != "mulch_height"]
+    if "vi" not in stages:   # no fan-out ran, crop still cuts the ortho
+        opts["fanout"] = False
+    stage_dir = opts["stage_dir"]
+    units, folders = build_units(base, stages, folder_pattern, with_mulch=with_mulch, joint=joint,
+                                 staged=bool(stage_dir))
+    if not folders:
+        print(f"[WARN] No date folders matched '{folder_pattern}' under {base}")
+    order = {s: i for i, s in enumerate(("stage_in",) + tuple(STAGES) + ("stage_out",))}
+
+    def blockers(unit):
+        # stage_out copies back whatever its date produced, so it only needs stage_in
+        return [("stage_in", unit[1])] if unit[0] == "stage_out" else units[unit]
+
+    def runnable(unit):
+        if unit[0] == "stage_out":
+            return all(d in status for d in units[unit]) and status.get(("stage_in", unit[1])) == "ok"
+        return all(status.get(d) == "ok" for d in units[unit])
+
+    def paths(unit):
+        # a staged date's stages run on the local mirror (base included, for trait_store / metashape_report)
+        stage, folder = unit
+        if stage_dir and folder and stage not in STAGING:
+            return staging.mirror_root(base, stage_dir), staging.local_folder(base, folder, stage_dir)
+        return base, folder
+
+    def label(unit):
+        stage, folder = unit
+        return f"{stage}:{os.path.basename(folder)}" if folder else stage
+
+    ortho_subdir, quota = opts["ortho_subdir"], opts["scratch_quota"]
+    # bytes of intermediates on disk (or reserved by a running producer), per (artifact, date folder)
+    live = {(a, f): scratch.size(scratch.artifact_dir(f, a, ortho_subdir), a)
+            for a in scratch.INTERMEDIATES for f in folders}
+    held = set()
+
+    def produces(stage):
+        # with --fanout, vi writes chips straight from the ortho and no VI rasters
+        return [] if stage == "vi" and opts["fanout"] else scratch.produced_by(stage)
+
+    def admit(unit, force=False):
+        """Reserve the producer's estimated output; False to hold it back until consumers free space."""
+        need = {a: scratch.estimate(paths(unit)[1], a, ortho_subdir) for a in produces(unit[0])}
+        used = sum(live.values())
+        if quota is not None and need and used + sum(need.values()) > quota:
+            mb = f"{used / 2**20:.0f} MB in use + {sum(need.values()) / 2**20:.0f} MB, quota {quota / 2**20:.0f} MB"
+            if not force:
+                if unit not in held:
+                    print(f"[SCRATCH] {label(unit)} waits for space: {mb}")
+                    held.add(unit)
+                return False
+            print(f"[WARN] {label(unit)} starts over the scratch quota ({mb}): nothing else can run")
+        held.discard(unit)
+        for a, n in need.items():
+            live[(a, unit[1])] = max(live[(a, unit[1])], n)
+        return True
+
+    def settle(unit):
+        """Measure what a producer wrote; reclaim an artifact once every consumer of its date is done."""
+        stage, folder = unit
+        for a in produces(stage):
+            live[(a, folder)] = scratch.size(scratch.artifact_dir(paths(unit)[1], a, ortho_subdir), a)
+        if status[unit] != "ok" or opts["keep_intermediates"]:
+            return
+        for a in scratch.consumed_by(stage):
+            consumers = [(c, folder) for c in scratch.INTERMEDIATES[a][1] if (c, folder) in units]
+            if all(status.get(c) == "ok" for c in consumers):
+                scratch.reclaim(scratch.artifact_dir(paths(unit)[1], a, ortho_subdir), a)
+                live[(a, folder)] = 0
+
+    status, running = {}, {}
+    limit = workers or os.cpu_count() or 1
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=limit) as pool:
+        while len(status) < len(units):
+            # units listed in STAGES order, so one pass propagates a failure down the chain
+            for u in units:
+                if u not in status and any(status.get(d) in ("failed", "skipped") for d in blockers(u)):
+                    status[u] = "skipped"
+                    print(f"[WARN] {label(u)} skipped (dependency failed)")
+            # earliest date (then earliest stage) first, so dates finish in order
+            ready = sorted((u for u in units if u not in status and u not in running.values() and runnable(u)),
+                           key=lambda u: (u[1] is None, u[1] or "", order[u[0]]))
+            for u in ready:
+                if len(running) >= limit:
+                    break
+                if u[1] is not None and not admit(u):
+                    continue
+                running[pool.submit(_run_unit, u[0], *paths(u), opts)] = u
+            if ready and not running:   # only held-back producers left: run one rather than stall
+                admit(ready[0], force=True)
+                running[pool.submit(_run_unit, ready[0][0], *paths(ready[0]), opts)] = ready[0]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                u = running.pop(fut)
+                try:
+                    print(f"[OK] {label(u)} in {fut.result():.1f}s")
+                    status[u] = "ok"
+                except Exception as e:
+                    print(f"[WARN] {label(u)} failed: {e}")
+                    status[u] = "failed"
+                if u[1] is not None:
+                    settle(u)
+
+    catalog.load(base)   # one index save for everything the workers wrote
+    counts = {k: sum(v == k for v in status.values()) for k in ("ok", "failed", "skipped")}
+    print(f"[DONE] {len(units)} unit(s) in {time.perf_counter() - t0:.1f}s: {counts}")
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the processing stages as a date x stage DAG on a process pool.")
+    parser.add_argument("base_dir", type=str, help="Base directory with one folder per date")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES),
+                        help=f"Comma-separated stages to run (default: all of {','.join(STAGES)}).")
+    parser.add_argument("--skip", type=str, default="",
+                        help="Comma-separated stages to leave out (e.g. 'render,vi' outside the QGIS shell).")
+    parser.add_argument("--folder-pattern", type=str, default="*_Swb_Cl*",
+                        help="Glob for date folders (default: '*_Swb_Cl*').")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count).")
+    parser.add_argument("--shp", type=str, default=None, help="Plot shapefile for the crop stage.")
+    parser.add_argument("--ortho-subdir", type=str, default="orthos")
+    parser.add_argument("--qgis-python", type=str, default=sys.executable,
+                        help="Python interpreter with QGIS for render/vi (default: this one).")
+    parser.add_argument("--vi-subdir", type=str, default="OSAVI_by_plot")
+    parser.add_argument("--vi-lt", type=float, default=None)
+    parser.add_argument("--vi-ut", type=float, default=None)
+    parser.add_argument("--vi-morph", type=int, default=5)
+    parser.add_argument("--op", type=str, default="AND", choices=["AND", "OR"])
+    parser.add_argument("--post-close", type=int, default=15)
+    parser.add_argument("--post-open", type=int, default=2)
+    parser.add_argument("--morph-mode", type=str, default="exact", choices=["exact", "approx"])
+    parser.add_argument("--with-mulch", action="store_true",
+                        help="Write the mulch masks in the overlap pass (drops the mulch stage).")
+    parser.add_argument("--joint", action="store_true",
+                        help="Mulch baseline from the DEM trait pass (drops the mulch_height stage).")
+    parser.add_argument("--approx-stats", action="store_true")
+    parser.add_argument("--excel", action="store_true", help="Also write the per-date Excel tables.")
+    parser.add_argument("--force", action="store_true", help="Ignore the .run_state manifests.")
+    parser.add_argument("--memory-budget", type=str, default=None,
+                        help="Per worker: process rasters larger than this (e.g. 2GB) block by block "
+                             "in the masks/overlap/mulch stages.")
+    parser.add_argument("--prefetch", type=int, default=prefetch.DEFAULT_DEPTH,
+                        help="Plots read ahead on background threads in the mulch_height/dem/spectral stages "
+                             "(0 = read inline).")
+    parser.add_argument("--stage-dir", type=str, default=None,
+                        help="Local scratch directory: run each date on a local copy and sync it back (staging.py).")
+    parser.add_argument("--stage-quota", type=str, default=None,
+                        help="Disk quota for staged dates in --stage-dir (e.g. 200GB); least recently used evicted.")
+    parser.add_argument("--scratch-quota", type=str, default=None,
+                        help="Disk quota for intermediates (e.g. 100GB): vi waits until crop of earlier dates "
+                             "has freed their VI rasters (scratch.py).")
+    parser.add_argument("--keep-intermediates", action="store_true",
+                        help="Keep the VI rasters after crop instead of deleting them.")
+    parser.add_argument("--fanout", action="store_true",
+                        help="vi stage: write the VI and ortho chips from one shared read of the ortho "
+                             "(ortho_fanout.py) instead of QGIS step 2.")
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace of the run (chrome://tracing, Perfetto) to this JSON file.")
+    args = parser.parse_args()
+    tracing.start(args.trace)
+
+    skip = {s.strip() for s in args.skip.split(",") if s.strip()}
+    stages = [s.strip() for s in args.stages.split(",") if s.strip() and s.strip() not in skip]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise SystemExit(f"Unknown stage(s): {unknown}; choose from {list(STAGES)}")
+    if "crop" in stages and not args.shp:
+        raise SystemExit("The crop stage needs --shp (or --skip crop)")
+    if args.fanout and "vi" in stages and not args.shp:
+        raise SystemExit("The vi stage with --fanout needs --shp")
+
+    status = run(args.base_dir, stages=stages, folder_pattern=args.folder_pattern, workers=args.workers,
+                 shp=args.shp, ortho_subdir=args.ortho_subdir, qgis_python=args.qgis_python,
+                 vi_subdir=args.vi_subdir, vi_lt=args.vi_lt, vi_ut=args.vi_ut, vi_morph=args.vi_morph,
+                 op=args.op, post_close=args.post_close, post_open=args.post_open, morph_mode=args.morph_mode,
+                 with_mulch=args.with_mulch, joint=args.joint, approx=args.approx_stats,
+                 excel=args.excel, force=args.force, fanout=args.fanout, prefetch=args.prefetch,
+                 stage_dir=args.stage_dir, stage_quota=windowed.parse_budget(args.stage_quota),
+                 scratch_quota=windowed.parse_budget(args.scratch_quota),
+                 keep_intermediates=args.keep_intermediates,
+                 memory_budget=windowed.parse_budget(args.memory_budget))
+    if any(v != "ok" for v in status.values()):
+        sys.exit(1)
@@ -0,0 +1,53 @@
+"""
+prefetch.py
+-----------
+Bounded read-ahead for the per-plot loops of steps 7-9 (--prefetch N).
+While one plot is reduced, the chips and masks of the next N plots are
+decoded on background threads, so the loop waits on storage bandwidth
+instead of one round trip per file (NAS, network drives).
+
+    jobs = [(plot, dem_path, mask_path), ...]
+    for (plot, dem_path, mask_path), (dem, mask) in prefetch.prefetched(
+            jobs, lambda job: (read_chip(job[1]), read_chip(job[2])), depth=4):
+        ...
+
+Items come back in their original order, so tables and manifests are the
+same as with sequential reads. At most the current plot plus `depth` loaded
+plots are held in memory. cv2.imread and tifffile release the GIL while
+decoding, so threads are enough. depth 0 reads inline, as before.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_DEPTH = 4
+
+
+def prefetched(items, load, depth=DEFAULT_DEPTH):
+    """
+    Yield (item, load(item)) in order, with up to `depth` of the following
+    loads running on background threads. An exception raised by load() is
+    raised when its item is reached.
+    """
+    if not depth or depth <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+    items = iter(items)
+    pool = ThreadPoolExecutor(max_workers=depth, thread_name_prefix="prefetch")
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, pool.submit(load, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, fut = pending.popleft()
+            data = fut.result()
+            for nxt in items:   # refill: `depth` loads in flight while the caller works
+                pending.append((nxt, pool.submit(load, nxt)))
+                break
+            yield item, data
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
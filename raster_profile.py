@@ -0,0 +1,154 @@
+"""
+raster_profile.py
+-----------------
+One GeoTIFF creation profile for every raster the pipeline writes (crop
+chips, step 4-6 masks, the QGIS render), instead of whatever layout the
+source happened to have (usually striped, no overviews).
+
+  - internally tiled: TILE x TILE blocks (LARGE_TILE for rasters with a side
+    over LARGE_SIDE px), so windowed reads (windowed.py) decode only the
+    tiles they touch
+  - the codec of the layer type (mask, dem, vi, ortho, render) from
+    codec_profile.json, written by codec_bench.py from a sample of real
+    intermediates (UAV_CODEC_PROFILE points elsewhere). Without a profile
+    entry: DEFLATE with the predictor for the data type, 2 (horizontal
+    differencing) for integers and 3 (floating point) for floats. DEFLATE
+    and predictor 2 decode everywhere (GDAL, OpenCV, tifffile); predictor 3
+    needs imagecodecs for tifffile (step 9), as listed in requirements.txt
+  - BIGTIFF=IF_SAFER: BigTIFF only when the file could pass 4 GB
+  - internal overviews (2x, 4x, ... down to about one tile) on rasters with a
+    side of at least OVERVIEW_MIN_SIDE px; chips get none. UAV_OVERVIEWS=0
+    in the environment turns them off
+
+    profile = raster_profile.output_profile(src.profile, "mask", count=1, dtype="uint8", nodata=0)
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(mask, 1)
+        raster_profile.add_overviews(dst, "nearest")
+
+creation_options() returns the same settings as GDAL KEY=VALUE strings for
+writers outside rasterio (QgsRasterFileWriter in 1_rasterRenderRGB.py).
+rasterio is only imported inside add_overviews, so the QGIS Python can
+import this module.
+"""
+
+import os
+import json
+
+TILE = 256
+LARGE_TILE = 512
+LARGE_SIDE = 16384
+COMPRESS = "DEFLATE"
+BIGTIFF = "IF_SAFER"
+OVERVIEW_MIN_SIDE = 2048
+OVERVIEWS = os.environ.get("UAV_OVERVIEWS", "1") != "0"
+LAYERS = ("mask", "dem", "vi", "ortho", "render")
+PROFILE_PATH = (os.environ.get("UAV_CODEC_PROFILE") or
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "codec_profile.json"))
+CODEC_KEYS = ("compress", "predictor", "zlevel", "zstd_level", "max_z_error")
+
+# layout/compression keys of a source profile that must not leak into the output
+_DROP = ("blockxsize", "blockysize", "tiled", "compress", "predictor", "zlevel", "zstd_level",
+         "jpeg_quality", "jpegtablesmode", "max_z_error", "bigtiff")
+
+
+def _dtype_name(dtype):
+    return getattr(dtype, "name", None) or str(dtype).lower()
+
+
+def predictor(dtype):
+    """GDAL PREDICTOR for a data type ('float32', np.uint8, 'Byte', ...)."""
+    name = _dtype_name(dtype).lower()
+    return 3 if "float" in name else 2
+
+
+_profile = None
+
+
+def load_codec_profile(path=None):
+    """{layer: creation options} from codec_profile.json ({} if missing or unreadable); cached."""
+    global _profile
+    if _profile is None or path:
+        path = path or PROFILE_PATH
+        _profile = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    _profile = json.load(f).get("layers", {})
+            except (OSError, ValueError) as e:
+                print(f"[WARN] Ignoring unreadable codec profile {path}: {e}")
+    return _profile
+
+
+def chip_layer(name):
+    """Layer type of a raster from its layer name ('dem', 'ortho', 'rgb_render', 'NDVI', ...)."""
+    low = name.lower()
+    if low == "dem":
+        return "dem"
+    if "render" in low:
+        return "render"
+    if low == "ortho":
+        return "ortho"
+    return "vi"
+
+
+def codec(layer, dtype):
+    """Compression options for a layer type: the benchmarked profile entry, else DEFLATE + predictor."""
+    entry = load_codec_profile().get(layer) if layer else None
+    if not entry:
+        return {"compress": COMPRESS, "predictor": predictor(dtype)}
+    out = {k: entry[k] for k in CODEC_KEYS if k in entry}
+    if out.get("predictor") == 3 and predictor(dtype) != 3:   # profile measured on another dtype
+        out["predictor"] = 2
+    return out
+
+
+def tile_size(width, height):
+    return LARGE_TILE if max(width, height) > LARGE_SIDE else TILE
+
+
+def output_profile(profile, layer=None, codec_opts=None, **updates):
+    """
+    Copy of a rasterio profile (src.profile, src.meta) with `updates` applied
+    and the shared layout: tiled, the codec of `layer` (or `codec_opts`),
+    BIGTIFF=IF_SAFER.
+    """
+    prof = {k: v for k, v in dict(profile).items() if k not in _DROP}
+    prof.update(updates)
+    if str(prof.get("photometric", "")).lower() == "ycbcr":   # only valid with JPEG
+        del prof["photometric"]
+    tile = tile_size(prof["width"], prof["height"])
+    prof.update(driver="GTiff", tiled=True, blockxsize=tile, blockysize=tile, bigtiff=BIGTIFF)
+    prof.update(codec_opts if codec_opts is not None else codec(layer, prof["dtype"]))
+    return prof
+
+
+def creation_options(dtype, width, height, layer=None):
+    """The same layout as GDAL creation options (['TILED=YES', 'BLOCKXSIZE=256', ...])."""
+    tile = tile_size(width, height)
+    return (["TILED=YES", f"BLOCKXSIZE={tile}", f"BLOCKYSIZE={tile}", f"BIGTIFF={BIGTIFF}"] +
+            [f"{k.upper()}={v}" for k, v in codec(layer, dtype).items()])
+
+
+def overview_factors(width, height):
+    """Decimation factors of the internal overviews; [] for small rasters or UAV_OVERVIEWS=0."""
+    side = max(width, height)
+    if not OVERVIEWS or side < OVERVIEW_MIN_SIDE:
+        return []
+    factors, f = [], 2
+    while side / f >= tile_size(width, height):
+        factors.append(f)
+        f *= 2
+    return factors
+
+
+def add_overviews(dst, resampling="nearest"):
+    """
+    Build internal overviews on a dataset open for writing, after its pixels
+    are written: 'nearest' for masks, 'average' for continuous rasters.
+    """
+    factors = overview_factors(dst.width, dst.height)
+    if not factors:
+        return
+    from rasterio.enums import Resampling
+    dst.build_overviews(factors, Resampling[resampling])
+    dst.update_tags(ns="rio_overview", resampling=resampling)
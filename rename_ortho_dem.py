@@ -1,9 +1,10 @@
 import os
 import argparse
+import catalog
 
 def rename_files_in_subfolders(root_dir):
     # Iterate through each subfolder in the root directory
-    for subdir, dirs, files in os.walk(root_dir):
+    for subdir, dirs, files in catalog.walk(catalog.load(root_dir)):
         for file in files:
             # Check if the file is ortho.tif or dem.tif
             if file == 'ortho.tif' or file == 'dem.tif':
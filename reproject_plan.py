@@ -0,0 +1,121 @@
+"""
+reproject_plan.py
+-----------------
+Cached nearest-neighbour reprojection for aligning masks onto a reference grid.
+
+The masks from different sensors (DEM vs multispectral) never share a grid, so
+every plot used to pay for a full `rasterio.warp.reproject` per mask.  Here the
+grid-to-grid mapping is computed once per
+(src CRS, src transform, src shape, dst CRS, dst transform, dst shape)
+and every later mask on that grid pair is aligned with a NumPy gather.
+
+Sampling follows GDAL's nearest resampling: each destination pixel takes the
+source pixel containing its centre; destination pixels outside the source
+grid get `fill` (0 / False, matching src_nodata=0, dst_nodata=0 before).
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from rasterio.warp import transform as warp_transform
+
+PLAN_CACHE_SIZE = 256
+
+
+def _crs_key(crs):
+    return crs.to_wkt() if crs is not None else None
+
+
+def same_grid(src_profile, ref_profile):
+    return (src_profile["crs"] == ref_profile["crs"] and
+            src_profile["transform"] == ref_profile["transform"] and
+            src_profile["width"] == ref_profile["width"] and
+            src_profile["height"] == ref_profile["height"])
+
+
+def _build_plan(src_crs_wkt, src_transform, src_shape,
+                dst_crs_wkt, dst_transform, dst_shape,
+                src_off=(0, 0), dst_off=(0, 0)):
+    """
+    Returns (dst_idx, src_idx): flat indices into the destination and the
+    source array such that out.flat[dst_idx] = src.flat[src_idx].
+    The shapes may be windows at (row, col) offsets `src_off` / `dst_off` of
+    the grids of `src_transform` / `dst_transform`: coordinates are computed
+    on the full grids, so a window plan samples exactly like the whole one.
+    """
+    h, w = dst_shape
+    rows, cols = np.mgrid[0:h, 0:w]
+    px = (cols.ravel() + dst_off[1]).astype(np.float64) + 0.5
+    py = (rows.ravel() + dst_off[0]).astype(np.float64) + 0.5
+    xs = dst_transform.a * px + dst_transform.b * py + dst_transform.c
+    ys = dst_transform.d * px + dst_transform.e * py + dst_transform.f
+
+    if src_crs_wkt != dst_crs_wkt and src_crs_wkt and dst_crs_wkt:
+        xs, ys = warp_transform(dst_crs_wkt, src_crs_wkt, xs, ys)
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+
+    inv = ~src_transform
+    src_c = np.floor(inv.a * xs + inv.b * ys + inv.c).astype(np.int64) - src_off[1]
+    src_r = np.floor(inv.d * xs + inv.e * ys + inv.f).astype(np.int64) - src_off[0]
+
+    src_h, src_w = src_shape
+    inside = (src_r >= 0) & (src_r < src_h) & (src_c >= 0) & (src_c < src_w)
+    dst_idx = np.flatnonzero(inside)
+    src_idx = src_r[inside] * src_w + src_c[inside]
+
+    idx_dtype = np.int32 if max(src_h * src_w, h * w) < 2**31 else np.int64
+    dst_idx = dst_idx.astype(idx_dtype)
+    src_idx = src_idx.astype(idx_dtype)
+    dst_idx.setflags(write=False)
+    src_idx.setflags(write=False)
+    return dst_idx, src_idx
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _plan(src_crs_wkt, src_transform, src_shape,
+          dst_crs_wkt, dst_transform, dst_shape):
+    return _build_plan(src_crs_wkt, src_transform, src_shape,
+                       dst_crs_wkt, dst_transform, dst_shape)
+
+
+def window_plan(src_profile, src_window, ref_profile, ref_window):
+    """
+    Uncached gather plan from `src_window` of `src_profile`'s grid onto
+    `ref_window` of `ref_profile`'s grid (windowed processing, see windowed.py).
+    """
+    return _build_plan(_crs_key(src_profile["crs"]), src_profile["transform"],
+                       (src_window.height, src_window.width),
+                       _crs_key(ref_profile["crs"]), ref_profile["transform"],
+                       (ref_window.height, ref_window.width),
+                       src_off=(src_window.row_off, src_window.col_off),
+                       dst_off=(ref_window.row_off, ref_window.col_off))
+
+
+def get_plan(src_profile, ref_profile):
+    """Look up (or build) the gather plan from `src_profile`'s grid onto `ref_profile`'s grid."""
+    return _plan(_crs_key(src_profile["crs"]), src_profile["transform"],
+                 (src_profile["height"], src_profile["width"]),
+                 _crs_key(ref_profile["crs"]), ref_profile["transform"],
+                 (ref_profile["height"], ref_profile["width"]))
+
+
+def reproject_nearest(arr, src_profile, ref_profile, fill=0):
+    """
+    Align a single-band array onto the reference grid with nearest-neighbour
+    sampling.  Returns `arr` unchanged when the grids already match.
+    """
+    if same_grid(src_profile, ref_profile):
+        return arr
+    dst_idx, src_idx = get_plan(src_profile, ref_profile)
+    out = np.full((ref_profile["height"], ref_profile["width"]), fill, dtype=arr.dtype)
+    out.reshape(-1)[dst_idx] = arr.reshape(-1)[src_idx]
+    return out
+
+
+def plan_cache_info():
+    return _plan.cache_info()
+
+
+def clear_plan_cache():
+    _plan.cache_clear()
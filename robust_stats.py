@@ -0,0 +1,132 @@
+"""
+robust_stats.py
+---------------
+Robust per-plot statistics shared by the trait steps (7-9).
+
+Everything works on the 1-D vector of selected pixels obtained with boolean
+indexing (`masked_values`), so no NaN-filled full-frame copies are made, and
+order statistics use O(n) selection (`np.partition`) instead of a full sort.
+With `approx=True` the rank-slice means are taken from a fixed-size histogram
+instead (one O(n) pass, error bounded by one bin width).
+
+Rank conventions match the original scripts:
+  inter_percentile_mean(v, 0.30, 0.70) == mean(sorted(v)[int(.30 n):int(.70 n)])
+  top_k_mean(v, 0.05)                  == mean of the max(1, int(.05 n)) largest values
+"""
+
+import numpy as np
+
+HIST_BINS = 4096
+
+
+def masked_values(arr, mask=None, nodata=-9999):
+    """
+    Return the 1-D vector of valid pixels of `arr`.
+    Valid = selected by `mask` (nonzero / True), not NaN and not equal to `nodata`.
+    Genuine zero values are kept.
+    """
+    sel = np.ones(arr.shape, dtype=bool) if mask is None else (mask > 0)
+    if nodata is not None:
+        sel &= arr != nodata
+    if np.issubdtype(arr.dtype, np.floating):
+        sel &= ~np.isnan(arr)
+    return arr[sel]
+
+
+def _rank_slice_mean_exact(values, lo, hi):
+    kth = sorted({lo, hi - 1})
+    part = np.partition(values, kth)
+    return float(part[lo:hi].mean(dtype=np.float64))
+
+
+def _rank_slice_mean_hist(values, lo, hi, bins):
+    vmin = float(values.min())
+    vmax = float(values.max())
+    if vmin == vmax:
+        return vmin
+    idx = ((values - vmin) * (bins / (vmax - vmin))).astype(np.intp)
+    np.minimum(idx, bins - 1, out=idx)
+    counts = np.bincount(idx, minlength=bins)
+    sums = np.bincount(idx, weights=values, minlength=bins)
+    end = np.cumsum(counts)
+    start = end - counts
+    take = np.clip(np.minimum(end, hi) - np.maximum(start, lo), 0, None)
+    nz = counts > 0
+    total = float((take[nz] * (sums[nz] / counts[nz])).sum())
+    return total / (hi - lo)
+
+
+def rank_slice_mean(values, lo, hi, approx=False, bins=HIST_BINS):
+    """Mean of sorted(values)[lo:hi]; NaN when the slice is empty."""
+    lo = max(0, int(lo))
+    hi = min(values.size, int(hi))
+    if hi <= lo:
+        return np.nan
+    if approx:
+        return _rank_slice_mean_hist(values, lo, hi, bins)
+    return _rank_slice_mean_exact(values, lo, hi)
+
+
+def inter_percentile_mean(values, lo_frac, hi_frac, approx=False, bins=HIST_BINS):
+    """Mean of the values ranked between lo_frac and hi_frac (e.g. 0.30-0.70)."""
+    n = values.size
+    if n == 0:
+        return np.nan
+    return rank_slice_mean(values, int(lo_frac * n), int(hi_frac * n), approx=approx, bins=bins)
+
+
+def trimmed_mean(values, proportion, approx=False, bins=HIST_BINS):
+    """Mean after cutting `proportion` of the values from each tail."""
+    return inter_percentile_mean(values, proportion, 1.0 - proportion, approx=approx, bins=bins)
+
+
+def top_k_mean(values, frac, approx=False, bins=HIST_BINS):
+    """Mean of the max(1, int(frac * n)) largest values."""
+    n = values.size
+    if n == 0:
+        return np.nan
+    k = max(1, int(frac * n))
+    return rank_slice_mean(values, n - k, n, approx=approx, bins=bins)
+
+
+def mean_std(values):
+    """(mean, population std) with float64 accumulation; NaNs when empty."""
+    if values.size == 0:
+        return np.nan, np.nan
+    mean = values.mean(dtype=np.float64)
+    return float(mean), float(values.std(dtype=np.float64))
+
+
+def nan_mean_std_rows(values):
+    """
+    Row-wise (mean, population std) of a 2-D array ignoring NaN, float64
+    accumulation; returns an (n_rows, 2) array, NaN rows where nothing is valid.
+    Same numbers as mean_std(masked_values(row)) for each row, in one reduction.
+    """
+    valid = ~np.isnan(values)
+    cnt = valid.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, values, 0).sum(axis=1, dtype=np.float64) / cnt
+        dev = np.where(valid, values - mean[:, None], 0)
+        var = np.einsum("ij,ij->i", dev, dev) / cnt
+    return np.stack([mean, np.sqrt(var)], axis=1)
+
+
+def percentile_bounds(values, lo_q, hi_q):
+    """
+    (lo, hi) percentiles of a 1-D vector with np.percentile's default linear
+    interpolation, via one np.partition on the four neighbouring ranks.
+    """
+    n = values.size
+    if n == 0:
+        return np.nan, np.nan
+    pos = np.array([lo_q, hi_q], dtype=np.float64) / 100.0 * (n - 1)
+    below = np.floor(pos).astype(np.intp)
+    above = np.minimum(below + 1, n - 1)
+    part = np.partition(values, np.unique(np.concatenate([below, above])))
+    a = part[below]
+    b = part[above]
+    t = pos - below
+    diff = b - a  # in the input dtype, as numpy does
+    out = np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+    return out[0], out[1]  # np.float64, like np.percentile
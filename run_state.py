@@ -0,0 +1,131 @@
+"""
+run_state.py
+------------
+Per-folder run manifests, so a re-run only recomputes what changed.
+
+  <folder>/.run_state/<stage>.json
+    {"params": {...}, "units": {"<unit>": {"inputs": [[rel path, size, mtime_ns], ...],
+                                           "result": <row or null>,
+                                           "outputs": [[rel path, size, mtime_ns], ...]}}}
+
+A unit (one plot chip, one mask file, one JPG, ...) is fresh when the stage
+parameters are unchanged, every input still has the recorded size and mtime
+(os.stat, not the catalog: masks rewritten in place must show up), and its
+outputs exist (and, where the stage records them, e.g. step 4's masks, still
+have the size and mtime they were written with). Changed parameters (thresholds, --op, kernel sizes, ...) make
+every unit of that stage dirty. Stages that build a table cache each unit's
+row as `result` and rebuild the table from fresh + recomputed rows.
+
+State is saved every SAVE_EVERY_S seconds and at the end, so an interrupted
+run resumes where it stopped.
+"""
+
+import os
+import json
+import time
+
+STATE_DIR = ".run_state"
+SAVE_EVERY_S = 10.0
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}   # key order kept: cached rows keep their columns
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, "item"):   # numpy scalar
+        return value.item()
+    return value
+
+
+def open_state(folder, stage, params, force=False):
+    """
+    State of `stage` in `folder`. Starts empty if missing, unreadable, `force`,
+    or recorded with different `params`.
+    """
+    path = os.path.join(folder, STATE_DIR, f"{stage}.json")
+    params = _jsonable(params)
+    state = None
+    if not force and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Ignoring unreadable run state {path}: {e}")
+        if state is not None and state.get("params") != params:
+            print(f"[INFO] {stage}: parameters changed, recomputing {folder}")
+            state = None
+    if state is None:
+        state = {"params": params, "units": {}}
+    state["_path"], state["_folder"] = path, folder
+    state["_seen"], state["_saved_at"], state["_recomputed"] = set(), time.monotonic(), 0
+    return state
+
+
+def _identity(state, inputs):
+    out = []
+    for p in inputs:
+        rel = os.path.relpath(p, state["_folder"]).replace(os.sep, "/")
+        try:
+            st = os.stat(p)
+            out.append([rel, st.st_size, st.st_mtime_ns])
+        except OSError:
+            out.append([rel, None, None])
+    return out
+
+
+def is_fresh(state, unit, inputs, outputs=()):
+    """
+    True if `unit` can be skipped; marks it as seen either way. Outputs whose
+    signature was recorded by mark_done must still match it; otherwise they
+    only have to exist.
+    """
+    state["_seen"].add(unit)
+    rec = state["units"].get(unit)
+    if rec is None or rec["inputs"] != _identity(state, inputs):
+        return False
+    if "outputs" in rec:
+        return rec["outputs"] == _identity(state, outputs)
+    return all(os.path.exists(o) for o in outputs)
+
+
+def result(state, unit):
+    """Cached result of a fresh unit."""
+    return state["units"][unit]["result"]
+
+
+def mark_done(state, unit, inputs, result=None, outputs=None):
+    """Record a recomputed unit (inputs, and `outputs` if given, are stat'ed now) and its result row."""
+    state["_seen"].add(unit)
+    state["units"][unit] = {"inputs": _identity(state, inputs), "result": _jsonable(result)}
+    if outputs is not None:
+        state["units"][unit]["outputs"] = _identity(state, outputs)
+    state["_recomputed"] += 1
+    if time.monotonic() - state["_saved_at"] > SAVE_EVERY_S:
+        save(state, prune=False)
+
+
+def recomputed(state):
+    return state["_recomputed"]
+
+
+def unchanged(state):
+    """Nothing recomputed and no recorded unit gone: the stage's outputs are current."""
+    return state["_recomputed"] == 0 and set(state["units"]) <= state["_seen"]
+
+
+def save(state, prune=True):
+    """
+    Write the manifest; `prune` drops units not seen in this run (deleted plots).
+    Returns `unchanged(state)` as it was before pruning.
+    """
+    current = unchanged(state)
+    if prune:
+        state["units"] = {u: r for u, r in state["units"].items() if u in state["_seen"]}
+    os.makedirs(os.path.dirname(state["_path"]), exist_ok=True)
+    tmp = state["_path"] + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"params": state["params"], "units": state["units"]}, f, separators=(",", ":"))
+    os.replace(tmp, state["_path"])
+    state["_saved_at"] = time.monotonic()
+    return current
@@ -0,0 +1,136 @@
+"""
+scratch.py
+----------
+Disk quota and cleanup for intermediates. An intermediate is a file that one
+stage writes only so that a later stage of the same date can read it. The
+main example is step 2's full-field VI rasters: about 50 per ortho, and only
+crop reads them.
+
+INTERMEDIATES lists each such artifact with the stage that produces it, the
+stages that consume it, and where its files live. pipeline.py uses the list
+in two ways:
+
+  - it deletes an artifact as soon as every consumer of its date in the run
+    has finished. crop no longer removes the VI rasters itself, and
+    --keep-intermediates keeps them.
+  - with --scratch-quota, a producer unit starts only when the
+    intermediates on disk plus its estimated output fit the quota. crop of
+    an earlier date then runs, and frees space, before vi runs ahead on a
+    later date. If nothing else can run, the producer starts anyway and a
+    warning is printed.
+
+When a consumer fails, its intermediates stay on disk, because a re-run of
+crop needs them. They count against the next run's quota. `clean` removes
+them.
+
+Usage:
+    python scratch.py status D:\\test --folder-pattern "*_Swb_Cl*"
+    python scratch.py clean D:\\test --folder-pattern "*_Swb_Cl*"
+    python pipeline.py D:\\test --shp plots.shp --scratch-quota 100GB
+"""
+
+import os
+import glob
+import fnmatch
+import argparse
+
+# artifact: (producer stage, consumer stages, folder under the date folder, file pattern)
+INTERMEDIATES = {
+    "vi_rasters": ("vi", ("crop",), "{ortho_subdir}", "*.tif"),
+}
+
+# rasters next to the VI layers that are inputs, not intermediates
+KEEP = ("ortho.tif", "render.tif", "dem.tif")
+
+# GDAL/QGIS statistics written next to a raster; reclaimed with it
+SIDECAR = ".aux.xml"
+
+# float32 rasters 2_multiOmRasterCalculation4.py writes per ortho
+VI_RASTERS = 53
+
+
+def produced_by(stage):
+    return [a for a, (producer, _, _, _) in INTERMEDIATES.items() if producer == stage]
+
+
+def consumed_by(stage):
+    return [a for a, (_, consumers, _, _) in INTERMEDIATES.items() if stage in consumers]
+
+
+def artifact_dir(folder, artifact, ortho_subdir="orthos"):
+    return os.path.join(folder, INTERMEDIATES[artifact][2].format(ortho_subdir=ortho_subdir))
+
+
+def files(directory, artifact):
+    """
+    Files of an artifact in its directory, with the GDAL/QGIS .aux.xml
+    sidecars next to them (the KEEP inputs and their sidecars excluded).
+    """
+    if not os.path.isdir(directory):
+        return []
+    pattern = INTERMEDIATES[artifact][3]
+    names = set(os.listdir(directory))
+    hits = [f for f in names if fnmatch.fnmatch(f, pattern) and not f.endswith(KEEP)]
+    hits += [f + SIDECAR for f in hits if f + SIDECAR in names]
+    return sorted(os.path.join(directory, f) for f in hits)
+
+
+def size(directory, artifact):
+    return sum(os.path.getsize(p) for p in files(directory, artifact))
+
+
+def _estimate_vi_rasters(directory):
+    import rasterio
+    total = 0
+    for f in os.listdir(directory) if os.path.isdir(directory) else []:
+        if f.endswith("ortho.tif"):
+            with rasterio.open(os.path.join(directory, f)) as src:
+                total += src.width * src.height * 4 * VI_RASTERS
+    return total
+
+
+_ESTIMATES = {"vi_rasters": _estimate_vi_rasters}
+
+
+def estimate(folder, artifact, ortho_subdir="orthos"):
+    """Bytes the producer will write for a date (uncompressed, so an upper bound); 0 if unknown."""
+    est = _ESTIMATES.get(artifact)
+    return est(artifact_dir(folder, artifact, ortho_subdir)) if est else 0
+
+
+def reclaim(directory, artifact):
+    """Delete an artifact's files; returns the bytes freed."""
+    paths = files(directory, artifact)
+    freed = 0
+    for path in paths:
+        freed += os.path.getsize(path)
+        os.remove(path)
+    if paths:
+        print(f"[SCRATCH] Reclaimed {artifact} in {directory}: {len(paths)} file(s), {freed / 2**20:.0f} MB")
+    return freed
+
+
+def date_folders(base, folder_pattern="*"):
+    return [d for d in sorted(glob.glob(os.path.join(base, folder_pattern))) if os.path.isdir(d)]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="List or remove the intermediates left in date folders.")
+    ap.add_argument("action", choices=["status", "clean"])
+    ap.add_argument("base_dir", help="Base directory holding the date folders")
+    ap.add_argument("--folder-pattern", type=str, default="*", help="Glob for date folders")
+    ap.add_argument("--ortho-subdir", type=str, default="orthos", help="Ortho folder inside each date folder")
+    args = ap.parse_args()
+
+    total = 0
+    for folder in date_folders(args.base_dir, args.folder_pattern):
+        for artifact in INTERMEDIATES:
+            directory = artifact_dir(folder, artifact, args.ortho_subdir)
+            if args.action == "clean":
+                total += reclaim(directory, artifact)
+            elif files(directory, artifact):
+                n = size(directory, artifact)
+                total += n
+                print(f"  {os.path.basename(folder):40s} {artifact:12s} "
+                      f"{len(files(directory, artifact)):5d} file(s) {n / 2**20:10.0f} MB")
+    print(f"[INFO] {total / 2**20:.0f} MB of intermediates {'freed' if args.action == 'clean' else 'on disk'}")
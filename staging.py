@@ -0,0 +1,438 @@
+"""
+staging.py
+----------
+Local-disk staging of a date's working set, for base directories on a
+network share. Instead of every stage reading and writing thousands of
+small files over the network, a date is copied once to local scratch, the
+stages run there, and what they wrote is copied back in one pass.
+
+    local = staging.stage_in(base, folder, stage_dir, quota=200 * 2**30)
+    ... run the stages on `local` (base: staging.mirror_root(base, stage_dir)) ...
+    staging.stage_out(base, folder, stage_dir)
+
+The mirror keeps the layout of the base directory, so scripts that look
+next to the date folder (metashape_report, trait_store) find their files:
+
+  <stage_dir>/<base name>_<hash>/
+    <date folder>/                       the whole date folder
+    metashape_report/                    read-only: copied in, never back
+    trait_store/<family>/date=<date>/    the date's trait partitions
+    mulch_height/<date>.xlsx             legacy step 7 export, if present
+    .staging/<date folder>.json          manifest: size + mtime of every file, both sides
+
+stage_in copies only files that changed on the share since the last copy,
+one after another in path order, and drops local files that came from the
+share and are gone from it. Local files that are not in the manifest, or
+changed since the last sync (a run interrupted before stage_out), are never
+overwritten or deleted: they are kept with a warning and stage_out copies
+them back. stage_out copies files that are new or changed
+locally. Each copy goes to a temporary name, is read back and compared
+with the source by BLAKE2 checksum (verify=False: size only), then renamed
+into place. Files the stages deleted (e.g. the VI rasters after crop) are
+deleted on the share too, unless they changed there in the meantime
+(inside the date folder only).
+
+Staged dates are evicted least recently used first when the next stage_in
+would exceed the quota. A date between stage_in and stage_out is in use
+and is never evicted. The index is <stage_dir>/staging_index.json.
+
+Usage:
+    python staging.py in D:\\test\\20240214_Swb_Cl --stage-dir C:\\scratch --quota 200GB
+    python staging.py out D:\\test\\20240214_Swb_Cl --stage-dir C:\\scratch
+    python staging.py status --stage-dir C:\\scratch
+    python staging.py selftest
+    python pipeline.py D:\\test --shp plots.shp --stage-dir C:\\scratch --stage-quota 200GB
+"""
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+
+INDEX = "staging_index.json"
+LOCK = "staging_index.lock"
+MANIFEST_DIR = ".staging"
+TMP_SUFFIX = ".staging-tmp"
+READ_ONLY = ("metashape_report",)
+COPY_BUFFER = 8 * 2**20
+LOCK_STALE_S = 300
+LOCK_REFRESH_S = 30   # the holder touches the lock this often, so a long eviction never looks stale
+
+
+def _parse_size(text):
+    import windowed   # same units as --memory-budget
+    return windowed.parse_budget(text)
+
+
+def mirror_root(base, stage_dir):
+    """Local mirror of `base` under `stage_dir` (one per base directory)."""
+    base = os.path.abspath(base)
+    key = hashlib.sha1(os.path.normcase(base).encode("utf-8")).hexdigest()[:8]
+    return os.path.join(os.path.abspath(stage_dir), f"{os.path.basename(base.rstrip(os.sep)) or 'base'}_{key}")
+
+
+def local_folder(base, folder, stage_dir):
+    """Mirror path of a date folder."""
+    return os.path.join(mirror_root(base, stage_dir), os.path.relpath(os.path.abspath(folder), os.path.abspath(base)))
+
+
+def _patterns(folder, read_only=True):
+    """Globs (relative to the base) of a date's working set."""
+    name = os.path.basename(os.path.abspath(folder))
+    date = glob.escape(name.split("_")[0])
+    out = [glob.escape(name), f"trait_store/*/date={date}", f"mulch_height/{date}.xlsx"]
+    return out + list(READ_ONLY) if read_only else out
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _files(root, patterns):
+    """{relative path: [size, mtime_ns]} of every file under the matching files/folders of `root`."""
+    out = {}
+    for pat in patterns:
+        for hit in glob.glob(os.path.join(root, pat)):
+            paths = [hit] if os.path.isfile(hit) else \
+                [os.path.join(d, f) for d, _, files in os.walk(hit) for f in files]
+            for p in paths:
+                if not p.endswith(TMP_SUFFIX):
+                    st = _stat(p)
+                    if st is not None:
+                        out[os.path.relpath(p, root)] = st
+    return out
+
+
+def _hash(path):
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _copy(src, dst, verify=True):
+    """Copy through a temporary name, check it, rename into place; keeps the mtime. Returns bytes."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + TMP_SUFFIX
+    h = hashlib.blake2b()
+    with open(src, "rb") as fi, open(tmp, "wb") as fo:
+        for chunk in iter(lambda: fi.read(COPY_BUFFER), b""):
+            h.update(chunk)
+            fo.write(chunk)
+    size = os.path.getsize(src)
+    if os.path.getsize(tmp) != size or (verify and _hash(tmp) != h.hexdigest()):
+        os.remove(tmp)
+        raise OSError(f"Verification failed copying {src} -> {dst}")
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+    return size
+
+
+# ---------- manifest (per date) and index (per stage_dir) ----------
+
+def _manifest_path(root, folder):
+    return os.path.join(root, MANIFEST_DIR, os.path.basename(os.path.abspath(folder)) + ".json")
+
+
+def _load_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _locked(stage_dir):
+    """
+    Exclusive access to the index across processes (pipeline workers stage
+    dates concurrently). A lock older than LOCK_STALE_S was left by a killed
+    process; a live holder keeps it fresh from a heartbeat thread.
+    """
+    os.makedirs(stage_dir, exist_ok=True)
+    lock = os.path.join(stage_dir, LOCK)
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > LOCK_STALE_S:   # left by a killed process
+                    os.remove(lock)
+                    continue
+            except OSError:
+                pass
+            time.sleep(0.05)
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(LOCK_REFRESH_S):
+            try:
+                os.utime(lock)
+            except OSError:
+                pass
+
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    try:
+        yield os.path.join(stage_dir, INDEX)
+    finally:
+        done.set()
+        beat.join()
+        os.close(fd)
+        os.remove(lock)
+
+
+def _entry_key(base, folder, stage_dir):
+    return os.path.relpath(local_folder(base, folder, stage_dir), os.path.abspath(stage_dir))
+
+
+def _evict(stage_dir, index, key):
+    """
+    Delete one staged date folder and its manifest records. Its trait
+    partitions are small and may be shared with another folder of the same
+    date; they stay, and so do their records, so that the next stage_in sees
+    them as synced and refreshes them from the share.
+    """
+    entry = index.pop(key)
+    root = os.path.join(stage_dir, os.path.dirname(key))
+    folder = os.path.join(root, os.path.basename(key))
+    shutil.rmtree(folder, ignore_errors=True)
+    path = _manifest_path(root, folder)
+    in_folder = os.path.basename(folder) + os.sep
+    manifest = {rel: rec for rel, rec in _load_json(path).items() if not rel.startswith(in_folder)}
+    if manifest:
+        _save_json(path, manifest)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    print(f"[STAGE] Evicted {key} ({entry.get('bytes', 0) / 2**20:.0f} MB)")
+
+
+def _reserve(stage_dir, key, base, need, quota):
+    """Mark `key` in use with `need` bytes; evict LRU dates not in use while the total exceeds the quota."""
+    with _locked(stage_dir) as index_path:
+        index = _load_json(index_path)
+        if quota is not None:
+            others = sorted((k for k, e in index.items() if k != key and not e.get("in_use")),
+                            key=lambda k: index[k].get("last_used", 0))
+            used = sum(e.get("bytes", 0) for k, e in index.items() if k != key)
+            for k in others:
+                if used + need <= quota:
+                    break
+                used -= index[k].get("bytes", 0)
+                _evict(stage_dir, index, k)
+            if used + need > quota:
+                print(f"[WARN] Staging {key} ({need / 2**20:.0f} MB) exceeds the quota "
+                      f"({quota / 2**20:.0f} MB; {used / 2**20:.0f} MB in use by other dates)")
+        index[key] = {"base": os.path.abspath(base), "bytes": need, "in_use": True, "last_used": time.time()}
+        _save_json(index_path, index)
+
+
+def _release(stage_dir, key, size):
+    with _locked(stage_dir) as index_path:
+        index = _load_json(index_path)
+        entry = index.setdefault(key, {})
+        entry.update(bytes=size, in_use=False, last_used=time.time())
+        _save_json(index_path, index)
+
+
+# ---------- stage in / out ----------
+
+def stage_in(base, folder, stage_dir, quota=None):
+    """Bring the local copy of a date's working set up to date with the share; returns the local date folder."""
+    t0 = time.perf_counter()
+    root = mirror_root(base, stage_dir)
+    local = local_folder(base, folder, stage_dir)
+    key = _entry_key(base, folder, stage_dir)
+    patterns = _patterns(folder)
+    remote = _files(base, patterns)
+    manifest = _load_json(_manifest_path(root, folder))
+
+    need = sum(size for size, _ in remote.values())
+    _reserve(stage_dir, key, base, need, quota)
+    localfiles = _files(root, patterns)
+    have = sum(s[0] for s in localfiles.values())
+    free = shutil.disk_usage(os.path.abspath(stage_dir)).free
+    if need - have > free:
+        raise OSError(f"Not enough space in {stage_dir} to stage {folder}: "
+                      f"{(need - have) / 2**20:.0f} MB needed, {free / 2**20:.0f} MB free")
+
+    # A local file is "as staged" when the manifest has it and its local stat is
+    # the one recorded at the last sync. Anything else (written or changed after
+    # staging, e.g. by a run interrupted before stage_out) is kept for stage_out.
+    kept = []
+    copied = nbytes = 0
+    for rel in sorted(remote):   # path order: one sequential stream per folder
+        rec = manifest.get(rel)
+        dst = os.path.join(root, rel)
+        if rel in localfiles and not (rec and rec[2:] == localfiles[rel]):
+            kept.append(rel)
+            continue
+        if rec and rec[:2] == remote[rel] and rel in localfiles:
+            continue
+        nbytes += _copy(os.path.join(base, rel), dst, verify=False)
+        manifest[rel] = remote[rel] + _stat(dst)
+        copied += 1
+    for rel in sorted(set(localfiles) - set(remote)):
+        rec = manifest.get(rel)
+        if rec and rec[2:] == localfiles[rel]:   # came from the share and is gone from it
+            os.remove(os.path.join(root, rel))
+        else:
+            kept.append(rel)
+    if kept:
+        print(f"[WARN] {len(kept)} local file(s) in {local} are not synced back yet (e.g. {kept[0]}); "
+              f"kept, stage_out copies them to the share")
+    manifest = {rel: rec for rel, rec in manifest.items() if rel in remote or rel in kept}
+    _save_json(_manifest_path(root, folder), manifest)
+    print(f"[STAGE] In {os.path.basename(local)}: {copied} file(s), {nbytes / 2**20:.0f} MB copied, "
+          f"{len(remote) - copied - sum(rel in remote for rel in kept)} unchanged ({time.perf_counter() - t0:.1f}s) → {local}")
+    return local
+
+
+def stage_out(base, folder, stage_dir, verify=True):
+    """Copy what the stages wrote locally back to the share and mirror their deletions; the date leaves use."""
+    t0 = time.perf_counter()
+    root = mirror_root(base, stage_dir)
+    local = local_folder(base, folder, stage_dir)
+    manifest = _load_json(_manifest_path(root, folder))
+    if not os.path.isdir(local):
+        raise FileNotFoundError(f"{folder} is not staged under {stage_dir}")
+    files = _files(root, _patterns(folder, read_only=False))
+    in_folder = os.path.basename(local) + os.sep
+
+    copied = nbytes = deleted = 0
+    for rel in sorted(files):
+        rec = manifest.get(rel)
+        if rec and rec[2:] == files[rel]:
+            continue
+        dst = os.path.join(base, rel)
+        nbytes += _copy(os.path.join(root, rel), dst, verify=verify)
+        manifest[rel] = _stat(dst) + files[rel]
+        copied += 1
+    # deletions are mirrored inside the date folder only (trait partitions are
+    # replaced, never deleted, and may be shared with a folder of the same date)
+    for rel in [r for r in manifest if r not in files and r.startswith(in_folder)]:
+        dst = os.path.join(base, rel)
+        st = _stat(dst)
+        if st is not None and st == manifest[rel][:2]:
+            os.remove(dst)
+            deleted += 1
+        elif st is not None:
+            print(f"[WARN] {dst} was deleted locally but changed on the share; kept")
+        del manifest[rel]
+    manifest = {rel: rec for rel, rec in manifest.items() if rel in files or rel.startswith(READ_ONLY)}
+    _save_json(_manifest_path(root, folder), manifest)
+    _release(stage_dir, _entry_key(base, folder, stage_dir),
+             sum(s[0] for s in _files(root, _patterns(folder)).values()))
+    print(f"[STAGE] Out {os.path.basename(local)}: {copied} file(s), {nbytes / 2**20:.0f} MB copied back"
+          f"{' (verified)' if verify else ''}, {deleted} deleted ({time.perf_counter() - t0:.1f}s)")
+    return copied
+
+
+def status(stage_dir):
+    """Print the staged dates, most recently used first."""
+    index = _load_json(os.path.join(stage_dir, INDEX))
+    total = sum(e.get("bytes", 0) for e in index.values())
+    print(f"[INFO] {len(index)} staged date(s), {total / 2**20:.0f} MB in {stage_dir}")
+    for key, e in sorted(index.items(), key=lambda kv: -kv[1].get("last_used", 0)):
+        used = time.strftime("%Y-%m-%d %H:%M", time.localtime(e.get("last_used", 0)))
+        print(f"  {key:50s} {e.get('bytes', 0) / 2**20:10.0f} MB  {used}"
+              f"{'  in use' if e.get('in_use') else ''}  ← {e.get('base', '?')}")
+
+
+def clear(stage_dir, force=False):
+    """Evict every staged date not in use (all with force)."""
+    with _locked(stage_dir) as index_path:
+        index = _load_json(index_path)
+        for key in [k for k, e in index.items() if force or not e.get("in_use")]:
+            _evict(stage_dir, index, key)
+        _save_json(index_path, index)
+
+
+def selftest():
+    """
+    Round trips on a throwaway share: an output written locally reaches the
+    share, and a trait partition updated on the share after its date was
+    evicted is restaged from the share, not overwritten with the old copy.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        base, stage_dir = os.path.join(tmp, "share"), os.path.join(tmp, "scratch")
+        folder = os.path.join(base, "20240214_Swb_Cl")
+        part = os.path.join("trait_store", "dem", "date=20240214", "part-0.parquet")
+
+        def write(path, text):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(text)
+
+        def read(path):
+            with open(path) as f:
+                return f.read()
+
+        write(os.path.join(folder, "orthos", "a_ortho.tif"), "ortho")
+        local = stage_in(base, folder, stage_dir)
+        write(os.path.join(mirror_root(base, stage_dir), part), "v1")
+        write(os.path.join(local, "masks", "m.png"), "mask")
+        stage_out(base, folder, stage_dir)
+        assert read(os.path.join(base, part)) == "v1"
+        assert read(os.path.join(folder, "masks", "m.png")) == "mask"
+
+        clear(stage_dir)
+        time.sleep(0.01)   # a distinct mtime on coarse clocks
+        write(os.path.join(base, part), "v2")
+        stage_in(base, folder, stage_dir)
+        assert read(os.path.join(mirror_root(base, stage_dir), part)) == "v2", "stale partition restaged"
+        stage_out(base, folder, stage_dir)
+        assert read(os.path.join(base, part)) == "v2", "stale partition copied back over the share"
+    print("[OK] staging round trips")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Stage a date folder on local disk and sync it back.")
+    ap.add_argument("action", choices=["in", "out", "status", "clear", "selftest"])
+    ap.add_argument("folder", nargs="?", help="Date folder on the share (in/out)")
+    ap.add_argument("--stage-dir", help="Local scratch directory (all actions but selftest)")
+    ap.add_argument("--quota", type=str, default=None, help="Disk quota for staged dates (e.g. 200GB)")
+    ap.add_argument("--no-verify", action="store_true", help="out: check sizes only, no read-back checksum")
+    ap.add_argument("--force", action="store_true", help="clear: also evict dates in use")
+    args = ap.parse_args()
+    if args.action != "selftest" and not args.stage_dir:
+        raise SystemExit(f"'{args.action}' needs --stage-dir")
+
+    if args.action in ("in", "out"):
+        if not args.folder:
+            raise SystemExit(f"'{args.action}' needs the date folder")
+        folder = os.path.abspath(args.folder)
+        base = os.path.dirname(folder)
+        if args.action == "in":
+            stage_in(base, folder, args.stage_dir, quota=_parse_size(args.quota))
+        else:
+            stage_out(base, folder, args.stage_dir, verify=not args.no_verify)
+    elif args.action == "status":
+        status(args.stage_dir)
+    elif args.action == "selftest":
+        selftest()
+    else:
+        clear(args.stage_dir, force=args.force)
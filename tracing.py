@@ -0,0 +1,224 @@
+"""
+tracing.py
+----------
+Opt-in spans that show where a run spends its time (--trace out.json).
+
+    with tracing.span("ckwrap.ckmeans", plot=fn, pixels=vals.size):
+        km = ckwrap.ckmeans(vals, k)
+
+    @tracing.traced()
+    def trait_extract_dem(input_folder, ...):
+
+When tracing is off (the default), span() returns one shared no-op context
+manager and a traced function costs a single global check, so the spans can
+stay in the per-plot loops.
+
+start(path) turns tracing on for this process. Through the UAV_TRACE
+environment variable it also turns it on for worker processes started later
+(pipeline.py, step 9 RGB). Workers append their events to
+<path>.parts/<pid>.jsonl whenever an outermost span ends. At exit, the
+process that called start() merges all events into Chrome trace-event JSON
+(open it in chrome://tracing or https://ui.perfetto.dev) and prints the top
+hotspots by self time. The same table goes into the file under
+otherData.hotspots.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import threading
+import functools
+
+ENV_VAR = "UAV_TRACE"
+TOP_N = 15
+
+_path = os.environ.get(ENV_VAR) or None   # trace file; None = disabled
+_owner_pid = None                         # pid of the process that called start()
+_events = []
+_events_lock = threading.Lock()   # spans close on prefetch threads too
+_local = threading.local()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "cat", "args", "t0")
+
+    def __init__(self, name, cat, args):
+        self.name, self.cat, self.args = name, cat, args
+
+    def __enter__(self):
+        _local.depth = getattr(_local, "depth", 0) + 1
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def set(self, **args):
+        """Add args known only inside the span (e.g. pixel count after a read)."""
+        self.args.update(args)
+
+    def __exit__(self, exc_type, exc, tb):
+        t1 = time.perf_counter_ns()
+        _local.depth -= 1
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        ev = {"name": self.name, "cat": self.cat, "ph": "X",
+              "ts": self.t0 / 1000.0, "dur": (t1 - self.t0) / 1000.0,
+              "pid": os.getpid(), "tid": threading.get_ident(), "args": self.args}
+        with _events_lock:
+            _events.append(ev)
+        if _local.depth == 0 and os.getpid() != _owner_pid:
+            _flush()
+        return False
+
+
+def enabled():
+    return _path is not None
+
+
+def span(name, cat="", **args):
+    """Context manager timing one block; args (date, plot, layer, pixels, ...) go into the trace."""
+    if _path is None:
+        return _NULL
+    return _Span(name, cat, args)
+
+
+def traced(name=None):
+    """Decorator: one span per call, named after the function; a leading path argument is recorded."""
+    def deco(fn):
+        label = name or fn.__name__
+        cat = fn.__module__
+
+        @functools.wraps(fn)
+        def wrapper(*a, **k):
+            if _path is None:
+                return fn(*a, **k)
+            args = {"path": os.fspath(a[0])} if a and isinstance(a[0], (str, os.PathLike)) else {}
+            with _Span(label, cat, args):
+                return fn(*a, **k)
+        return wrapper
+    return deco
+
+
+def _parts_dir():
+    return _path + ".parts"
+
+
+def _flush():
+    global _events
+    with _events_lock:   # swap first: events other threads add while writing go to the next flush
+        events, _events = _events, []
+    if not events:
+        return
+    os.makedirs(_parts_dir(), exist_ok=True)
+    with open(os.path.join(_parts_dir(), f"{os.getpid()}.jsonl"), "a", encoding="utf-8") as f:
+        for ev in events:
+            f.write(json.dumps(ev, default=str) + "\n")
+
+
+def _after_fork():
+    # a forked worker starts with the parent's unflushed events: drop them
+    # (and a fresh lock, in case another parent thread held it at the fork)
+    global _events, _events_lock
+    _events = []
+    _events_lock = threading.Lock()
+    _local.depth = 0
+
+
+if hasattr(os, "register_at_fork"):   # not on Windows, where workers are spawned
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def start(path):
+    """Enable tracing for this run (no-op for a falsy path); the trace is written at exit."""
+    global _path, _owner_pid
+    if not path:
+        return
+    _path = os.path.abspath(path)
+    _owner_pid = os.getpid()
+    os.environ[ENV_VAR] = _path
+    shutil.rmtree(_parts_dir(), ignore_errors=True)
+    atexit.register(finish)
+
+
+def hotspots(events, top=TOP_N):
+    """Per span name: calls, total and self time (ms), pixels; sorted by self time."""
+    by_thread = {}
+    for ev in events:
+        if ev.get("ph") == "X":
+            by_thread.setdefault((ev["pid"], ev["tid"]), []).append(ev)
+    stats = {}
+    for evs in by_thread.values():
+        evs.sort(key=lambda e: (e["ts"], -e["dur"]))
+        stack = []   # [event, child time]
+        for ev in evs:
+            while stack and stack[-1][0]["ts"] + stack[-1][0]["dur"] <= ev["ts"]:
+                _close(stack.pop(), stats)
+            if stack:
+                stack[-1][1] += ev["dur"]
+            stack.append([ev, 0.0])
+        while stack:
+            _close(stack.pop(), stats)
+    rows = sorted(stats.values(), key=lambda r: -r["self_ms"])[:top]
+    for r in rows:
+        r["total_ms"], r["self_ms"] = round(r["total_ms"], 3), round(r["self_ms"], 3)
+        r["mpx_per_s"] = round(r["pixels"] / r["total_ms"] / 1000.0, 3) if r["pixels"] and r["total_ms"] else None
+    return rows
+
+
+def _close(item, stats):
+    ev, child = item
+    r = stats.setdefault(ev["name"], {"name": ev["name"], "calls": 0, "total_ms": 0.0, "self_ms": 0.0, "pixels": 0})
+    r["calls"] += 1
+    r["total_ms"] += ev["dur"] / 1000.0
+    r["self_ms"] += (ev["dur"] - child) / 1000.0
+    px = ev.get("args", {}).get("pixels")
+    if isinstance(px, (int, float)):
+        r["pixels"] += int(px)
+
+
+def finish():
+    """Merge this process's and the workers' events into the trace file and print the hotspots."""
+    global _path
+    if _path is None or os.getpid() != _owner_pid:
+        return
+    with _events_lock:
+        events = list(_events)
+    parts = _parts_dir()
+    if os.path.isdir(parts):
+        for fn in sorted(os.listdir(parts)):
+            with open(os.path.join(parts, fn), "r", encoding="utf-8") as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+    meta = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+             "args": {"name": os.path.basename(sys.argv[0]) if pid == _owner_pid else f"worker {pid}"}}
+            for pid in sorted({ev["pid"] for ev in events})]
+    top = hotspots(events)
+    os.makedirs(os.path.dirname(_path) or ".", exist_ok=True)
+    with open(_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms",
+                   "otherData": {"hotspots": top}}, f, default=str)
+    shutil.rmtree(parts, ignore_errors=True)
+
+    print(f"[TRACE] {len(events)} span(s) → {_path}")
+    print(f"[TRACE] top {len(top)} by self time:")
+    print(f"  {'self s':>9} {'total s':>9} {'calls':>7} {'Mpx/s':>8}  name")
+    for r in top:
+        mpx = f"{r['mpx_per_s']:8.2f}" if r["mpx_per_s"] is not None else f"{'':8}"
+        print(f"  {r['self_ms'] / 1000:9.3f} {r['total_ms'] / 1000:9.3f} {r['calls']:7d} {mpx}  {r['name']}")
+    _path = None
@@ -0,0 +1,118 @@
+"""
+trait_store.py
+--------------
+Columnar trait store shared by the trait steps (7-10).
+
+Each step writes one Parquet file per trait family and date:
+
+  <base>/trait_store/<family>/date=<date>/<date>.parquet
+
+(families: mulch_height, dem_trait, nodem_trait, nodem_trait_RGB,
+merged_trait), plus whole-project tables as <base>/trait_store/<name>.parquet
+(trait_long, trait_wide from step 10). Every partition carries 'Date' (str)
+and 'Image ID' plus the trait columns. A date filter only opens the matching
+partitions, and `columns=` only decodes those columns; partitions whose
+columns differ (e.g. different index sets per date) are read under one
+unified schema, missing cells as NaN.
+Excel is an export (`export_excel`), not the exchange format between steps.
+"""
+
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import tracing
+
+STORE_DIR = "trait_store"
+KEY_COLS = ["Date", "Image ID"]
+
+
+def store_root(base):
+    return os.path.join(base, STORE_DIR)
+
+
+def family_dir(base, family):
+    return os.path.join(store_root(base), family)
+
+
+@tracing.traced()
+def write_traits(base, family, date, df):
+    """Replace the <family>/<date> partition with `df`; returns the file path."""
+    out_dir = os.path.join(family_dir(base, family), f"date={date}")
+    os.makedirs(out_dir, exist_ok=True)
+    df = df.copy()
+    if "Date" not in df.columns:
+        df.insert(0, "Date", str(date))
+    df["Date"] = df["Date"].astype(str)
+    out_path = os.path.join(out_dir, f"{date}.parquet")
+    tmp = out_path + ".tmp"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def has_family(base, family):
+    return os.path.isdir(family_dir(base, family))
+
+
+def _partition_path(base, family, date):
+    return os.path.join(family_dir(base, family), f"date={date}", f"{date}.parquet")
+
+
+def list_dates(base, family):
+    """Dates present for a family (sorted strings)."""
+    root = family_dir(base, family)
+    if not os.path.isdir(root):
+        return []
+    dates = [d.split("=", 1)[1] for d in os.listdir(root) if d.startswith("date=")]
+    return sorted(d for d in dates if os.path.exists(_partition_path(base, family, d)))
+
+
+def read_traits(base, family, dates=None, columns=None):
+    """
+    DataFrame of one family; `dates` prunes partitions, `columns` prunes
+    columns ('Date' and 'Image ID' are always included). Empty if absent.
+    """
+    if dates is None:
+        dates = list_dates(base, family)
+    files = [_partition_path(base, family, d) for d in map(str, dates)]
+    files = [f for f in files if os.path.exists(f)]
+    if not files:
+        return pd.DataFrame(columns=KEY_COLS + [c for c in (columns or []) if c not in KEY_COLS])
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options="permissive")
+    if columns is not None:
+        columns = KEY_COLS + [c for c in columns if c not in KEY_COLS and c in schema.names]
+    dataset = ds.dataset(files, schema=schema, format="parquet")
+    return dataset.to_table(columns=columns).to_pandas()
+
+
+def export_excel(base, family, out_dir=None, dates=None, drop_date=False):
+    """Write <out_dir>/<date>.xlsx per date (default out_dir: <base>/<family>)."""
+    out_dir = out_dir or os.path.join(base, family)
+    os.makedirs(out_dir, exist_ok=True)
+    df = read_traits(base, family, dates=dates)
+    paths = []
+    for date, g in df.groupby("Date", sort=True):
+        out_path = os.path.join(out_dir, f"{date}.xlsx")
+        (g.drop(columns=["Date"]) if drop_date else g).to_excel(out_path, index=False)
+        paths.append(out_path)
+    return paths
+
+
+def _table_path(base, name):
+    return os.path.join(store_root(base), f"{name}.parquet")
+
+
+def write_table(base, name, df):
+    """Whole-project table (not date-partitioned), e.g. the wide trait table."""
+    os.makedirs(store_root(base), exist_ok=True)
+    out_path = _table_path(base, name)
+    tmp = out_path + ".tmp"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def read_table(base, name, columns=None):
+    return pq.read_table(_table_path(base, name), columns=columns).to_pandas()
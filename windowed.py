@@ -0,0 +1,168 @@
+"""
+windowed.py
+-----------
+Block-wise raster processing under a memory budget (--memory-budget 2GB),
+for full-field DEMs/orthos that do not fit in worker RAM.
+
+    budget = windowed.parse_budget("2GB")
+    if not windowed.fits(src.width, src.height, bytes_per_px, budget):
+        for core, read in windowed.windows(src.width, src.height, src.block_shapes[0],
+                                           bytes_per_px, budget, halo=windowed.morph_halo(15, 2)):
+            arr = src.read(1, window=read, masked=True)
+            ...
+            dst.write(out[windowed.core_slices(core, read)], 1, window=core)
+
+`bytes_per_px` is the caller's estimate of its working set per pixel (input
+band, masks, morphology temporaries, ...). Core windows tile the raster and
+are aligned to the file's internal blocks (strips or tiles; common_block()
+of the source's and the output's), so every block is decoded once per pass
+and window writes fill whole output tiles. Each read
+window is its core grown by `halo` pixels (clipped to the raster), so
+neighbourhood operations on the core see the same pixels as a whole-raster
+run. Strips of full width are used while they fit, square-ish tiles
+otherwise. A budget below one block plus halo still processes one block at a
+time (the smallest unit the file can be read in).
+
+read_on_grid() reads only the source pixels under a window of a reference
+grid and aligns them with reproject_plan's nearest-neighbour gather (window
+plans are uncached, used once, and sample exactly like the whole-grid plan).
+"""
+
+import math
+import re
+
+import numpy as np
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, bounds as window_bounds, from_bounds
+
+from reproject_plan import same_grid, window_plan
+
+_UNITS = {"": 1, "b": 1, "k": 2**10, "kb": 2**10, "m": 2**20, "mb": 2**20,
+          "g": 2**30, "gb": 2**30, "t": 2**40, "tb": 2**40}
+_BUDGET_RE = re.compile(r"^\s*([0-9]*\.?[0-9]+)\s*([a-zA-Z]*)\s*$")
+
+# transient memory of building one nearest-neighbour plan, per reference pixel
+# (pixel grid, coordinates, source indices; see reproject_plan._build_plan)
+PLAN_BYTES_PER_PX = 80
+
+
+def parse_budget(text):
+    """'512MB', '2G', '1.5GB', '1073741824' -> bytes; None/'' -> None (no budget)."""
+    if text is None or text == "":
+        return None
+    if isinstance(text, (int, float)):
+        return int(text)
+    m = _BUDGET_RE.match(str(text))
+    if not m or m.group(2).lower() not in _UNITS:
+        raise ValueError(f"Bad memory budget '{text}' (use e.g. 512MB, 2GB)")
+    return int(float(m.group(1)) * _UNITS[m.group(2).lower()])
+
+
+def fits(width, height, bytes_per_px, budget):
+    """True if the whole raster can be processed in one piece (always without a budget)."""
+    return budget is None or width * height * bytes_per_px <= budget
+
+
+def morph_halo(*kernels):
+    """Halo for a chain of dilations/erosions: each k x k op reaches k // 2 pixels."""
+    return sum(k // 2 for k in kernels if k and k > 1)
+
+
+def _window_shape(width, height, block_shape, bytes_per_px, budget, halo):
+    px = max(1, budget // max(1, bytes_per_px))
+    bh, bw = block_shape
+    bh, bw = max(1, min(bh, height)), max(1, min(bw, width))
+    # full-width strips: the halo only adds rows, the read window is clamped to the raster's columns
+    if (bh + 2 * halo) * width <= px:
+        rows = (px // width - 2 * halo) // bh * bh
+        return max(bh, min(rows, height)), width
+    # tiles: strips would not fit, split the columns too (any width for striped files)
+    uw = bw if bw < width else 1
+    side = max(1, int(math.isqrt(px)) - 2 * halo)
+    rows = max(bh, side // bh * bh)
+    cols = (px // (rows + 2 * halo) - 2 * halo) // uw * uw
+    return min(rows, height), max(uw, min(cols, width))
+
+
+def windows(width, height, block_shape, bytes_per_px, budget, halo=0):
+    """
+    (core, read) window pairs covering the raster in row-major order. Without a
+    budget a single pair spans the whole raster.
+    """
+    if budget is None:
+        rows, cols = height, width
+    else:
+        rows, cols = _window_shape(width, height, block_shape, bytes_per_px, budget, halo)
+    out = []
+    for r0 in range(0, height, rows):
+        for c0 in range(0, width, cols):
+            core = Window(c0, r0, min(cols, width - c0), min(rows, height - r0))
+            r1, c1 = max(0, r0 - halo), max(0, c0 - halo)
+            read = Window(c1, r1,
+                          min(width, c0 + core.width + halo) - c1,
+                          min(height, r0 + core.height + halo) - r1)
+            out.append((core, read))
+    return out
+
+
+def common_block(*shapes):
+    """Smallest (rows, cols) block aligned to every given block shape (source and output tiling)."""
+    return (math.lcm(*(int(s[0]) for s in shapes)), math.lcm(*(int(s[1]) for s in shapes)))
+
+
+def band_rows(width, block_shape, bytes_per_px, budget, default):
+    """Rows per full-width band for streaming passes (multiple of the block height)."""
+    if budget is None:
+        return default
+    bh = max(1, block_shape[0])
+    rows = budget // max(1, bytes_per_px * width) // bh * bh
+    return max(bh, rows)
+
+
+def core_slices(core, read):
+    """Slices selecting the core window inside an array read with the read window."""
+    r0 = core.row_off - read.row_off
+    c0 = core.col_off - read.col_off
+    return slice(r0, r0 + core.height), slice(c0, c0 + core.width)
+
+
+def _source_window(src, ref_profile, window):
+    """Window of `src` covering `window` of the reference grid (plus one pixel), or None."""
+    left, bottom, right, top = window_bounds(window, ref_profile["transform"])
+    if src.crs and ref_profile["crs"] and src.crs != ref_profile["crs"]:
+        left, bottom, right, top = transform_bounds(ref_profile["crs"], src.crs,
+                                                    left, bottom, right, top, densify_pts=21)
+    w = from_bounds(left, bottom, right, top, src.transform)
+    c0 = max(0, math.floor(min(w.col_off, w.col_off + w.width)) - 1)
+    r0 = max(0, math.floor(min(w.row_off, w.row_off + w.height)) - 1)
+    c1 = min(src.width, math.ceil(max(w.col_off, w.col_off + w.width)) + 1)
+    r1 = min(src.height, math.ceil(max(w.row_off, w.row_off + w.height)) + 1)
+    if c1 <= c0 or r1 <= r0:
+        return None
+    return Window(c0, r0, c1 - c0, r1 - r0)
+
+
+def read_on_grid(src, ref_profile, window, fn, fill=0, band=1):
+    """
+    Band `band` of `src` under `window` of the reference grid, passed through
+    `fn` (masked array -> array, or list of arrays) and aligned onto the
+    window with nearest-neighbour sampling; pixels outside `src` get `fill`.
+    Returns what `fn` returns (array or list), on the window's shape.
+    """
+    if same_grid(src.profile, ref_profile):
+        return fn(src.read(band, window=window, masked=True))
+    sw = _source_window(src, ref_profile, window)
+    if sw is None:
+        res = fn(np.ma.masked_all((1, 1), dtype=src.dtypes[band - 1]))
+        many = isinstance(res, (list, tuple))
+        outs = [np.full((window.height, window.width), fill, dtype=r.dtype) for r in (res if many else [res])]
+        return outs if many else outs[0]
+    res = fn(src.read(band, window=sw, masked=True))
+    many = isinstance(res, (list, tuple))
+    dst_idx, src_idx = window_plan(src.profile, sw, ref_profile, window)
+    outs = []
+    for r in (res if many else [res]):
+        out = np.full((window.height, window.width), fill, dtype=r.dtype)
+        out.reshape(-1)[dst_idx] = r.reshape(-1)[src_idx]
+        outs.append(out)
+    return outs if many else outs[0]
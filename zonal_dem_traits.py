@@ -0,0 +1,346 @@
+"""
+zonal_dem_traits.py
+-------------------
+Step 8 DEM traits (canopy coverage, top-5% height, volume) for every plot
+straight from the full-field DEM, without the dem_by_plot chips.
+
+The plot polygons are burned once into a plot-ID label raster on the DEM grid
+(cached as .npy under <date>/.zonal_cache and memory-mapped). The DEM and a
+full-field vegetation mask on the same grid are then streamed in row bands:
+per-plot pixel counts and elevation sums come from np.bincount, and the top-5%
+candidates of all plots are kept together by one grouped sort per flush, so
+there is no per-plot loop and no per-plot file.
+
+Plot IDs follow 3_cropFromOrthomosaic2.py (first attribute of each feature,
+"<id>.tif" as Image ID), so the table lines up with the chip-based step 8 and
+with step 7's mulch baselines. Output goes to the trait store (dem_trait).
+
+Usage examples:
+  # Batch; veg mask = <date>/orthos/*veg_mask.tif (nonzero = vegetation)
+  python zonal_dem_traits.py --batchpath D:\\test --folder-pattern "_20m_" --shp D:\\test\\plots.shp --veg-suffix veg_mask.tif
+
+  # One date; threshold a full-field VI on the DEM grid on the fly
+  python zonal_dem_traits.py --ipath D:\\test\\20241118_VW_Neo_20m_ --shp plots.shp --veg-suffix OSAVI.tif --veg-lt 0.6
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import fnmatch
+import numpy as np
+import pandas as pd
+import fiona
+import rasterio
+from rasterio.features import rasterize, bounds as geom_bounds
+from rasterio.warp import transform_geom
+from rasterio.windows import Window, bounds as window_bounds, transform as window_transform
+
+from reproject_plan import same_grid
+from dem_traits import canopy_traits, load_baseline_map
+import trait_store
+import catalog
+import windowed
+
+BLOCK_ROWS = 1024
+# working set per pixel of a streamed band: labels, DEM, vegetation, selection and temporaries
+BYTES_PER_PX = 32
+TOP_FRAC = 0.05
+
+
+# ---------- helpers ----------
+def _normalize_patterns(pattern_str):
+    """Comma/semicolon separated; add wildcards if missing; case-insensitive."""
+    if not pattern_str:
+        return ['*AS_S2*']
+    raw = [p.strip() for p in pattern_str.replace(';', ',').split(',') if p.strip()]
+    norm = []
+    for p in raw:
+        if not any(ch in p for ch in '*?['):
+            p = f"*{p}*"
+        norm.append(p.lower())
+    return norm
+
+def _matches_any(name, patterns):
+    n = name.lower()
+    return any(fnmatch.fnmatch(n, pat) for pat in patterns)
+
+def _find_raster(folder, suffix, cat):
+    hits = sorted(f for f in catalog.listdir(cat, folder) if f.lower().endswith(suffix.lower()))
+    if len(hits) > 1:
+        print(f"[WARN] Several *{suffix} in {folder}; using {hits[0]}")
+    return os.path.join(folder, hits[0]) if hits else None
+
+def _row_bands(height, width, block_rows):
+    for r0 in range(0, height, block_rows):
+        yield Window(0, r0, width, min(block_rows, height - r0))
+
+
+# ---------- label raster ----------
+def read_plots(shp_path, dst_crs=None, id_field=None):
+    """(geometries in dst_crs, plot id strings) in shapefile order."""
+    with fiona.open(shp_path) as shapes:
+        src_crs = shapes.crs_wkt or None
+        geoms, ids = [], []
+        for feat in shapes:
+            props = dict(feat["properties"])
+            key = id_field or next(iter(props))
+            if key not in props:
+                raise ValueError(f"Field '{key}' not in {shp_path}: {list(props)}")
+            geoms.append(feat["geometry"])
+            ids.append(str(props[key]).replace("'", ""))
+    if dst_crs is not None and src_crs and rasterio.crs.CRS.from_wkt(src_crs) != dst_crs:
+        geoms = [transform_geom(src_crs, dst_crs, g) for g in geoms]
+    return geoms, ids
+
+def _label_key(shp_path, id_field, profile):
+    st = os.stat(shp_path)
+    parts = [os.path.abspath(shp_path), st.st_mtime_ns, st.st_size, id_field or "",
+             profile["crs"].to_wkt() if profile["crs"] else "",
+             tuple(profile["transform"])[:6], profile["width"], profile["height"]]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+def label_raster(shp_path, profile, cache_dir, id_field=None, block_rows=BLOCK_ROWS):
+    """
+    Plot-ID label raster (int32, 0 = no plot, i + 1 = i-th plot) on the grid of
+    `profile`, plus the plot ids. Built band by band into a memmap and reused
+    while the shapefile and grid are unchanged. Overlapping plots: last wins.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = _label_key(shp_path, id_field, profile)
+    npy = os.path.join(cache_dir, f"labels_{key}.npy")
+    meta = os.path.join(cache_dir, f"labels_{key}.json")
+    if os.path.exists(npy) and os.path.exists(meta):
+        with open(meta) as f:
+            ids = json.load(f)["ids"]
+        return np.load(npy, mmap_mode="r"), ids
+
+    geoms, ids = read_plots(shp_path, profile["crs"], id_field)
+    gb = np.array([geom_bounds(g) for g in geoms], dtype=np.float64).reshape(-1, 4)
+    h, w = profile["height"], profile["width"]
+    tmp = npy + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.int32, shape=(h, w))
+    for win in _row_bands(h, w, block_rows):
+        left, bottom, right, top = window_bounds(win, profile["transform"])
+        hit = np.flatnonzero((gb[:, 0] <= right) & (gb[:, 2] >= left) &
+                             (gb[:, 1] <= top) & (gb[:, 3] >= bottom))
+        rows = slice(win.row_off, win.row_off + win.height)
+        if hit.size == 0:
+            out[rows] = 0
+            continue
+        out[rows] = rasterize(((geoms[i], i + 1) for i in hit),
+                              out_shape=(win.height, win.width),
+                              transform=window_transform(win, profile["transform"]),
+                              fill=0, dtype="int32")
+    out.flush()
+    del out
+    os.replace(tmp, npy)
+    with open(meta, "w") as f:
+        json.dump({"shp": os.path.abspath(shp_path), "ids": ids}, f)
+    print(f"[INFO] Cached plot label raster → {npy}")
+    return np.load(npy, mmap_mode="r"), ids
+
+
+# ---------- streaming reductions ----------
+def _valid_blocks(dem_src, veg_src, labels, block_rows, veg_lt=None, veg_ut=None, nodata=-9999):
+    """Yield (plot label, elevation) of the valid vegetation pixels, one row band at a time."""
+    for win in _row_bands(dem_src.height, dem_src.width, block_rows):
+        lab = np.asarray(labels[win.row_off:win.row_off + win.height])
+        sel = lab > 0
+        if not sel.any():
+            continue
+        dem = dem_src.read(1, window=win)
+        veg = veg_src.read(1, window=win)
+        if veg_lt is None and veg_ut is None:
+            sel &= veg > 0
+        else:
+            if veg_lt is not None:
+                sel &= veg >= veg_lt
+            if veg_ut is not None:
+                sel &= veg <= veg_ut
+            if veg_src.nodata is not None:
+                sel &= veg != veg_src.nodata
+        sel &= dem != nodata
+        if dem_src.nodata is not None:
+            sel &= dem != dem_src.nodata
+        if np.issubdtype(dem.dtype, np.floating):
+            sel &= ~np.isnan(dem)
+        yield lab[sel], dem[sel]
+
+def _keep_top_k(lab, val, k):
+    """Keep the k[label] largest values of each label group (one lexsort)."""
+    order = np.lexsort((-val, lab))
+    lab, val = lab[order], val[order]
+    rank = np.arange(lab.size) - np.searchsorted(lab, lab, side="left")
+    keep = rank < k[lab]
+    return lab[keep], val[keep]
+
+def zonal_dem_stats(dem_path, veg_path, labels, n_plots, block_rows=BLOCK_ROWS,
+                    veg_lt=None, veg_ut=None):
+    """
+    Per-plot (coverage_px, top-5% mean elevation, elevation sum) arrays of
+    length n_plots, the vectorized counterpart of dem_traits.canopy_stats.
+    Two streamed passes: counts/sums, then top-k candidates once k is known.
+    """
+    n = n_plots + 1
+    with rasterio.open(dem_path) as dem_src, rasterio.open(veg_path) as veg_src:
+        if not same_grid(veg_src.profile, dem_src.profile):
+            raise ValueError(f"Vegetation raster {veg_path} is not on the DEM grid of {dem_path}")
+
+        counts = np.zeros(n, dtype=np.int64)
+        sums = np.zeros(n, dtype=np.float64)
+        for lab, val in _valid_blocks(dem_src, veg_src, labels, block_rows, veg_lt, veg_ut):
+            counts += np.bincount(lab, minlength=n)
+            sums += np.bincount(lab, weights=val, minlength=n)
+
+        k = np.maximum(1, (TOP_FRAC * counts).astype(np.int64))
+        k[counts == 0] = 0
+        flush_at = max(int(k.sum()), 1 << 20)
+        cand_lab = np.empty(0, dtype=np.int32)
+        cand_val = np.empty(0, dtype=np.float64)
+        pend_lab, pend_val, pend_n = [], [], 0
+        for lab, val in _valid_blocks(dem_src, veg_src, labels, block_rows, veg_lt, veg_ut):
+            pend_lab.append(lab)
+            pend_val.append(val.astype(np.float64))
+            pend_n += lab.size
+            if pend_n >= flush_at:
+                cand_lab, cand_val = _keep_top_k(np.concatenate([cand_lab] + pend_lab),
+                                                 np.concatenate([cand_val] + pend_val), k)
+                pend_lab, pend_val, pend_n = [], [], 0
+        cand_lab, cand_val = _keep_top_k(np.concatenate([cand_lab] + pend_lab),
+                                         np.concatenate([cand_val] + pend_val), k)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        top = np.bincount(cand_lab, weights=cand_val, minlength=n) / k
+    return counts[1:], top[1:], sums[1:]
+
+
+# ---------- trait table ----------
+def _px_area_m2(profile, gsd_file, date_component):
+    """Pixel area of the DEM grid (projected CRS), else the GSD table as in step 8."""
+    crs = profile["crs"]
+    if crs is not None and crs.is_projected:
+        unit = crs.linear_units_factor[1]
+        t = profile["transform"]
+        return abs(t.a * t.e) * unit * unit
+    if gsd_file and os.path.exists(gsd_file):
+        gsd_df = pd.read_excel(gsd_file)
+        s = gsd_df.loc[gsd_df['filename'].astype(str) == str(date_component), 'GSD(mm/pix)']
+        if not s.empty:
+            return (float(s.values[0]) / 1000.0) ** 2
+    print(f"[WARN] No pixel area for date {date_component} (geographic CRS and no GSD entry)")
+    return np.nan
+
+def zonal_trait_table(date_component, image_ids, stats, ref_h, px_m2):
+    """Step 8 columns for all plots at once (dem_traits.canopy_traits on arrays)."""
+    counts, top, sums = stats
+    cov = np.where(counts > 0, counts, np.nan)
+    df = pd.DataFrame({'Date': date_component, 'Image ID': image_ids})
+    for col, vals in canopy_traits(cov, top, sums, ref_h, px_m2).items():
+        df[col] = vals
+    return df
+
+def zonal_trait_extract(input_folder, shp_path, veg_suffix, dem_suffix="dem.tif",
+                        raster_subdir="orthos", reference_subdir="mulch_height",
+                        gsd_file=None, id_field=None, veg_lt=None, veg_ut=None,
+                        out_subdir="dem_trait", block_rows=BLOCK_ROWS, excel=False, cat=None,
+                        memory_budget=None):
+    """
+    Trait table for one date folder, written to the trait store (dem_trait
+    family, as step 8); `excel` also writes <date folder>/<out_subdir>/<date>.xlsx.
+    `memory_budget` (bytes) sizes the row bands instead of `block_rows`.
+    """
+    base = os.path.dirname(os.path.normpath(input_folder))
+    folder_name = os.path.basename(os.path.normpath(input_folder))
+    date_component = folder_name.split("_")[0]
+    rdir = os.path.join(input_folder, raster_subdir)
+    cat = cat or catalog.for_folder(input_folder)
+    dem_path = _find_raster(rdir, dem_suffix, cat)
+    veg_path = _find_raster(rdir, veg_suffix, cat)
+    if dem_path is None or veg_path is None:
+        print(f"[WARN] Need *{dem_suffix} and *{veg_suffix} in {rdir}")
+        return None
+
+    with rasterio.open(dem_path) as src:
+        profile = src.profile
+        block_rows = windowed.band_rows(src.width, src.block_shapes[0], BYTES_PER_PX,
+                                        memory_budget, block_rows)
+    labels, ids = label_raster(shp_path, profile, os.path.join(input_folder, ".zonal_cache"),
+                               id_field=id_field, block_rows=block_rows)
+    image_ids = [f"{i}.tif" for i in ids]
+
+    stats = zonal_dem_stats(dem_path, veg_path, labels, len(ids), block_rows=block_rows,
+                            veg_lt=veg_lt, veg_ut=veg_ut)
+
+    if gsd_file is None:
+        gsd_file = os.path.join(base, "metashape_report", "gsd_4_all.xlsx")
+    px_m2 = _px_area_m2(profile, gsd_file, date_component)
+    baseline_map = load_baseline_map(base, date_component, reference_subdir)
+    ref_h = np.array([baseline_map.get(i, np.nan) for i in image_ids], dtype=np.float64)
+    df = zonal_trait_table(date_component, image_ids, stats, ref_h, px_m2)
+
+    out_path = trait_store.write_traits(base, "dem_trait", date_component, df)
+    print(f"[OK] Saved zonal traits ({len(df)} plots) → {out_path}")
+    if excel:
+        output_folder = os.path.join(input_folder, out_subdir)
+        os.makedirs(output_folder, exist_ok=True)
+        out_xlsx = os.path.join(output_folder, f"{date_component}.xlsx")
+        df.to_excel(out_xlsx, index=False)
+        print(f"[OK] Saved zonal traits → {out_xlsx}")
+    return df
+
+def zonal_trait_extract_batch(batch_folder, folder_pattern="*AS_S2*", **kwargs):
+    patterns = _normalize_patterns(folder_pattern)
+    cat = catalog.load(batch_folder)
+    count = 0
+    for folder in catalog.subdirs(cat):
+        input_folder = os.path.join(batch_folder, folder)
+        if _matches_any(folder, patterns):
+            print(f"[INFO] Processing {input_folder}")
+            zonal_trait_extract(input_folder, cat=cat, **kwargs)
+            count += 1
+    if count == 0:
+        print(f"[WARN] No subfolders matched {patterns} under {batch_folder}")
+
+# ---------- cli ----------
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Per-plot DEM traits from the full-field DEM via a plot label raster.")
+    p.add_argument("--ipath", type=str, help="Path to one date folder.")
+    p.add_argument("--batchpath", type=str, help="Path containing multiple date folders.")
+    p.add_argument("--folder-pattern", type=str, default="*AS_S2*",
+                   help="Glob(s) for batch subfolders; e.g. '*_Swb_Cl*' or 'AS_S2,*_Swb_Cl*'.")
+    p.add_argument("--shp", type=str, required=True, help="Plot polygon shapefile (same as step 3).")
+    p.add_argument("--id-field", type=str, default=None,
+                   help="Attribute holding the plot id (default: first attribute, as step 3).")
+    p.add_argument("--raster-subdir", type=str, default="orthos",
+                   help="Subfolder of each date folder holding the full-field rasters.")
+    p.add_argument("--dem-suffix", type=str, default="dem.tif")
+    p.add_argument("--veg-suffix", type=str, required=True,
+                   help="Full-field vegetation raster on the DEM grid (nonzero = vegetation, "
+                        "or thresholded with --veg-lt/--veg-ut).")
+    p.add_argument("--veg-lt", type=float, default=None, help="Vegetation if value >= this.")
+    p.add_argument("--veg-ut", type=float, default=None, help="Vegetation if value <= this.")
+    p.add_argument("--reference-subdir", type=str, default="mulch_height",
+                   help="Subfolder (next to date folder) containing mulch baseline Excel per date.")
+    p.add_argument("--gsd-file", type=str, default=None,
+                   help="gsd_4_all.xlsx, only used when the DEM CRS is geographic.")
+    p.add_argument("--out-subdir", type=str, default="dem_trait", help="Excel folder used with --excel.")
+    p.add_argument("--excel", action="store_true",
+                   help="Also write <date folder>/<out-subdir>/<date>.xlsx next to the trait store.")
+    p.add_argument("--block-rows", type=int, default=BLOCK_ROWS, help="Rows per streamed band.")
+    p.add_argument("--memory-budget", type=str, default=None,
+                   help="Size the streamed bands to this much RAM (e.g. 2GB); overrides --block-rows.")
+    args = p.parse_args()
+
+    kwargs = dict(shp_path=args.shp, veg_suffix=args.veg_suffix, dem_suffix=args.dem_suffix,
+                  raster_subdir=args.raster_subdir, reference_subdir=args.reference_subdir,
+                  gsd_file=args.gsd_file, id_field=args.id_field,
+                  veg_lt=args.veg_lt, veg_ut=args.veg_ut,
+                  out_subdir=args.out_subdir, block_rows=args.block_rows, excel=args.excel,
+                  memory_budget=windowed.parse_budget(args.memory_budget))
+    if args.batchpath:
+        zonal_trait_extract_batch(args.batchpath, folder_pattern=args.folder_pattern, **kwargs)
+    elif args.ipath:
+        zonal_trait_extract(args.ipath, **kwargs)
+    else:
+        raise SystemExit("Provide either --ipath or --batchpath")